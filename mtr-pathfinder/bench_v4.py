@@ -0,0 +1,281 @@
+'''
+Benchmarks for the real-time pathfinder (v4) on generated maps.
+'''
+
+from random import Random
+from time import perf_counter
+import copy
+import json
+import os
+import sys
+import tempfile
+
+from mtr_pathfinder_v4 import (compile_timetable, CSA, gen_route_timetable,
+                               get_distance, lower_bounds, MAX_BAG_SIZE, np,
+                               process_data, Raptor, RUNNING_SPEED,
+                               Timetable, TRANSFER_SPEED, WILD_WALKING_SPEED)
+
+# 从A站到B站，非出站换乘（越野）的最远步行距离，默认值为1500
+MAX_WILD_BLOCKS: int = 1500
+# 平均每个车站占用的面积边长，单位 block
+STATION_SPACING: int = 400
+# 每条路线的车站数量
+ROUTE_LENGTH: int = 12
+
+
+def gen_map(n_stations: int, seed: int = 0) -> dict:
+    '''
+    Generate a stations-and-routes response with n_stations stations.
+    The map grows in area with the station count, so density is constant.
+    '''
+    rnd = Random(seed)
+    side = int(n_stations ** 0.5 * STATION_SPACING)
+    stations = []
+    coords = []
+    for i in range(n_stations):
+        stations.append({'id': f'{i:016X}', 'name': f'站{i}|Station {i}',
+                         'color': 0, 'zone1': 0, 'zone2': 0, 'zone3': 0,
+                         'connections': []})
+        coords.append((rnd.uniform(0, side), rnd.uniform(0, side)))
+
+    # 相近的车站之间添加出站换乘
+    for i in range(0, n_stations - 1, 10):
+        j = i + 1
+        stations[i]['connections'].append(stations[j]['id'])
+        stations[j]['connections'].append(stations[i]['id'])
+
+    routes = []
+    order = sorted(range(n_stations), key=lambda i: (coords[i][0] // 3000,
+                                                     coords[i][1]))
+    for r, start in enumerate(range(0, n_stations, ROUTE_LENGTH // 2)):
+        ids = order[start:start + ROUTE_LENGTH]
+        if len(ids) < 2:
+            continue
+
+        for ids_ in (ids, ids[::-1]):
+            route_stations = []
+            for i in ids_:
+                x, z = coords[i]
+                route_stations.append({'id': stations[i]['id'],
+                                       'x': round(x) + rnd.randint(-8, 8),
+                                       'y': 64,
+                                       'z': round(z) + rnd.randint(-8, 8),
+                                       'dwellTime': 20000})
+
+            durations = [round(get_distance(
+                {'x': a['x'], 'z': a['z']}, {'x': b['x'], 'z': b['z']})
+                / 14 * 1000) for a, b in zip(route_stations,
+                                             route_stations[1:])]
+            routes.append({'id': f'R{len(routes):015X}',
+                           'name': f'{r}号线|Line {r}', 'color': r * 997,
+                           'number': str(r), 'type': 'train_normal',
+                           'circularState': 'NONE', 'hidden': False,
+                           'stations': route_stations,
+                           'durations': durations, 'depots': []})
+
+    return {'stations': stations, 'routes': routes}
+
+
+def transfer_matrix_naive(data_new: dict, MAX_WILD_BLOCKS) -> tuple[dict]:
+    '''
+    The O(n²) transfer matrix, kept as the reference output.
+    '''
+    transfer_time = {}
+    transfer_dist = {}
+    for x, dict1 in data_new['station_coords'].items():
+        for y, dict2 in data_new['station_coords'].items():
+            if x == y:
+                continue
+
+            distance = get_distance(dict1, dict2)
+            if x == y:
+                speed = RUNNING_SPEED
+            elif x in data_new['stations'][y]['connections'] or \
+                    y in data_new['stations'][x]['connections']:
+                speed = TRANSFER_SPEED
+            else:
+                speed = WILD_WALKING_SPEED
+                if distance > MAX_WILD_BLOCKS:
+                    continue
+
+                if abs(dict1['x'] - dict2['x']) > MAX_WILD_BLOCKS or \
+                        abs(dict1['z'] - dict2['z']) > MAX_WILD_BLOCKS:
+                    continue
+
+            transfer_time.setdefault(x, {})[y] = distance / speed
+            transfer_dist.setdefault(x, {})[y] = distance
+
+    return transfer_time, transfer_dist
+
+
+def bench_transfer(sizes=(500, 1000, 2000, 5000, 10000, 20000),
+                   naive_limit: int = 2000) -> None:
+    '''
+    Time process_data() with and without NumPy against the naive
+    transfer matrix, checking that all of them agree.
+    '''
+    print(f'{"stations":>8} {"pairs":>9} {"numpy (s)":>10} '
+          f'{"python (s)":>10} {"naive matrix (s)":>16}')
+    for n in sizes:
+        raw = gen_map(n)
+        numpy_time = '-'
+        if np is not None:
+            start = perf_counter()
+            data_np = process_data(copy.deepcopy(raw), MAX_WILD_BLOCKS)
+            numpy_time = f'{perf_counter() - start:.3f}'
+
+        start = perf_counter()
+        data_new = process_data(copy.deepcopy(raw), MAX_WILD_BLOCKS,
+                                use_numpy=False)
+        python_time = perf_counter() - start
+        pairs = sum(len(x) for x in data_new['transfer_time'].values())
+        got = json.dumps(data_new)
+        if np is not None and json.dumps(data_np) != got:
+            raise AssertionError(f'NumPy output mismatch at {n}')
+
+        naive_time = '-'
+        if n <= naive_limit:
+            start = perf_counter()
+            expected = transfer_matrix_naive(data_new, MAX_WILD_BLOCKS)
+            naive_time = f'{perf_counter() - start:.3f}'
+            got = (data_new['transfer_time'], data_new['transfer_dist'])
+            if json.dumps(got) != json.dumps(expected):
+                raise AssertionError(f'Transfer matrix mismatch at {n}')
+
+        print(f'{n:>8} {pairs:>9} {numpy_time:>10} '
+              f'{python_time:>10.3f} {naive_time:>16}')
+
+
+def bench_incremental(sizes=(2000, 20000), changed_routes: int = 3) -> None:
+    '''
+    Time a refresh in which a few routes changed, processing from scratch
+    and incrementally from the previous data, checking that they agree.
+    '''
+    print(f'{"stations":>8} {"full (s)":>9} {"incremental (s)":>15} '
+          f'{"rows redone":>11}')
+    for n in sizes:
+        raw = gen_map(n)
+        old = process_data(copy.deepcopy(raw), MAX_WILD_BLOCKS)
+        for route in raw['routes'][:changed_routes]:
+            route['durations'] = [x + 1000 for x in route['durations']]
+            route['stations'][0]['x'] += 50
+
+        start = perf_counter()
+        full = process_data(copy.deepcopy(raw), MAX_WILD_BLOCKS)
+        full_time = perf_counter() - start
+        start = perf_counter()
+        inc = process_data(copy.deepcopy(raw), MAX_WILD_BLOCKS, old=old)
+        inc_time = perf_counter() - start
+        if json.dumps([inc['routes'], inc['transfer_time']]) != \
+                json.dumps([full['routes'], full['transfer_time']]):
+            raise AssertionError(f'Incremental output mismatch at {n}')
+
+        redone = sum(1 for x in inc['hashes']['stations']
+                     if inc['hashes']['stations'][x] !=
+                     old['hashes']['stations'][x])
+        print(f'{n:>8} {full_time:>9.3f} {inc_time:>15.3f} {redone:>11}')
+
+
+def build_timetable(data: dict, headway: int = 600) -> Timetable:
+    '''
+    Compile the timetable of a processed generated map, with a departure
+    from every route every headway seconds.
+    '''
+    tt_dict = {}
+    for route_id in data['routes']:
+        tt = gen_route_timetable(data, route_id, [], False, {}, {})
+        if tt is not None:
+            tt_dict[route_id] = tt
+
+    dep_data = {route_id: list(range(i * 37 % headway, 86400, headway))
+                for i, route_id in enumerate(tt_dict)}
+    with tempfile.TemporaryDirectory() as tmp:
+        dep_path = os.path.join(tmp, 'departures.json')
+        with open(dep_path, 'w', encoding='utf-8') as f:
+            json.dump(dep_data, f)
+
+        return compile_timetable(tt_dict, dep_path)
+
+
+def bench_raptor(sizes=(500, 2000, 5000), hours=(1, 3, 6),
+                 queries: int = 20) -> None:
+    '''
+    Time Raptor.compute() against CSA.compute() on the same random queries,
+    checking that they arrive at the same time.
+    '''
+    print(f'{"stations":>8} {"hours":>5} {"csa (ms)":>9} '
+          f'{"raptor (ms)":>11} {"patterns (s)":>12}')
+    for n in sizes:
+        data = process_data(gen_map(n), MAX_WILD_BLOCKS)
+        timetable = build_timetable(data)
+        start = perf_counter()
+        timetable.route_patterns()
+        patterns_time = perf_counter() - start
+        csa = CSA(n, timetable)
+        raptor = Raptor(n, timetable)
+        for h in hours:
+            rnd = Random(h)
+            csa_time = raptor_time = 0
+            for _ in range(queries):
+                a, b = rnd.randrange(n), rnd.randrange(n)
+                t = rnd.randrange(86400)
+                start = perf_counter()
+                expected = csa.compute(a, b, t, t + h * 3600)
+                csa_time += perf_counter() - start
+                start = perf_counter()
+                got = raptor.compute(a, b, t, t + h * 3600)
+                raptor_time += perf_counter() - start
+                if [x[3] for x in expected[-1:]] != [x[3] for x in got[-1:]]:
+                    raise AssertionError(f'Raptor arrival mismatch at {n}')
+
+            print(f'{n:>8} {h:>5} {csa_time / queries * 1000:>9.1f} '
+                  f'{raptor_time / queries * 1000:>11.1f} '
+                  f'{patterns_time:>12.3f}')
+
+
+def bench_pruning(sizes=(500, 2000, 5000), queries: int = 30) -> None:
+    '''
+    Count the connections CSA.compute() and CSA.compute_mc() relax with and
+    without the goal-directed lower bounds, checking that the journeys
+    are the same.
+    '''
+    print(f'{"stations":>8} {"scan":>7} {"relaxed":>9} {"pruned":>9} '
+          f'{"ratio":>6} {"plain (ms)":>10} {"pruned (ms)":>11}')
+    for n in sizes:
+        data = process_data(gen_map(n), MAX_WILD_BLOCKS)
+        timetable = build_timetable(data)
+        csa = CSA(n, timetable)
+        scans = {'ea': lambda a, b, t, bound: csa.compute(
+                     a, b, t, t + 3 * 3600, [], bound),
+                 'mc': lambda a, b, t, bound: csa.compute_mc(
+                     a, b, t, t + 3 * 3600, [], MAX_BAG_SIZE, True, bound)}
+        for name, scan in scans.items():
+            rnd = Random(n)
+            relaxed = pruned = 0
+            plain_time = pruned_time = 0
+            for _ in range(queries):
+                a, b = rnd.randrange(n), rnd.randrange(n)
+                t = rnd.randrange(86400)
+                start = perf_counter()
+                expected = scan(a, b, t, None)
+                plain_time += perf_counter() - start
+                relaxed += csa.relaxed
+                start = perf_counter()
+                got = scan(a, b, t, lower_bounds(data, timetable, b))
+                pruned_time += perf_counter() - start
+                pruned += csa.relaxed
+                if got != expected:
+                    raise AssertionError(f'Pruned journey mismatch at {n}')
+
+            print(f'{n:>8} {name:>7} {relaxed:>9} {pruned:>9} '
+                  f'{pruned / max(relaxed, 1):>6.2f} '
+                  f'{plain_time / queries * 1000:>10.1f} '
+                  f'{pruned_time / queries * 1000:>11.1f}')
+
+if __name__ == '__main__':
+    benchmarks = {'transfer': bench_transfer,
+                  'incremental': bench_incremental,
+                  'raptor': bench_raptor,
+                  'pruning': bench_pruning}
+    for name in sys.argv[1:] or benchmarks:
+        benchmarks[name]()
@@ -0,0 +1,352 @@
+'''
+HTTP client for the MTR map API, shared by both pathfinder versions.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import random
+from threading import BoundedSemaphore, get_ident, Lock
+from time import perf_counter, sleep
+from typing import Optional
+from urllib.parse import quote, urlsplit
+import argparse
+import gzip
+import hashlib
+import os
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.request import ACCEPT_ENCODING
+import requests
+
+TIMEOUT: tuple = (5, 60)            # 连接超时和读取超时，单位 s
+RETRIES: int = 3                    # 请求失败后的最多重试次数
+BACKOFF: float = 0.5                # 重试等待的基数，单位 s
+MAX_BACKOFF: float = 10             # 单次重试的最长等待，单位 s
+MAX_PER_HOST: int = 16              # 每个服务器同时进行的最多请求数
+
+# 这些状态码表示服务器暂时不可用，可以重试
+RETRY_STATUS = frozenset((408, 429, 500, 502, 503, 504))
+
+
+class MapClient:
+    '''
+    A pooled HTTP client with keep-alive connections, compression,
+    timeouts, jittered retries and a per-host concurrency limit.
+    It counts requests, bytes and latency for monitoring.
+    '''
+
+    def __init__(self, timeout: tuple = TIMEOUT, retries: int = RETRIES,
+                 backoff: float = BACKOFF, max_per_host: int = MAX_PER_HOST,
+                 capture_dir: str = None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_per_host = max_per_host
+        self.session = requests.Session()
+        # 安装 brotli 后 ACCEPT_ENCODING 会包含 br
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        adapter = HTTPAdapter(pool_maxsize=max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.host_limits: dict[str, BoundedSemaphore] = {}
+        self.lock = Lock()
+        self.counters = {}
+        self.reset_stats()
+        # 设置后，成功的响应会保存到该快照目录
+        self.capture_dir = capture_dir
+
+    def replay(self, snapshot_dir: str, latency: float = 0) -> None:
+        '''
+        Serve every request from snapshot_dir instead of the network,
+        waiting latency seconds per request.
+        '''
+        adapter = ReplayAdapter(snapshot_dir, latency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def host_limit(self, url: str) -> BoundedSemaphore:
+        '''
+        Get the semaphore limiting concurrent requests to the host of url.
+        '''
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = BoundedSemaphore(self.max_per_host)
+
+            return self.host_limits[host]
+
+    def get(self, url: str, headers: dict = None) -> requests.Response:
+        '''
+        GET url, retrying connection errors, timeouts and temporary
+        server errors. The last response is returned even if it is an
+        error, so the caller decides how to handle the status code.
+        '''
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.count(retries=1)
+
+            try:
+                with self.host_limit(url):
+                    # 等待并发名额的时间不计入延迟
+                    start = perf_counter()
+                    r = self.session.get(url, headers=headers,
+                                         timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self.count(requests=1, failures=1,
+                           seconds=perf_counter() - start)
+                if attempt == self.retries:
+                    raise
+
+                self.wait(attempt)
+                continue
+
+            wire_bytes = r.raw.tell() if r.raw is not None else 0
+            self.count(requests=1, seconds=perf_counter() - start,
+                       bytes_received=wire_bytes or len(r.content),
+                       bytes_decoded=len(r.content))
+            if self.capture_dir is not None and r.status_code == 200:
+                save_snapshot(self.capture_dir, url, r.content)
+
+            if r.status_code not in RETRY_STATUS or attempt == self.retries:
+                return r
+
+            self.count(failures=1)
+            self.wait(attempt, r.headers.get('Retry-After'))
+
+    def get_json(self, url: str, headers: dict = None):
+        '''
+        GET url and decode the JSON body, raising on HTTP errors.
+        '''
+        r = self.get(url, headers)
+        r.raise_for_status()
+        return r.json()
+
+    def wait(self, attempt: int, retry_after: Optional[str] = None) -> None:
+        '''
+        Sleep before a retry, with exponential backoff and full jitter.
+        '''
+        delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random()
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(MAX_BACKOFF, int(retry_after)))
+
+        sleep(delay)
+
+    def count(self, **values) -> None:
+        '''
+        Add values to the counters.
+        '''
+        with self.lock:
+            for key, value in values.items():
+                self.counters[key] += value
+
+    def reset_stats(self) -> None:
+        '''
+        Reset the request, byte and latency counters.
+        '''
+        with self.lock:
+            self.counters = {'requests': 0, 'retries': 0, 'failures': 0,
+                             'bytes_received': 0, 'bytes_decoded': 0,
+                             'seconds': 0.0}
+
+    def stats(self) -> dict:
+        '''
+        Get a copy of the counters, with the average latency in seconds.
+        bytes_received counts the bytes on the wire (compressed),
+        bytes_decoded the bytes after decompression.
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats['average_seconds'] = stats['seconds'] / stats['requests'] \
+            if stats['requests'] > 0 else 0.0
+        return stats
+
+
+def map_api(link: str, endpoint: str) -> str:
+    '''
+    Get the URL of a /mtr/api/map/ endpoint of the map at link.
+    '''
+    return link.rstrip('/') + f'/mtr/api/map/{endpoint}?dimension=0'
+
+
+def snapshot_path(snapshot_dir: str, url: str) -> str:
+    '''
+    Get the file of a snapshot that stores the response of url.
+    The host is ignored, so a snapshot can be replayed under any address.
+    '''
+    parts = urlsplit(url)
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+
+    return os.path.join(snapshot_dir, quote(target, safe='') + '.json')
+
+
+def save_snapshot(snapshot_dir: str, url: str, body: bytes) -> None:
+    '''
+    Save the response body of url into snapshot_dir.
+    '''
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = snapshot_path(snapshot_dir, url)
+    tmp = f'{path}.{os.getpid()}.{get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(body)
+
+    os.replace(tmp, path)
+
+
+def load_snapshot(snapshot_dir: str, url: str,
+                  headers) -> tuple[int, dict, bytes]:
+    '''
+    Get the status code, headers and body stored for url.
+    The ETag is the hash of the body, so conditional requests get 304.
+    '''
+    try:
+        with open(snapshot_path(snapshot_dir, url), 'rb') as f:
+            body = f.read()
+    except FileNotFoundError:
+        return 404, {'Content-Type': 'text/plain'}, b'Not in snapshot'
+
+    etag = '"' + hashlib.md5(body).hexdigest() + '"'
+    response_headers = {'Content-Type': 'application/json', 'ETag': etag}
+    if headers.get('If-None-Match') == etag:
+        return 304, response_headers, b''
+
+    return 200, response_headers, body
+
+
+class ReplayAdapter(BaseAdapter):
+    '''
+    A transport adapter for requests that answers from a snapshot
+    directory, with a fixed latency per request.
+    '''
+
+    def __init__(self, snapshot_dir: str, latency: float = 0):
+        super().__init__()
+        self.snapshot_dir = snapshot_dir
+        self.latency = latency
+
+    def send(self, request, **kwargs) -> requests.Response:
+        sleep(self.latency)
+        status, headers, body = load_snapshot(self.snapshot_dir,
+                                              request.url, request.headers)
+        r = requests.Response()
+        r.status_code = status
+        r.headers = CaseInsensitiveDict(headers)
+        r._content = body
+        r.url = request.url
+        r.request = request
+        r.encoding = 'utf-8'
+        return r
+
+    def close(self) -> None:
+        pass
+
+
+def capture(link: str, snapshot_dir: str, mtr_ver: int = 4) -> None:
+    '''
+    Download the responses used by the pathfinders into snapshot_dir:
+    stations-and-routes and departures for MTR 4,
+    /data and the /arrivals of every station for MTR 3.
+    '''
+    capture_client = MapClient(capture_dir=snapshot_dir)
+    link = link.rstrip('/')
+    if mtr_ver == 4:
+        for endpoint in ('stations-and-routes', 'departures'):
+            capture_client.get_json(map_api(link, endpoint))
+
+        return
+
+    data = capture_client.get_json(link + '/data')
+    urls = [link + f'/arrivals?worldIndex=0&stationId={station_id}'
+            for station_id in data[0]['stations']]
+    with ThreadPoolExecutor(capture_client.max_per_host) as executor:
+        list(executor.map(capture_client.get_json, urls))
+
+
+def make_server(snapshot_dir: str, host: str = '127.0.0.1', port: int = 8888,
+                latency: float = 0,
+                unavailable: int = 0) -> ThreadingHTTPServer:
+    '''
+    Create the HTTP server of a snapshot, see serve(). The body is sent
+    gzip-compressed if the client accepts it, like the live server. The
+    first unavailable requests get 503 with Retry-After, to try the
+    retries. Use port 0 to pick a free port.
+    '''
+    failures = [unavailable]
+    failures_lock = Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            sleep(latency)
+            with failures_lock:
+                fail = failures[0] > 0
+                failures[0] -= fail
+
+            if fail:
+                self.send_response(503)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            status, headers, body = load_snapshot(snapshot_dir, self.path,
+                                                  self.headers)
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+
+            if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(snapshot_dir: str, host: str = '127.0.0.1', port: int = 8888,
+          latency: float = 0, unavailable: int = 0) -> None:
+    '''
+    Serve a snapshot over HTTP, waiting latency seconds per request.
+    Use http://host:port as the map link.
+    '''
+    with make_server(snapshot_dir, host, port, latency,
+                     unavailable) as server:
+        server.serve_forever()
+
+
+# 所有查询共用的客户端
+client = MapClient()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Capture the MTR map API into a snapshot, '
+                    'or serve a snapshot for offline use.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    capture_parser = commands.add_parser('capture')
+    capture_parser.add_argument('link')
+    capture_parser.add_argument('snapshot_dir')
+    capture_parser.add_argument('--mtr-ver', type=int, default=4,
+                                choices=(3, 4))
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('snapshot_dir')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8888)
+    serve_parser.add_argument('--latency', type=float, default=0,
+                              help='seconds to wait per request')
+    serve_parser.add_argument('--unavailable', type=int, default=0,
+                              help='answer the first requests with 503')
+    args = parser.parse_args()
+    if args.command == 'capture':
+        capture(args.link, args.snapshot_dir, args.mtr_ver)
+    else:
+        serve(args.snapshot_dir, args.host, args.port, args.latency,
+              args.unavailable)
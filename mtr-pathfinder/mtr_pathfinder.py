@@ -8,7 +8,7 @@ from io import BytesIO
 from math import gcd, sqrt
 from operator import itemgetter
 from statistics import median_low
-from threading import Thread, BoundedSemaphore
+from threading import Thread
 from time import gmtime, strftime, time
 from typing import Optional, Dict, Literal, Tuple, List, Union
 from queue import Queue
@@ -23,7 +23,9 @@ from fontTools.ttLib import TTFont
 from opencc import OpenCC
 from PIL import Image, ImageDraw, ImageFont
 import networkx as nx
-import requests
+
+from mtr_api import map_api
+import mtr_api
 
 SERVER_TICK: int = 20
 
@@ -42,7 +44,6 @@ TRANSFER_SPEED: int = 4.317         # 出站换乘速度，单位 block/s
 WILD_WALKING_SPEED: int = 2.25      # 非出站换乘（越野）速度，单位 block/s
 
 ROUTE_INTERVAL_DATA = Queue()
-semaphore = BoundedSemaphore(25)
 original = {}
 tmp_names = {}
 opencc1 = OpenCC('s2t')
@@ -245,14 +246,14 @@ def fetch_interval_data(station_id: str, LINK) -> None:
     Fetch the interval data of a station.
     '''
     global ROUTE_INTERVAL_DATA
-    with semaphore:
-        link = LINK + f'/arrivals?worldIndex=0&stationId={station_id}'
-        try:
-            data = requests.get(link).json()
-        except Exception:
-            pass
-        else:
-            ROUTE_INTERVAL_DATA.put([station_id, [time(), data]])
+    link = LINK + f'/arrivals?worldIndex=0&stationId={station_id}'
+    try:
+        # 同时进行的请求数由客户端限制
+        data = mtr_api.client.get_json(link)
+    except Exception:
+        pass
+    else:
+        ROUTE_INTERVAL_DATA.put([station_id, [time(), data]])
 
 
 def gen_route_interval(LOCAL_FILE_PATH, INTERVAL_PATH, LINK, MTR_VER) -> None:
@@ -314,8 +315,8 @@ def gen_route_interval(LOCAL_FILE_PATH, INTERVAL_PATH, LINK, MTR_VER) -> None:
                 freq_dict[route] = round_ten(sum(arrivals) / len(arrivals))
 
     elif MTR_VER == 4:
-        link = LINK.rstrip('/') + '/mtr/api/map/departures?dimension=0'
-        departures = requests.get(link).json()['data']['departures']
+        departures = mtr_api.client.get_json(
+            map_api(LINK, 'departures'))['data']['departures']
         dep_dict: dict[str, list[int]] = {}
         for x in departures:
             dep_list = set()
@@ -373,12 +374,10 @@ def fetch_data(link: str, LOCAL_FILE_PATH, MTR_VER) -> str:
     Fetch all the route data and station data.
     '''
     if MTR_VER == 3:
-        link = link.rstrip('/') + '/data'
-        data = requests.get(link).json()
+        data = mtr_api.client.get_json(link.rstrip('/') + '/data')
     else:
-        link = link.rstrip('/') + \
-            '/mtr/api/map/stations-and-routes?dimension=0'
-        data = requests.get(link).json()['data']
+        data = mtr_api.client.get_json(
+            map_api(link, 'stations-and-routes'))['data']
 
         data_new = {'routes': [], 'stations': {}}
         i = 0
@@ -3,13 +3,17 @@ Find paths between two stations for Minecraft Transit Railway.
 '''
 
 from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from difflib import SequenceMatcher
-from enum import Enum
+from enum import Enum, IntEnum
 from io import BytesIO
-from math import gcd, sqrt
-from operator import itemgetter
+from math import floor, gcd, sqrt
 from random import randint
+from threading import Event, get_ident, Lock
 from time import gmtime, strftime, time
 from typing import Optional, Dict, Literal, Tuple, List, Union
 import base64
@@ -19,21 +23,53 @@ import mmap
 import os
 import pickle
 import re
+import struct
+import sys
 
 from fontTools.ttLib import TTFont
 from opencc import OpenCC
 from PIL import Image, ImageDraw, ImageFont
 import requests
 
+from mtr_api import map_api
+import mtr_api
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 MAX_INT = 2 ** 64 - 1
 
 RUNNING_SPEED: int = 5.612          # 站内换乘速度，单位 block/s
 TRANSFER_SPEED: int = 4.317         # 出站换乘速度，单位 block/s
 WILD_WALKING_SPEED: int = 2.25      # 非出站换乘（越野）速度，单位 block/s
+DATA_TTL: int = 600                 # 车站数据有效期，单位 s
+MAX_BAG_SIZE: int = 16              # 多目标寻路最多的乘车次数，每个车站最多保留 MAX_BAG_SIZE + 1 个标签
+CHECK_INTERVAL: int = 20000         # 寻路时每扫描多少个连接检查一次取消和预算
+
+DATA_MAGIC = b'MTRD'                # 车站数据二进制快照的文件头
+DATA_VERSION: int = 2               # 车站数据二进制快照的格式版本
 
 opencc1 = OpenCC('s2t')
 opencc2 = OpenCC('t2jp')
 
+# 每个数据文件一把锁，同一时间只有一个线程在更新该文件
+refresh_locks: dict[str, Lock] = {}
+refresh_locks_lock = Lock()
+
+# 读取过的车站数据，键为文件路径，值为 (文件版本, 车站数据)
+loaded_data: dict[str, tuple] = {}
+loaded_data_lock = Lock()
+
+# 编译好的时刻表，键为寻路设置，值为 (车站数据, 发车数据修改时间, 时刻表)
+MAX_COMPILED_TIMETABLES: int = 16
+compiled_timetables: dict[str, tuple] = {}
+compiled_timetables_lock = Lock()
+
+# 借出和归还时刻表空闲的寻路器（Timetable.csa_pool）时使用的锁
+csa_pools_lock = Lock()
+
 
 def get_close_matches(words, possibilities, cutoff=0.2):
     result = [(-1, None)]
@@ -158,56 +194,700 @@ def draw_text_v2(
 #                           self.station_count)])
 
 
+class QueryCancelled(Exception):
+    '''
+    Raised when a query is cancelled through its Budget.
+    '''
+
+
+class Budget:
+    '''
+    Cooperative cancellation and compute budget of one query.
+    The long loops call check() every so often, it raises QueryCancelled
+    once cancel() is called, and TimeoutError once timeout seconds have
+    passed or more than max_steps connections are scanned. The scans count
+    the connections CHECK_INTERVAL at a time.
+    '''
+    def __init__(self, timeout: float = None, max_steps: int = None):
+        self.deadline = None if timeout is None else time() + timeout
+        self.max_steps = max_steps
+        self.steps = 0
+        self.cancelled = Event()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def check(self, steps: int = 0) -> None:
+        self.steps += steps
+        if self.cancelled.is_set():
+            raise QueryCancelled('Query cancelled')
+
+        if self.deadline is not None and time() > self.deadline:
+            raise TimeoutError('Pathfinding timeout')
+
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise TimeoutError('Pathfinding step budget exceeded')
+
+
+def query_budget(budget: Optional[Budget], timeout_min) -> Budget:
+    '''
+    Get the budget of one scan, a new one of timeout_min minutes
+    if the query has none.
+    '''
+    return Budget(60 * timeout_min) if budget is None else budget
+
+
+def profile_arrival(entries: Optional[tuple[list, list, list, list]],
+                    t: int) -> int:
+    '''
+    Get the earliest arrival of a station profile when leaving at t or later.
+    '''
+    if entries is None:
+        return MAX_INT
+
+    k = bisect_right(entries[0], -t) - 1
+    return entries[1][k] if k >= 0 else MAX_INT
+
+
+def add_label(bags: dict[int, list[tuple]], station: int,
+              label: tuple) -> None:
+    '''
+    Add a label (arrival time, rides, ...) to the Pareto bag of a station,
+    sorted by arrival time, unless a label in the bag dominates it.
+    '''
+    bag = bags.get(station)
+    if bag is None:
+        bags[station] = [label]
+        return
+
+    if any(x[0] <= label[0] and x[1] <= label[1] for x in bag):
+        return
+
+    bag[:] = [x for x in bag if x[0] < label[0] or x[1] < label[1]]
+    k = 0
+    while k < len(bag) and bag[k][0] <= label[0]:
+        k += 1
+
+    bag.insert(k, label)
+
+
 # From https://github.com/trainline-eu/csa-challenge/blob/2aa0fa55e466692d404d87aa2dcaf5b83bca5920/csa.py and https://ljn.io/posts/connection-scan-algorithm-with-interchange-time
 class CSA:
-    def __init__(self, max_stations, connections: list[tuple], timeout_min=2):
-        self.in_connection = array('L')
-        self.earliest_arrival = array('L')
+    '''
+    The buffers are allocated once, each query only resets the stations
+    and trips touched by the previous one, so keep one CSA per timetable
+    and use borrow_csa() to share it.
+    '''
+    def __init__(self, max_stations, timetable: 'Timetable', timeout_min=2):
+        self.in_connection = array('Q', [MAX_INT]) * max_stations
+        self.in_boarding = array('Q', [MAX_INT]) * max_stations
+        self.earliest_arrival = array('Q', [MAX_INT]) * max_stations
+        self.legs = array('Q', [MAX_INT]) * max_stations
+        self.trip_boarding = array('Q', [MAX_INT]) * timetable.trip_count
+        self.trip_legs = array('Q', [MAX_INT]) * timetable.trip_count
+        # 上一次寻路修改过的车站和班次
+        self.touched: list[int] = []
+        self.boarded: list[int] = []
         self.max_stations = max_stations
-        self.connections: list[tuple] = connections
+        self.timetable = timetable
+        self.walks: list[tuple] = []
         self.timeout_min = timeout_min
-
-    def main_loop(self, arrival_station):
+        self.budget: Optional[Budget] = None
+        self.relaxed = 0
+
+    def main_loop(self, arrival_station, lo, hi,
+                  lower_bound: Optional[array] = None):
+        '''
+        Scan the connections lo to hi. If lower_bound is given, skip the
+        connections that cannot reach arrival_station before the earliest
+        arrival found so far.
+        '''
         earliest = MAX_INT
-        for i, c in enumerate(self.connections):
-            if c[2] >= self.earliest_arrival[c[0]] and c[3] < self.earliest_arrival[c[1]]:
-                self.earliest_arrival[c[1]] = c[3]
-                self.in_connection[c[1]] = i
-
+        relaxed = 0
+        budget = query_budget(self.budget, self.timeout_min)
+        earliest_arrival = self.earliest_arrival
+        in_connection = self.in_connection
+        in_boarding = self.in_boarding
+        legs = self.legs
+        trip_boarding = self.trip_boarding
+        trip_legs = self.trip_legs
+        touched = self.touched
+        boarded = self.boarded
+        # 起点的换乘不在时刻表中，先处理
+        n = len(self.timetable)
+        for i, c in enumerate(self.walks):
+            if c[3] < earliest_arrival[c[1]]:
+                if earliest_arrival[c[1]] == MAX_INT:
+                    touched.append(c[1])
+
+                earliest_arrival[c[1]] = c[3]
+                in_connection[c[1]] = n + i
+                in_boarding[c[1]] = n + i
+                legs[c[1]] = 1
                 if c[1] == arrival_station:
                     earliest = min(earliest, c[3])
 
-            elif c[2] >= earliest:
-                return
+        dep_station = self.timetable.dep_station
+        arr_station = self.timetable.arr_station
+        dep_time = self.timetable.dep_time
+        arr_time = self.timetable.arr_time
+        trip_column = self.timetable.trip
+        for i in range(lo, hi):
+            if dep_time[i] >= earliest:
+                break
 
-            if i % 20000 == 0:
-                if time() > self.start_time + 60 * self.timeout_min:
-                    raise TimeoutError('Pathfinding timeout')
+            if (i - lo) % CHECK_INTERVAL == 0:
+                budget.check(CHECK_INTERVAL)
+
+            # 能在发车前到达车站，或者已在车上
+            # 同一班车在换乘次数最少的车站上车
+            trip = trip_column[i]
+            station = dep_station[i]
+            reachable = dep_time[i] >= earliest_arrival[station]
+            if trip >= 0:
+                if reachable and legs[station] < trip_legs[trip]:
+                    if trip_boarding[trip] == MAX_INT:
+                        boarded.append(trip)
+
+                    trip_boarding[trip] = i
+                    trip_legs[trip] = legs[station]
+                elif trip_boarding[trip] == MAX_INT:
+                    continue
 
-    def find_path(self, arrival_station):
-        route = []
-        if self.in_connection[arrival_station] != MAX_INT:
-            last_connection_index = self.in_connection[arrival_station]
-            while last_connection_index != MAX_INT:
-                connection = self.connections[last_connection_index]
-                route.append(connection)
-                last_connection_index = self.in_connection[connection[0]]
+                boarding = trip_boarding[trip]
+                count = trip_legs[trip] + 1
+            elif reachable:
+                boarding = i
+                count = legs[station] + 1
+            else:
+                continue
+
+            station = arr_station[i]
+            if lower_bound is not None and \
+                    arr_time[i] + lower_bound[station] > earliest:
+                continue
+
+            relaxed += 1
+            if arr_time[i] < earliest_arrival[station] or \
+                    (arr_time[i] == earliest_arrival[station] and
+                     count < legs[station]):
+                if earliest_arrival[station] == MAX_INT:
+                    touched.append(station)
+
+                earliest_arrival[station] = arr_time[i]
+                in_connection[station] = i
+                in_boarding[station] = boarding
+                legs[station] = count
 
-            route.reverse()
+                if station == arrival_station:
+                    earliest = min(earliest, arr_time[i])
 
+        # 检查过的连接数量
+        self.relaxed = relaxed
+
+    def connection(self, i) -> tuple:
+        if i >= len(self.timetable):
+            return self.walks[i - len(self.timetable)]
+
+        return self.timetable.connection(i)
+
+    def find_path(self, arrival_station):
+        '''
+        Get the legs to arrival_station, each leg is one ride from
+        boarding to alighting a trip, or one walk.
+        '''
+        route = []
+        station = arrival_station
+        while self.in_connection[station] != MAX_INT:
+            boarding = self.connection(self.in_boarding[station])
+            alighting = self.connection(self.in_connection[station])
+            route.append((boarding[0], alighting[1], boarding[2],
+                          alighting[3]) + alighting[4:])
+            station = boarding[0]
+
+        route.reverse()
         return route
 
-    def compute(self, departure_station, arrival_station, departure_time) -> list[tuple]:
-        self.in_connection = array('Q', [MAX_INT for _ in range(self.max_stations)])
-        self.earliest_arrival = array('Q', [MAX_INT for _ in range(self.max_stations)])
+    def reset(self, departure_station, departure_time,
+              walks: list[tuple] = []) -> None:
+        '''
+        Clear the labels of the previous query, only where it set them.
+        '''
+        for station in self.touched:
+            self.in_connection[station] = MAX_INT
+            self.in_boarding[station] = MAX_INT
+            self.earliest_arrival[station] = MAX_INT
+            self.legs[station] = MAX_INT
+
+        for trip in self.boarded:
+            self.trip_boarding[trip] = MAX_INT
+            self.trip_legs[trip] = MAX_INT
+
+        self.touched = [departure_station]
+        self.boarded = []
         self.earliest_arrival[departure_station] = departure_time
+        self.legs[departure_station] = 0
+        self.walks = walks
 
+    def compute(self, departure_station, arrival_station, departure_time,
+                end_time, walks: list[tuple] = [],
+                lower_bound: Optional[array] = None) -> list[tuple]:
+        self.reset(departure_station, departure_time, walks)
         if departure_station <= self.max_stations and arrival_station <= self.max_stations:
-            self.start_time = time()
-            self.main_loop(arrival_station)
+            lo, hi = self.timetable.bounds(departure_time, end_time)
+            self.main_loop(arrival_station, lo, hi, lower_bound)
 
         return self.find_path(arrival_station)
 
+    def compute_all(self, departure_station, departure_time, end_time,
+                    walks: list[tuple] = []) -> array:
+        '''
+        Scan the whole window without stopping at a target, returns the
+        earliest arrival at every station, MAX_INT if it is unreachable.
+        '''
+        self.reset(departure_station, departure_time, walks)
+        lo, hi = self.timetable.bounds(departure_time, end_time)
+        self.main_loop(-1, lo, hi)
+        return self.earliest_arrival
+
+    def compute_latest(self, departure_station, arrival_station,
+                       arrival_time, start_time,
+                       walks: list[tuple] = []) -> list[tuple]:
+        '''
+        Reverse scan by arrival time, from arrival_time back to start_time,
+        returns the legs of the latest departure that still arrives by
+        arrival_time. Only the durations of the walks from the start
+        station are used, they can leave at any time.
+        '''
+        n = self.max_stations
+        latest_departure = array('q', [-1]) * n
+        out_boarding = array('Q', [MAX_INT]) * n
+        out_connection = array('Q', [MAX_INT]) * n
+        legs = array('Q', [MAX_INT]) * n
+        trip_alighting = array('Q', [MAX_INT]) * self.timetable.trip_count
+        trip_legs = array('Q', [MAX_INT]) * self.timetable.trip_count
+        latest_departure[arrival_station] = arrival_time
+        legs[arrival_station] = 0
+
+        dep_station = self.timetable.dep_station
+        arr_station = self.timetable.arr_station
+        dep_time = self.timetable.dep_time
+        arr_time = self.timetable.arr_time
+        trip_column = self.timetable.trip
+        order, arrivals = self.timetable.by_arrival()
+        lo = bisect_left(arrivals, max(start_time, arrival_time - 86400))
+        hi = bisect_right(arrivals, arrival_time)
+        budget = query_budget(self.budget, self.timeout_min)
+        for k in range(hi - 1, lo - 1, -1):
+            i = order[k]
+            if arr_time[i] <= latest_departure[departure_station]:
+                break
+
+            if (hi - 1 - k) % CHECK_INTERVAL == 0:
+                budget.check(CHECK_INTERVAL)
+
+            # 能在到达后赶上之后的行程，或者留在车上
+            # 同一班车在换乘次数最少的车站下车
+            trip = trip_column[i]
+            station = arr_station[i]
+            reachable = arr_time[i] <= latest_departure[station]
+            if trip >= 0:
+                if reachable and legs[station] < trip_legs[trip]:
+                    trip_alighting[trip] = i
+                    trip_legs[trip] = legs[station]
+                elif trip_alighting[trip] == MAX_INT:
+                    continue
+
+                alighting = trip_alighting[trip]
+                count = trip_legs[trip] + 1
+            elif reachable:
+                alighting = i
+                count = legs[station] + 1
+            else:
+                continue
+
+            station = dep_station[i]
+            if dep_time[i] > latest_departure[station] or \
+                    (dep_time[i] == latest_departure[station] and
+                     count < legs[station]):
+                latest_departure[station] = dep_time[i]
+                out_boarding[station] = i
+                out_connection[station] = alighting
+                legs[station] = count
+
+        # 起点的换乘可以在任意时间出发
+        route = []
+        first = departure_station
+        for c in walks:
+            if latest_departure[c[1]] < 0:
+                continue
+
+            dep = latest_departure[c[1]] - (c[3] - c[2])
+            if dep > latest_departure[departure_station] and \
+                    dep >= start_time:
+                latest_departure[departure_station] = dep
+                route = [(c[0], c[1], dep, latest_departure[c[1]], c[4])]
+                first = c[1]
+
+        station = first
+        while out_connection[station] != MAX_INT:
+            boarding = self.timetable.connection(out_boarding[station])
+            alighting = self.timetable.connection(out_connection[station])
+            route.append((boarding[0], alighting[1], boarding[2],
+                          alighting[3]) + alighting[4:])
+            station = alighting[1]
+
+        if station != arrival_station:
+            return []
+
+        return route
+
+    def profile(self, departure_station, arrival_station, first_departure,
+                last_departure, end_time,
+                walks: list[tuple] = []) -> list[list[tuple]]:
+        '''
+        Profile connection scan: find, in one backward scan, every
+        journey leaving between first_departure and last_departure that
+        no journey leaving later reaches arrival_station as early.
+        Returns the legs of each journey, by departure time.
+        '''
+        timetable = self.timetable
+        dep_station = timetable.dep_station
+        arr_station = timetable.arr_station
+        dep_time = timetable.dep_time
+        arr_time = timetable.arr_time
+        trip_column = timetable.trip
+        trip_arrival = array('Q', [MAX_INT]) * timetable.trip_count
+        trip_alighting = array('Q', [MAX_INT]) * timetable.trip_count
+        # 每个车站的 (-发车时间, 到达时间, 上车连接, 下车连接)，发车时间递减
+        profiles: dict[int, tuple[list, list, list, list]] = {}
+        self.walks = walks
+        budget = query_budget(self.budget, self.timeout_min)
+        lo, hi = timetable.bounds(first_departure, end_time)
+        for i in range(hi - 1, lo - 1, -1):
+            if (hi - 1 - i) % CHECK_INTERVAL == 0:
+                budget.check(CHECK_INTERVAL)
+
+            station = arr_station[i]
+            best = arr_time[i] if station == arrival_station else \
+                profile_arrival(profiles.get(station), arr_time[i])
+            alighting = i
+            # 留在车上不比换乘晚时不换乘
+            trip = trip_column[i]
+            if trip >= 0:
+                if trip_arrival[trip] <= best:
+                    best = trip_arrival[trip]
+                    alighting = trip_alighting[trip]
+                else:
+                    trip_arrival[trip] = best
+                    trip_alighting[trip] = i
+
+            station = dep_station[i]
+            if best == MAX_INT or station == arrival_station:
+                continue
+
+            if station not in profiles:
+                profiles[station] = ([], [], [], [])
+
+            entries = profiles[station]
+            if len(entries[1]) == 0 or best < entries[1][-1]:
+                entries[0].append(-dep_time[i])
+                entries[1].append(best)
+                entries[2].append(i)
+                entries[3].append(alighting)
+
+        # 出发车站的候选：直接乘车，或者先换乘到其他车站
+        candidates = []
+        entries = profiles.get(departure_station, ([], [], [], []))
+        for k in range(len(entries[0])):
+            candidates.append((-entries[0][k], entries[1][k], None,
+                               entries[2][k], entries[3][k]))
+
+        for walk in walks:
+            duration = walk[3] - walk[2]
+            entries = profiles.get(walk[1], ([], [], [], []))
+            for k in range(len(entries[0])):
+                candidates.append((-entries[0][k] - duration, entries[1][k],
+                                   walk, entries[2][k], entries[3][k]))
+
+        journeys = []
+        earliest = MAX_INT
+        candidates.sort(key=lambda x: (-x[0], x[1]))
+        for dep, arr, walk, boarding, alighting in candidates:
+            if not first_departure <= dep <= last_departure or \
+                    arr >= earliest:
+                continue
+
+            earliest = arr
+            legs = []
+            if walk is not None:
+                legs.append((walk[0], walk[1], dep, dep + walk[3] - walk[2],
+                             walk[4]))
+
+            while True:
+                c1 = self.connection(boarding)
+                c2 = self.connection(alighting)
+                legs.append((c1[0], c2[1], c1[2], c2[3]) + c2[4:])
+                if c2[1] == arrival_station:
+                    break
+
+                entries = profiles[c2[1]]
+                k = bisect_right(entries[0], -c2[3]) - 1
+                boarding = entries[2][k]
+                alighting = entries[3][k]
+
+            journeys.append(legs)
+
+        journeys.reverse()
+        return journeys
+
+    def compute_mc(self, departure_station, arrival_station, departure_time,
+                   end_time, walks: list[tuple] = [],
+                   max_rides: int = MAX_BAG_SIZE,
+                   prefer_less_transfer: bool = False,
+                   lower_bound: Optional[array] = None) -> list[tuple]:
+        '''
+        Multi-criteria connection scan on arrival time and number of
+        rides, keeping a Pareto bag of labels per station. Journeys with
+        more than max_rides rides are not considered, which also bounds
+        each bag to max_rides + 1 labels (0 to max_rides rides).
+        max_rides larger than MAX_BAG_SIZE raises ValueError.
+        Returns the legs of the earliest arrival, or of the journey with
+        the fewest rides if prefer_less_transfer is True.
+        If lower_bound is given, skip the labels that cannot reach
+        arrival_station without being dominated there.
+        '''
+        if max_rides > MAX_BAG_SIZE:
+            raise ValueError(f'At most {MAX_BAG_SIZE} rides are supported, '
+                             f'got {max_rides}')
+
+        # 标签：(到达时间, 乘车次数, 上车连接, 下车连接, 上一个标签)
+        bags: dict[int, list[tuple]] = {
+            departure_station: [(departure_time, 0, None, None, None)]}
+        # 每班车：(乘车次数, 上车连接, 上车车站的标签)
+        trips: dict[int, tuple] = {}
+        self.walks = walks
+        n = len(self.timetable)
+        for i, c in enumerate(walks):
+            add_label(bags, c[1], (c[3], 0, n + i, n + i,
+                                   bags[departure_station][0]))
+
+        stop = MAX_INT
+        relaxed = 0
+        if arrival_station in bags and not prefer_less_transfer:
+            stop = bags[arrival_station][0][0]
+
+        dep_station = self.timetable.dep_station
+        arr_station = self.timetable.arr_station
+        dep_time = self.timetable.dep_time
+        arr_time = self.timetable.arr_time
+        trip_column = self.timetable.trip
+        budget = query_budget(self.budget, self.timeout_min)
+        lo, hi = self.timetable.bounds(departure_time, end_time)
+        for i in range(lo, hi):
+            if dep_time[i] >= stop:
+                break
+
+            if (i - lo) % CHECK_INTERVAL == 0:
+                budget.check(CHECK_INTERVAL)
+
+            label = None
+            bag = bags.get(dep_station[i])
+            if bag is not None:
+                # 到达时间不晚于发车时间的标签中乘车次数最少的
+                for x in bag:
+                    if x[0] > dep_time[i]:
+                        break
+
+                    label = x
+
+            trip = trip_column[i]
+            if trip >= 0:
+                if label is not None and label[1] < max_rides and \
+                        (trip not in trips or label[1] + 1 < trips[trip][0]):
+                    trips[trip] = (label[1] + 1, i, label)
+
+                if trip not in trips:
+                    continue
+
+                rides, boarding, parent = trips[trip]
+            elif label is not None:
+                rides, boarding, parent = label[1], i, label
+            else:
+                continue
+
+            new = (arr_time[i], rides, boarding, i, parent)
+            bound = arr_time[i]
+            if lower_bound is not None:
+                bound += lower_bound[arr_station[i]]
+
+            target = bags.get(arrival_station, ())
+            if any(x[0] <= bound and x[1] <= rides for x in target):
+                continue
+
+            relaxed += 1
+            add_label(bags, arr_station[i], new)
+            if arr_station[i] == arrival_station and \
+                    not prefer_less_transfer:
+                stop = min(stop, new[0])
+
+        self.relaxed = relaxed
+        if arrival_station not in bags:
+            return []
+
+        if prefer_less_transfer:
+            label = min(bags[arrival_station], key=lambda x: (x[1], x[0]))
+        else:
+            label = min(bags[arrival_station], key=lambda x: (x[0], x[1]))
+
+        route = []
+        while label[4] is not None:
+            boarding = self.connection(label[2])
+            alighting = self.connection(label[3])
+            route.append((boarding[0], alighting[1], boarding[2],
+                          alighting[3]) + alighting[4:])
+            label = label[4]
+
+        route.reverse()
+        return route
+
+
+class Raptor:
+    '''
+    Round-based routing (RAPTOR) on the route patterns of a compiled
+    timetable. Round k finds the earliest arrivals with k rides, so the
+    number of transfers is bounded by the number of rounds.
+    The legs are the same as the ones of CSA.compute().
+    '''
+    def __init__(self, max_stations, timetable: 'Timetable', timeout_min=2):
+        self.max_stations = max_stations
+        self.timetable = timetable
+        self.patterns = timetable.route_patterns()
+        self.timeout_min = timeout_min
+        self.budget: Optional[Budget] = None
+
+    def compute(self, departure_station, arrival_station, departure_time,
+                end_time, walks: list[tuple] = [], max_rides: int = None,
+                prefer_less_transfer: bool = False) -> list[tuple]:
+        '''
+        Returns the legs of the earliest arrival with at most max_rides
+        rides, or of the journey with the fewest rides if
+        prefer_less_transfer is True.
+        '''
+        patterns = self.patterns
+        timetable = self.timetable
+        end_time = min(end_time, departure_time + 86400)
+        # 标签：(到达时间, 轮次, 路段, 上一个标签, 本站之前的标签)
+        origin = (departure_time, 0, None, None, None)
+        best: dict[int, tuple] = {departure_station: origin}
+        marked = {departure_station}
+        for c in walks:
+            old = best.get(c[1])
+            if old is None or c[3] < old[0]:
+                best[c[1]] = (c[3], 0, tuple(c), origin, old)
+                marked.add(c[1])
+
+        targets = []
+        self.walk(best, marked, targets, 0, end_time)
+        if arrival_station in best:
+            targets.append(best[arrival_station])
+
+        budget = query_budget(self.budget, self.timeout_min)
+        rnd = 0
+        while len(marked) > 0 and (max_rides is None or rnd < max_rides):
+            budget.check(len(marked))
+
+            rnd += 1
+            # 经过已标记车站的路线，从最靠前的车站开始扫描
+            queue: dict[int, int] = {}
+            for station in marked:
+                for p, k in patterns.stops.get(station, ()):
+                    if k < queue.get(p, MAX_INT):
+                        queue[p] = k
+
+            marked = set()
+            for p, k0 in queue.items():
+                pairs = patterns.pairs[p]
+                dep = patterns.dep[p]
+                arr = patterns.arr[p]
+                j = None
+                for k in range(k0, len(pairs)):
+                    # 上一轮到达的车站可以赶上更早的班次
+                    label = best.get(pairs[k][0])
+                    while label is not None and label[1] >= rnd:
+                        label = label[4]
+
+                    if label is not None and \
+                            (j is None or label[0] <= dep[k][j]):
+                        j2 = bisect_left(dep[k], label[0])
+                        if j2 < len(dep[k]) and (j is None or j2 < j):
+                            j, boarding, parent = j2, k, label
+
+                    if j is None or dep[k][j] >= end_time:
+                        continue
+
+                    station = pairs[k][1]
+                    old = best.get(station)
+                    if (old is None or arr[k][j] < old[0]) and \
+                            (len(targets) == 0 or
+                             arr[k][j] < targets[-1][0]):
+                        b = timetable.connection(
+                            patterns.index[p][boarding][j])
+                        c = timetable.connection(patterns.index[p][k][j])
+                        best[station] = (arr[k][j], rnd,
+                                         (b[0], c[1], b[2], c[3]) + c[4:],
+                                         parent, old)
+                        marked.add(station)
+
+            self.walk(best, marked, targets, rnd, end_time)
+            if arrival_station in marked:
+                targets.append(best[arrival_station])
+
+        if len(targets) == 0:
+            return []
+
+        label = targets[0] if prefer_less_transfer else targets[-1]
+        route = []
+        while label[2] is not None:
+            route.append(label[2])
+            label = label[3]
+
+        route.reverse()
+        return route
+
+    def walk(self, best: dict[int, tuple], marked: set[int],
+             targets: list[tuple], rnd: int, end_time: int) -> None:
+        '''
+        Walk from the marked stations and mark the stations reached.
+        As in the timetable, the walks from a station leave when a train
+        arrives there, so a walk can follow another one.
+        '''
+        patterns = self.patterns
+        timetable = self.timetable
+        queue = list(marked)
+        while len(queue) > 0:
+            station = queue.pop()
+            times = patterns.walk_times.get(station)
+            if times is None:
+                continue
+
+            label = best[station]
+            k = bisect_left(times, label[0])
+            if k == len(times) or times[k] >= end_time:
+                continue
+
+            dep = times[k]
+            for con, t2, i in patterns.footpaths[station]:
+                old = best.get(con)
+                if (old is None or dep + t2 < old[0]) and \
+                        (len(targets) == 0 or dep + t2 < targets[-1][0]):
+                    best[con] = (dep + t2, rnd,
+                                 (station, con, dep, dep + t2,
+                                  timetable.details[timetable.detail[i]]),
+                                 label, old)
+                    marked.add(con)
+                    queue.append(con)
+
 
 class RouteType(Enum):
     '''
@@ -218,6 +898,36 @@ class RouteType(Enum):
     REAL_TIME = 2
 
 
+class Engine(Enum):
+    '''
+    An Enum class to define the routing algorithm of a query.
+    '''
+    CSA = 'csa'
+    RAPTOR = 'raptor'
+
+
+class LegKind(IntEnum):
+    '''
+    An Enum class to define the kinds of the connections.
+    '''
+    RIDE = 0
+    TRANSFER = 1  # 出站换乘
+    WILD = 2  # 非出站换乘（越野）
+
+
+def leg_kind(detail: list[str]) -> LegKind:
+    '''
+    Get the kind of a connection from its detail.
+    '''
+    if detail[1] != '':
+        return LegKind.RIDE
+
+    if detail[0].startswith('出站换乘'):
+        return LegKind.TRANSFER
+
+    return LegKind.WILD
+
+
 class ImagePattern(Enum):
     '''
     An Enum class to define the patterns of the image.
@@ -275,48 +985,26 @@ def get_distance(a_dict: dict, b_dict: dict, square: bool = False) -> float:
     return sqrt(dist_square)
 
 
-def fetch_data(link: str, LOCAL_FILE_PATH, MAX_WILD_BLOCKS) -> str:
+def build_station_grid(station_coords: dict[str, dict],
+                       cell_size: float) -> dict[tuple[int, int], list[str]]:
     '''
-    Fetch all the route data and station data.
+    Bucket the stations into a uniform grid over x/z.
     '''
-    link = link.rstrip('/') + '/mtr/api/map/stations-and-routes?dimension=0'
-    data = requests.get(link).json()['data']
-    data_new = {'stations': {}, 'routes': {},
-                'station_coords': {}, 'station_routes': {},
-                'transfer_time': {}, 'transfer_dist': {}}
-    for d in data['routes']:
-        data_new['routes'][d['id']] = d
-        lengths = []
-        last_x = None
-        for x in d['stations']:
-            if x['id'] in data_new['station_routes']:
-                data_new['station_routes'][x['id']] += [d['id']]
-            else:
-                data_new['station_routes'][x['id']] = [d['id']]
-
-            if last_x is not None:
-                x1 = last_x['x']
-                y1 = last_x['y']
-                z1 = last_x['z']
-                x2 = x['x']
-                y2 = x['y']
-                z2 = x['z']
-                lengths.append(((x1 - x2) ** 2 + (y1 - y2) ** 2 +
-                                (z1 - z2) ** 2) ** 0.5)
-
-            last_x = x
-
-        data_new['routes'][d['id']]['lengths'] = lengths
+    grid: dict[tuple[int, int], list[str]] = {}
+    for station_id, coords in station_coords.items():
+        key = (floor(coords['x'] / cell_size), floor(coords['z'] / cell_size))
+        if key in grid:
+            grid[key].append(station_id)
+        else:
+            grid[key] = [station_id]
 
-    i = 0
-    for d in data['stations']:
-        if d['id'] not in data_new['station_routes']:
-            continue
+    return grid
 
-        d['station'] = hex(i)[2:]
-        data_new['stations'][d['id']] = d
-        i += 1
 
+def station_centroids(data: dict) -> dict[str, dict]:
+    '''
+    Average the platform positions of every station.
+    '''
     x_dict = {x['id']: [] for x in data['stations']}
     y_dict = {x['id']: [] for x in data['stations']}
     z_dict = {x['id']: [] for x in data['stations']}
@@ -326,6 +1014,7 @@ def fetch_data(link: str, LOCAL_FILE_PATH, MAX_WILD_BLOCKS) -> str:
             y_dict[station['id']] += [station['y']]
             z_dict[station['id']] += [station['z']]
 
+    station_coords = {}
     for station in data['stations']:
         x_list = x_dict[station['id']]
         y_list = y_dict[station['id']]
@@ -333,16 +1022,70 @@ def fetch_data(link: str, LOCAL_FILE_PATH, MAX_WILD_BLOCKS) -> str:
         if len(x_list) == 0:
             continue
 
-        data_new['station_coords'][station['id']] = \
+        station_coords[station['id']] = \
             {'x': sum(x_list) / len(x_list),
              'y': sum(y_list) / len(y_list),
              'z': sum(z_list) / len(z_list)}
 
-    for x, dict1 in data_new['station_coords'].items():
-        for y, dict2 in data_new['station_coords'].items():
+    return station_coords
+
+
+def station_centroids_np(data: dict) -> dict[str, dict]:
+    '''
+    Average the platform positions of every station with grouped NumPy sums.
+    '''
+    index = {x['id']: i for i, x in enumerate(data['stations'])}
+    platforms = [x for route in data['routes'] for x in route['stations']]
+    group = np.array([index[x['id']] for x in platforms], dtype=np.int64)
+    xyz = np.array([(x['x'], x['y'], x['z']) for x in platforms],
+                   dtype=np.float64).reshape(-1, 3)
+    n = len(data['stations'])
+    count = np.bincount(group, minlength=n)
+    found = np.flatnonzero(count)
+    mean = [(np.bincount(group, weights=xyz[:, k], minlength=n)[found] /
+             count[found]).tolist() for k in range(3)]
+
+    station_coords = {}
+    for i, x, y, z in zip(found.tolist(), *mean):
+        station_coords[data['stations'][i]['id']] = {'x': x, 'y': y, 'z': z}
+
+    return station_coords
+
+
+def transfer_matrix(data_new: dict, MAX_WILD_BLOCKS,
+                    rows: set[str] = None) -> None:
+    '''
+    Fill transfer_time and transfer_dist of the processed data,
+    only for the stations in rows if it is given.
+    '''
+    station_coords = data_new['station_coords']
+    order = {x: i for i, x in enumerate(station_coords)}
+    cell_size = max(MAX_WILD_BLOCKS, 1)
+    grid = build_station_grid(station_coords, cell_size)
+    linked: dict[str, set[str]] = {x: set() for x in station_coords}
+    for x in station_coords:
+        for y in data_new['stations'][x]['connections']:
+            if y in linked:
+                linked[x].add(y)
+                linked[y].add(x)
+
+    for x, dict1 in station_coords.items():
+        if rows is not None and x not in rows:
+            continue
+
+        # 只比较相邻网格内的车站和出站换乘车站
+        cx = floor(dict1['x'] / cell_size)
+        cz = floor(dict1['z'] / cell_size)
+        candidates = set(linked[x])
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cz - 1, cz, cz + 1):
+                candidates.update(grid.get((i, j), ()))
+
+        for y in sorted(candidates, key=order.__getitem__):
             if x == y:
                 continue
 
+            dict2 = station_coords[y]
             distance = get_distance(dict1, dict2)
 
             if x == y:
@@ -369,18 +1112,685 @@ def fetch_data(link: str, LOCAL_FILE_PATH, MAX_WILD_BLOCKS) -> str:
                 data_new['transfer_dist'][x] = {}
 
             data_new['transfer_dist'][x][y] = distance
-    
-    with open(LOCAL_FILE_PATH, 'w', encoding='utf-8') as f:
-        json.dump(data_new, f)
+
+
+def transfer_matrix_np(data_new: dict, MAX_WILD_BLOCKS,
+                       rows: set[str] = None) -> None:
+    '''
+    Fill transfer_time and transfer_dist of the processed data,
+    computing the candidate distances in blocked NumPy operations.
+    The output is identical to transfer_matrix().
+    '''
+    station_coords = data_new['station_coords']
+    ids = list(station_coords)
+    n = len(ids)
+    if n == 0:
+        return
+
+    order = {x: i for i, x in enumerate(ids)}
+    xz = np.array([(c['x'], c['z']) for c in station_coords.values()],
+                  dtype=np.float64)
+    if rows is None:
+        sel = np.arange(n)
+    else:
+        sel = np.array(sorted(order[x] for x in rows if x in order),
+                       dtype=np.int64)
+
+    # 网格按 (x, z) 排序后，相邻三格在同一行中是连续的区间
+    cells = np.floor(xz / max(MAX_WILD_BLOCKS, 1)).astype(np.int64)
+    cells -= cells.min(axis=0)
+    width = int(cells[:, 1].max()) + 3
+    key = (cells[:, 0] + 1) * width + cells[:, 1] + 1
+    by_key = np.argsort(key, kind='stable')
+    sorted_key = key[by_key]
+    src_list = []
+    dst_list = []
+    for dx in (-1, 0, 1):
+        row = key[sel] + dx * width
+        lo = np.searchsorted(sorted_key, row - 1, 'left')
+        hi = np.searchsorted(sorted_key, row + 1, 'right')
+        counts = hi - lo
+        start = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        src_list.append(np.repeat(sel, counts))
+        dst_list.append(by_key[np.arange(int(counts.sum())) + start])
+
+    src = np.concatenate(src_list)
+    dst = np.concatenate(dst_list)
+
+    linked = set()
+    for x in ids:
+        for y in data_new['stations'][x]['connections']:
+            if y in order and y != x:
+                linked.add(order[x] * n + order[y])
+                linked.add(order[y] * n + order[x])
+
+    linked_code = np.array(sorted(linked), dtype=np.int64)
+    wild = (src != dst) & ~np.isin(src * n + dst, linked_code)
+    src = src[wild]
+    dst = dst[wild]
+    dx = xz[src, 0] - xz[dst, 0]
+    dz = xz[src, 1] - xz[dst, 1]
+    dist = np.sqrt(dx ** 2 + dz ** 2)
+    wild = (dist <= MAX_WILD_BLOCKS) & \
+        (np.abs(dx) <= MAX_WILD_BLOCKS) & (np.abs(dz) <= MAX_WILD_BLOCKS)
+
+    l_src = linked_code // n
+    l_dst = linked_code % n
+    if rows is not None:
+        in_rows = np.isin(l_src, sel)
+        l_src = l_src[in_rows]
+        l_dst = l_dst[in_rows]
+    l_dist = np.sqrt((xz[l_src, 0] - xz[l_dst, 0]) ** 2 +
+                     (xz[l_src, 1] - xz[l_dst, 1]) ** 2)
+
+    src = np.concatenate((src[wild], l_src))
+    dst = np.concatenate((dst[wild], l_dst))
+    dist = np.concatenate((dist[wild], l_dist))
+    speed = np.concatenate((np.full(int(wild.sum()), WILD_WALKING_SPEED),
+                            np.full(len(l_src), TRANSFER_SPEED)))
+    pair_order = np.lexsort((dst, src))
+    src = src[pair_order].tolist()
+    dst = dst[pair_order].tolist()
+    dist = dist[pair_order]
+    times = (dist / speed[pair_order]).tolist()
+    dist = dist.tolist()
+
+    transfer_time = data_new['transfer_time']
+    transfer_dist = data_new['transfer_dist']
+    last = -1
+    for i, j, t, d in zip(src, dst, times, dist):
+        if i != last:
+            last = i
+            time_dict = transfer_time[ids[i]] = {}
+            dist_dict = transfer_dist[ids[i]] = {}
+
+        time_dict[ids[j]] = t
+        dist_dict[ids[j]] = d
+
+
+def record_hash(record) -> str:
+    '''
+    Get a stable hash of a JSON-like record.
+    '''
+    return hashlib.md5(json.dumps(record, sort_keys=True).encode('utf-8')
+                       ).hexdigest()
+
+
+def same_record(record: dict, old_record: Optional[dict], derived: str) -> bool:
+    '''
+    Check if a downloaded record equals the processed old record,
+    ignoring the derived key added while processing.
+    '''
+    if old_record is None or len(old_record) != len(record) + 1:
+        return False
+
+    return all(k == derived or record.get(k, old_record) == v
+               for k, v in old_record.items())
+
+
+def process_data(data: dict, MAX_WILD_BLOCKS,
+                 use_numpy: bool = True, old: dict = None) -> dict:
+    '''
+    Process the downloaded route data and station data.
+    NumPy is used for the coordinates when it is installed.
+    If the previously processed data is given as old, station indices are
+    kept, and only the routes and transfer pairs of changed records are
+    recomputed.
+    '''
+    if old is not None and (old.get('max_wild_blocks') != MAX_WILD_BLOCKS
+                            or 'hashes' not in old):
+        old = None
+
+    data_new = {'stations': {}, 'routes': {},
+                'station_coords': {}, 'station_routes': {},
+                'transfer_time': {}, 'transfer_dist': {},
+                'hashes': {'routes': {}, 'station_records': {},
+                           'stations': {}},
+                'index_epoch': '', 'max_wild_blocks': MAX_WILD_BLOCKS}
+    hashes = data_new['hashes']
+    for d in data['routes']:
+        data_new['routes'][d['id']] = d
+        for x in d['stations']:
+            if x['id'] in data_new['station_routes']:
+                data_new['station_routes'][x['id']] += [d['id']]
+            else:
+                data_new['station_routes'][x['id']] = [d['id']]
+
+        if old is not None and \
+                same_record(d, old['routes'].get(d['id']), 'lengths'):
+            hashes['routes'][d['id']] = old['hashes']['routes'][d['id']]
+            d['lengths'] = old['routes'][d['id']]['lengths']
+            continue
+
+        hashes['routes'][d['id']] = record_hash(d)
+
+        lengths = []
+        last_x = None
+        for x in d['stations']:
+            if last_x is not None:
+                x1 = last_x['x']
+                y1 = last_x['y']
+                z1 = last_x['z']
+                x2 = x['x']
+                y2 = x['y']
+                z2 = x['z']
+                lengths.append(((x1 - x2) ** 2 + (y1 - y2) ** 2 +
+                                (z1 - z2) ** 2) ** 0.5)
+
+            last_x = x
+
+        data_new['routes'][d['id']]['lengths'] = lengths
+
+    if old is not None:
+        # 原有车站保持原来的编号，新车站排在后面
+        position = {x: i for i, x in enumerate(old['stations'])}
+        data['stations'].sort(key=lambda d: position.get(d['id'],
+                                                         len(position)))
+
+    i = 0
+    for d in data['stations']:
+        if d['id'] not in data_new['station_routes']:
+            continue
+
+        if old is not None and \
+                same_record(d, old['stations'].get(d['id']), 'station'):
+            hashes['station_records'][d['id']] = \
+                old['hashes']['station_records'][d['id']]
+        else:
+            hashes['station_records'][d['id']] = record_hash(d)
+
+        d['station'] = i
+        data_new['stations'][d['id']] = d
+        i += 1
+
+    ids = list(data_new['stations'])
+    data_new['station_list'] = list(data_new['stations'].values())
+    if old is not None and ids[:len(old['stations'])] == list(old['stations']):
+        data_new['index_epoch'] = old['index_epoch']
+    else:
+        old = None
+        data_new['index_epoch'] = record_hash(ids)
+
+    if use_numpy is True and np is not None:
+        data_new['station_coords'] = station_centroids_np(data)
+        matrix = transfer_matrix_np
+    else:
+        data_new['station_coords'] = station_centroids(data)
+        matrix = transfer_matrix
+
+    if old is None:
+        matrix(data_new, MAX_WILD_BLOCKS)
+        rows = set(ids)
+    else:
+        rows = changed_transfer_rows(data_new, old, MAX_WILD_BLOCKS)
+        matrix(data_new, MAX_WILD_BLOCKS, rows)
+        fresh_time = data_new['transfer_time']
+        fresh_dist = data_new['transfer_dist']
+        data_new['transfer_time'] = {}
+        data_new['transfer_dist'] = {}
+        for x in ids:
+            if x in rows:
+                if x in fresh_time:
+                    data_new['transfer_time'][x] = fresh_time[x]
+                    data_new['transfer_dist'][x] = fresh_dist[x]
+            elif x in old['transfer_time']:
+                # 复制快照中的行，旧文件会被覆盖
+                time_row = old['transfer_time'][x]
+                dist_row = old['transfer_dist'][x]
+                if not isinstance(time_row, dict):
+                    time_row = dict(time_row.items())
+                    dist_row = dict(dist_row.items())
+
+                data_new['transfer_time'][x] = time_row
+                data_new['transfer_dist'][x] = dist_row
+
+    # 车站的哈希值只在车站记录、坐标或换乘发生变化时更新
+    for x in ids:
+        station_hash = [hashes['station_records'][x],
+                        data_new['stations'][x]['station'],
+                        data_new['station_coords'][x]]
+        if old is None:
+            hashes['stations'][x] = record_hash(station_hash)
+            continue
+
+        if x not in rows:
+            hashes['stations'][x] = old['hashes']['stations'][x]
+            continue
+
+        row = data_new['transfer_time'].get(x, {})
+        if x in old['transfer_time']:
+            old_row = dict(old['transfer_time'][x].items())
+        else:
+            old_row = {}
+
+        if x in old['stations'] and row == old_row and \
+                old['hashes']['station_records'][x] == station_hash[0] and \
+                old['station_coords'][x] == station_hash[2]:
+            hashes['stations'][x] = old['hashes']['stations'][x]
+        else:
+            hashes['stations'][x] = record_hash(station_hash +
+                                                [list(row.items())])
+
+    return data_new
+
+
+def changed_transfer_rows(data_new: dict, old: dict,
+                          MAX_WILD_BLOCKS) -> set[str]:
+    '''
+    Find the stations whose transfer pairs may differ from the old data:
+    stations that are new, moved or have changed connections,
+    plus the stations near them or connected to them.
+    '''
+    station_coords = data_new['station_coords']
+    old_records = old['hashes']['station_records']
+    dirty = set()
+    for x, h in data_new['hashes']['station_records'].items():
+        if old_records.get(x) != h or x not in old['station_coords'] or \
+                old['station_coords'][x] != station_coords[x]:
+            dirty.add(x)
+
+    rows = set(dirty)
+    cell_size = max(MAX_WILD_BLOCKS, 1)
+    grid = build_station_grid(station_coords, cell_size)
+    for x in dirty:
+        positions = [station_coords[x]]
+        if x in old['station_coords']:
+            positions.append(old['station_coords'][x])
+            rows.update(y for y in old['stations'][x]['connections']
+                        if y in station_coords)
+
+        rows.update(y for y in data_new['stations'][x]['connections']
+                    if y in station_coords)
+        for c in positions:
+            cx = floor(c['x'] / cell_size)
+            cz = floor(c['z'] / cell_size)
+            for i in (cx - 1, cx, cx + 1):
+                for j in (cz - 1, cz, cz + 1):
+                    rows.update(grid.get((i, j), ()))
+
+    for x, station in data_new['stations'].items():
+        if not dirty.isdisjoint(station['connections']):
+            rows.add(x)
+
+    return rows
+
+
+class TransferRow(Mapping):
+    '''
+    Read-only view of one row of a CSR transfer table.
+    '''
+    def __init__(self, table: 'TransferTable', lo: int, hi: int):
+        self.table = table
+        self.lo = lo
+        self.hi = hi
+
+    def __getitem__(self, station_id: str) -> float:
+        j = self.table.index.get(station_id)
+        if j is None:
+            raise KeyError(station_id)
+
+        k = bisect_left(self.table.indices, j, self.lo, self.hi)
+        if k == self.hi or self.table.indices[k] != j:
+            raise KeyError(station_id)
+
+        return self.table.values[k]
+
+    def __iter__(self):
+        ids = self.table.ids
+        for k in range(self.lo, self.hi):
+            yield ids[self.table.indices[k]]
+
+    def __len__(self) -> int:
+        return self.hi - self.lo
+
+    def items(self) -> list[tuple[str, float]]:
+        ids = self.table.ids
+        indices = self.table.indices
+        values = self.table.values
+        return [(ids[indices[k]], values[k]) for k in range(self.lo, self.hi)]
+
+
+class TransferTable(Mapping):
+    '''
+    Read-only dict-of-dicts view over CSR arrays
+    (indptr, indices, values), keyed by station ID.
+    '''
+    def __init__(self, ids: list[str], index: dict[str, int],
+                 indptr, indices, values):
+        self.ids = ids
+        self.index = index
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+
+    def __getitem__(self, station_id: str) -> TransferRow:
+        i = self.index[station_id]
+        lo = self.indptr[i]
+        hi = self.indptr[i + 1]
+        if lo == hi:
+            raise KeyError(station_id)
+
+        return TransferRow(self, lo, hi)
+
+    def __iter__(self):
+        for i, station_id in enumerate(self.ids):
+            if self.indptr[i] != self.indptr[i + 1]:
+                yield station_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class StationCoords(Mapping):
+    '''
+    Read-only view of the station coordinates stored in an (n, 3) array.
+    '''
+    def __init__(self, ids: list[str], index: dict[str, int], coords):
+        self.ids = ids
+        self.index = index
+        self.coords = coords
+
+    def __getitem__(self, station_id: str) -> dict[str, float]:
+        i = self.index[station_id]
+        x = self.coords[i * 3]
+        if x != x:  # NaN
+            raise KeyError(station_id)
+
+        return {'x': x, 'y': self.coords[i * 3 + 1],
+                'z': self.coords[i * 3 + 2]}
+
+    def __iter__(self):
+        for i, station_id in enumerate(self.ids):
+            if self.coords[i * 3] == self.coords[i * 3]:
+                yield station_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = 'w', **kwargs):
+    '''
+    Open a temporary file that replaces path once it is completely written,
+    so readers see either the old file or the new one, never a torn file.
+    '''
+    tmp = f'{path}.{os.getpid()}.{get_ident()}.tmp'
+    try:
+        with open(tmp, mode, **kwargs) as f:
+            yield f
+
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def refresh_lock(path: str) -> Lock:
+    '''
+    Get the lock that serialises refreshes of the file at path.
+    '''
+    path = os.path.abspath(path)
+    with refresh_locks_lock:
+        if path not in refresh_locks:
+            refresh_locks[path] = Lock()
+
+        return refresh_locks[path]
+
+
+def save_data(data: dict, LOCAL_FILE_PATH) -> None:
+    '''
+    Save the processed data as a binary snapshot.
+    Layout: header, then length-prefixed sections padded to 8 bytes --
+    station ID string table, coordinates (float64, n * 3),
+    CSR transfer adjacency (indptr, indices, time, distance)
+    and the pickled station / route records.
+    '''
+    ids = list(data['stations'])
+    index = {x: i for i, x in enumerate(ids)}
+    coords = array('d', [float('nan')] * (len(ids) * 3))
+    for station_id, c in data['station_coords'].items():
+        i = index[station_id] * 3
+        coords[i:i + 3] = array('d', (c['x'], c['y'], c['z']))
+
+    indptr = array('I', [0])
+    indices = array('I')
+    times = array('d')
+    dists = array('d')
+    for station_id in ids:
+        row = data['transfer_time'].get(station_id, {})
+        dist_row = data['transfer_dist'][station_id] if row else {}
+        for j, other in sorted((index[y], y) for y in row):
+            indices.append(j)
+            times.append(row[other])
+            dists.append(dist_row[other])
+
+        indptr.append(len(indices))
+
+    records = {k: v for k, v in data.items() if k not in
+               ('station_coords', 'transfer_time', 'transfer_dist',
+                'station_list', 'name_index', 'station_xz')}
+    sections = ['\0'.join(ids).encode('utf-8'), coords, indptr, indices,
+                times, dists, pickle.dumps(records, protocol=4)]
+    with atomic_open(LOCAL_FILE_PATH, 'wb') as f:
+        f.write(struct.pack('<4sHH', DATA_MAGIC, DATA_VERSION,
+                            sys.byteorder == 'big'))
+        for section in sections:
+            raw = section.tobytes() if isinstance(section, array) \
+                else section
+            f.write(struct.pack('<Q', len(raw)))
+            f.write(raw)
+            f.write(bytes(-len(raw) % 8))
+
+
+def read_data(LOCAL_FILE_PATH) -> dict:
+    '''
+    Read the processed data, either a binary snapshot (memory-mapped)
+    or a JSON file written by older versions.
+    A corrupt or truncated file raises ValueError.
+    The file is parsed again only when it changed, otherwise the same
+    object is returned, so the timetables compiled from it stay cached.
+    '''
+    stat = os.stat(LOCAL_FILE_PATH)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with loaded_data_lock:
+        cached = loaded_data.get(LOCAL_FILE_PATH)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    try:
+        data = parse_data(LOCAL_FILE_PATH)
+    except (struct.error, EOFError, pickle.UnpicklingError, TypeError,
+            IndexError, KeyError, AttributeError) as e:
+        raise ValueError(f'Corrupt station data file: {e}') from e
+
+    with loaded_data_lock:
+        loaded_data[LOCAL_FILE_PATH] = (version, data)
+    return data
+
+
+def parse_data(LOCAL_FILE_PATH) -> dict:
+    '''
+    Parse the processed data file, see read_data().
+    '''
+    with open(LOCAL_FILE_PATH, 'rb') as f:
+        if f.read(4) != DATA_MAGIC:
+            f.seek(0)
+            data = json.loads(f.read().decode('utf-8'))
+            # 旧版本的车站编号是十六进制字符串
+            data['station_list'] = list(data['stations'].values())
+            for i, station in enumerate(data['station_list']):
+                station['station'] = i
+
+            return data
+
+        if os.name == 'nt':
+            # Windows 不能替换已映射的文件，读入内存以便之后原子更新
+            mm = f.read()
+        else:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, big_endian = struct.unpack_from('<4sHH', mm, 0)
+    if version != DATA_VERSION:
+        raise ValueError(f'Unsupported station data version {version}')
+
+    view = memoryview(mm)
+    sections = []
+    pos = 8
+    for _ in range(7):
+        length, = struct.unpack_from('<Q', mm, pos)
+        pos += 8
+        if pos + length > len(mm):
+            raise ValueError('Truncated station data file')
+
+        sections.append(view[pos:pos + length])
+        pos += length + (-length % 8)
+
+    ids = bytes(sections[0]).decode('utf-8').split('\0') \
+        if len(sections[0]) > 0 else []
+    arrays = []
+    for section, fmt in zip(sections[1:6], 'dIIdd'):
+        if bool(big_endian) == (sys.byteorder == 'big'):
+            arrays.append(section.cast(fmt))
+        else:
+            a = array(fmt)
+            a.frombytes(section)
+            a.byteswap()
+            arrays.append(a)
+
+    coords, indptr, indices, times, dists = arrays
+    records = pickle.loads(sections[6])
+    index = {x: i for i, x in enumerate(ids)}
+    records['station_list'] = list(records['stations'].values())
+    records['station_coords'] = StationCoords(ids, index, coords)
+    records['transfer_time'] = TransferTable(ids, index, indptr,
+                                             indices, times)
+    records['transfer_dist'] = TransferTable(ids, index, indptr,
+                                             indices, dists)
+    return records
+
+
+def load_meta(LOCAL_FILE_PATH) -> dict:
+    '''
+    Load the freshness metadata of the station data file.
+    '''
+    meta_path = LOCAL_FILE_PATH + '.meta'
+    if not os.path.exists(meta_path):
+        return {}
+
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_meta(LOCAL_FILE_PATH, meta: dict) -> None:
+    '''
+    Save the freshness metadata of the station data file.
+    '''
+    with atomic_open(LOCAL_FILE_PATH + '.meta', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def fetch_data(link: str, LOCAL_FILE_PATH, MAX_WILD_BLOCKS,
+               meta: dict = None) -> Optional[dict]:
+    '''
+    Fetch all the route data and station data.
+    If meta is given, the request is conditional (ETag / Last-Modified),
+    and None is returned when the server reports no change.
+    '''
+    headers = {}
+    if meta is not None and meta.get('link') == link:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    r = mtr_api.client.get(map_api(link, 'stations-and-routes'), headers)
+    if r.status_code == 304 and meta is not None:
+        meta['checked'] = time()
+        save_meta(LOCAL_FILE_PATH, meta)
+        return None
+
+    r.raise_for_status()
+    old = None
+    if os.path.exists(LOCAL_FILE_PATH):
+        try:
+            old = read_data(LOCAL_FILE_PATH)
+        except (OSError, ValueError):
+            old = None
+
+    data_new = process_data(r.json()['data'], MAX_WILD_BLOCKS, old=old)
+    del old
+    save_data(data_new, LOCAL_FILE_PATH)
+    save_meta(LOCAL_FILE_PATH, {'link': link,
+                                'etag': r.headers.get('ETag'),
+                                'last_modified': r.headers.get('Last-Modified'),
+                                'checked': time()})
     return data_new
 
 
+def data_needs_refresh(link: str, LOCAL_FILE_PATH, UPDATE_DATA: bool,
+                       ttl: int) -> Optional[dict]:
+    '''
+    Check whether the station data file must be fetched again.
+    Returns None if the local file can be used as it is, otherwise the
+    metadata for a conditional request ({} for a full download).
+    '''
+    if not os.path.exists(LOCAL_FILE_PATH):
+        return {}
+
+    meta = load_meta(LOCAL_FILE_PATH)
+    if meta.get('link', link) != link:
+        return {}
+
+    checked = meta.get('checked', os.path.getmtime(LOCAL_FILE_PATH))
+    if UPDATE_DATA is True and time() - checked >= ttl:
+        return meta
+
+    return None
+
+
+def load_data(link: str, LOCAL_FILE_PATH, MAX_WILD_BLOCKS,
+              UPDATE_DATA: bool = True, ttl: int = DATA_TTL) -> dict:
+    '''
+    Load the station data, refreshing it only when needed.
+    UPDATE_DATA False -- use the local file, download only if it is missing
+    UPDATE_DATA True -- revalidate with the server once the file is older
+    than ttl seconds, keeping the local file if nothing changed
+    Concurrent callers share one refresh: the others wait for it to finish
+    and read its result instead of downloading again.
+    '''
+    if data_needs_refresh(link, LOCAL_FILE_PATH, UPDATE_DATA, ttl) is not None:
+        with refresh_lock(LOCAL_FILE_PATH):
+            # 等待锁期间其他线程可能已经更新了数据
+            meta = data_needs_refresh(link, LOCAL_FILE_PATH, UPDATE_DATA, ttl)
+            if meta == {}:
+                return fetch_data(link, LOCAL_FILE_PATH, MAX_WILD_BLOCKS)
+
+            if meta is not None:
+                try:
+                    data = fetch_data(link, LOCAL_FILE_PATH,
+                                      MAX_WILD_BLOCKS, meta)
+                except (requests.RequestException, ValueError, KeyError):
+                    # 服务器不可用时继续使用本地数据
+                    data = None
+
+                if data is not None:
+                    return data
+
+    try:
+        return read_data(LOCAL_FILE_PATH)
+    except ValueError:
+        with refresh_lock(LOCAL_FILE_PATH):
+            return fetch_data(link, LOCAL_FILE_PATH, MAX_WILD_BLOCKS)
+
+
 def gen_departure(link: str, DEP_PATH) -> None:
     '''
     Download the departures.
     '''
-    link = link.rstrip('/') + '/mtr/api/map/departures?dimension=0'
-    data = requests.get(link).json()['data']
+    data = mtr_api.client.get_json(map_api(link, 'departures'))['data']
     departures = data['departures']
     offset = data['cachedResponseTime']
     dep_dict: dict[str, list[int]] = {}
@@ -396,57 +1806,190 @@ def gen_departure(link: str, DEP_PATH) -> None:
         dep_list = list(sorted(dep_list))
         dep_dict[x['id']] = dep_list
     
-    with open(DEP_PATH, 'w', encoding='utf-8') as f:
+    with atomic_open(DEP_PATH, 'w', encoding='utf-8') as f:
         json.dump(dep_dict, f)
 
 
-def station_name_to_id(data: dict, sta: str, STATION_TABLE,
-                       fuzzy_compare=True) -> str:
+def station_name_index(data: dict) -> dict[str, int]:
+    '''
+    Get the lookup table from the lowercase forms of the station names
+    to the station index, built once per data. When several stations share
+    a name, the last one wins.
+    '''
+    if 'name_index' not in data:
+        name_index = {}
+        for station_id, station_dict in data['stations'].items():
+            s_1 = station_dict['name']
+            s_split = s_1.split('|')
+            s_2_2 = s_split[-1]
+            s_2 = s_2_2.split('/')[-1]
+            s_3 = s_split[0]
+            for name in (s_1, s_2, s_2_2, s_3):
+                name_index[name.lower()] = station_dict['station']
+
+        data['name_index'] = name_index
+
+    return data['name_index']
+
+
+def station_name_to_id(data: dict, sta: str, STATION_TABLE,
+                       fuzzy_compare=True) -> str:
+    '''
+    Convert one station's name to its ID.
+    '''
+    sta = sta.lower()
+    if sta in STATION_TABLE:
+        sta = STATION_TABLE[sta]
+
+    tra1 = opencc1.convert(sta)
+    sta_try = [sta, tra1, opencc2.convert(tra1)]
+
+    name_index = station_name_index(data)
+    found = [name_index[st] for st in sta_try if st in name_index]
+    if len(found) > 0:
+        return data['station_list'][max(found)]['id']
+
+    if fuzzy_compare is True:
+        all_names = [(x['name'], x['id']) for x in data['station_list']]
+        return get_close_matches(sta_try, all_names)
+
+    return None
+
+
+def station_num_to_name(data: dict, sta: int) -> str:
+    '''
+    Convert one station's index to its name.
+    '''
+    return data['station_list'][sta]['name']
+
+
+def station_xz(data: dict) -> list[Optional[tuple[float, float]]]:
     '''
-    Convert one station's name to its ID.
+    Get the (x, z) of every station by index, None if the station has no
+    platforms, built once per data.
     '''
-    sta = sta.lower()
-    if sta in STATION_TABLE:
-        sta = STATION_TABLE[sta]
+    if 'station_xz' not in data:
+        coords = data['station_coords']
+        data['station_xz'] = [
+            (coords[x['id']]['x'], coords[x['id']]['z'])
+            if x['id'] in coords else None for x in data['station_list']]
 
-    tra1 = opencc1.convert(sta)
-    sta_try = [sta, tra1, opencc2.convert(tra1)]
+    return data['station_xz']
 
-    all_names = []
-    stations = data['stations']
-    output = None
-    has_station = False
-    for station_id, station_dict in stations.items():
-        s_1 = station_dict['name']
-        all_names.append((s_1, station_id))
-        s_split = station_dict['name'].split('|')
-        s_2_2 = s_split[-1]
-        s_2 = s_2_2.split('/')[-1]
-        s_3 = s_split[0]
-        for st in sta_try:
-            if st in (s_1.lower(), s_2.lower(), s_2_2.lower(), s_3.lower()):
-                has_station = True
-                output = station_id
-                break
 
-    if has_station is False and fuzzy_compare is True:
-        return get_close_matches(sta_try, all_names)
+def route_fingerprint(data: dict, route_id: str) -> Optional[str]:
+    '''
+    Get a hash of everything the timetable of one route depends on:
+    the route record and the index, coordinates and transfers of its
+    stations. None if the data has no record hashes.
+    '''
+    if 'hashes' not in data:
+        return None
 
-    return output
+    station_hashes = data['hashes']['stations']
+    m = hashlib.md5(data['hashes']['routes'][route_id].encode('utf-8'))
+    m.update(data['index_epoch'].encode('utf-8'))
+    for x in data['routes'][route_id]['stations']:
+        m.update(station_hashes[x['id']].encode('utf-8'))
 
+    return m.hexdigest()
 
-def station_num_to_name(data: dict, sta: str) -> str:
+
+def gen_route_timetable(data: dict, route_id: str, avoid_ids: list,
+                        CALCULATE_WALKING_WILD: bool,
+                        WILD_ADDITION, TRANSFER_ADDITION) -> list[tuple]:
     '''
-    Convert one station's code (str of base-10 int) to its name.
+    Generate the timetable template of one route, relative to the
+    departure from its first station. None if the route has no
+    usable durations.
     '''
-    sta = hex(int(sta))[2:]
-    for station in data['stations'].values():
-        if station['station'] == sta:
-            return station['name']
+    route = data['routes'][route_id]
+    durations = route['durations']
+    if durations == []:
+        return None
+
+    station_ids = [data['stations'][x['id']]['station']
+                   for x in route['stations']]
+    if len(station_ids) - 1 < len(durations):
+        durations = durations[:len(station_ids) - 1]
+
+    if len(station_ids) - 1 > len(durations):
+        return None
+
+    real_ids = [x['id'] for x in route['stations']]
+    dwells = [x['dwellTime'] for x in route['stations']]
+    if len(dwells) > 0:
+        dep = -round(dwells[-1] / 1000)
+    else:
+        dep = 0
+
+    tt = []
+    for i in range(len(station_ids) - 1, 0, -1):
+        station1 = station_ids[i - 1]
+        station2 = station_ids[i]
+        _station1 = real_ids[i - 1]
+        _station2 = real_ids[i]
+        dur = round(durations[i - 1] / 1000)
+        arr_time = dep
+        dep_time = dep - dur
+        dwell = round(dwells[i - 1] / 1000)
+        dep -= dur
+        dep -= dwell
+        if station1 == station2:
+            continue
+
+        if _station2 in avoid_ids:
+            continue
+
+        if _station1 not in avoid_ids and _station2 not in avoid_ids:
+            tt.append((station1, station2,
+                       dep_time, arr_time,
+                       [route_id, route['stations'][-1]['id']]))
+
+        # 添加出站换乘
+        connections = list(data['stations'][_station2]['connections'])
+        if _station2 in TRANSFER_ADDITION:
+            connections += data['stations'][TRANSFER_ADDITION[_station2]]
+        for con in connections:
+            if con in avoid_ids:
+                continue
+
+            if _station2 not in data['transfer_time']:
+                continue
+
+            if con not in data['transfer_time'][_station2]:
+                continue
 
+            t2 = round(data['transfer_time'][_station2][con])
+            dist = data['transfer_dist'][_station2][con]
+            con = data['stations'][con]['station']
+            tt.append((station2, con,
+                       arr_time, arr_time + t2,
+                       [f'出站换乘步行 Walk {round(dist, 2)}m', '']))
+
+        if CALCULATE_WALKING_WILD is True:
+            # 添加非出站换乘（越野），换乘表的行已按车站编号排序
+            connections = list(data['transfer_time'].get(_station2, {}))
+            if _station2 in WILD_ADDITION:
+                connections += data['stations'][WILD_ADDITION[_station2]]
+            for con in connections:
+                if con in avoid_ids:
+                    continue
+
+                if _station2 not in data['transfer_time']:
+                    continue
+
+                if con not in data['transfer_time'][_station2]:
+                    continue
+
+                t2 = round(data['transfer_time'][_station2][con])
+                dist = data['transfer_dist'][_station2][con]
+                con = data['stations'][con]['station']
+                tt.append((station2, con,
+                           arr_time, arr_time + t2,
+                           [f'步行 Walk {round(dist, 2)}m', '']))
 
-def sta_id(station: str) -> int:
-    return int('0x' + station, 16)
+    return tt
 
 
 def gen_timetable(data: dict, IGNORED_LINES: list[str],
@@ -455,10 +1998,13 @@ def gen_timetable(data: dict, IGNORED_LINES: list[str],
                   AVOID_STATIONS: list, route_type: RouteType,
                   original_ignored_lines: list[str], DEP_PATH: str,
                   version1: str, version2: str,
-                  STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION
-                  ) -> list[tuple]:
+                  STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION,
+                  budget: Budget = None) -> list[tuple]:
     '''
     Generate the timetable of all routes.
+    With the default settings, the timetable of every route is cached
+    together with its route_fingerprint(), so refreshing the data only
+    regenerates the routes that changed.
     '''
     if not os.path.exists('mtr_pathfinder_temp'):
         os.makedirs('mtr_pathfinder_temp')
@@ -467,6 +2013,7 @@ def gen_timetable(data: dict, IGNORED_LINES: list[str],
         dep_data: dict[str, list[int]] = json.load(f)
 
     filename = ''
+    cache: dict[str, tuple[str, list]] = {}
     m = hashlib.md5()
     if IGNORED_LINES == original_ignored_lines and \
             CALCULATE_BOAT is True and ONLY_LRT is False and \
@@ -474,15 +2021,17 @@ def gen_timetable(data: dict, IGNORED_LINES: list[str],
         for s in original_ignored_lines:
             m.update(s.encode('utf-8'))
 
+        m.update(DEP_PATH.encode('utf-8'))
+        m.update(json.dumps([TRANSFER_ADDITION, WILD_ADDITION],
+                            sort_keys=True).encode('utf-8'))
         filename = f'mtr_pathfinder_temp{os.sep}' + \
             f'4{int(CALCULATE_HIGH_SPEED)}{int(CALCULATE_WALKING_WILD)}' + \
-            f'-{version1}-{version2}-{m.hexdigest()}.dat'
+            f'-{m.hexdigest()}.dat'
         if os.path.exists(filename):
-            with open(filename, 'r+b') as f:
-                mmapped_file = mmap.mmap(f.fileno(), 0)
-                tt_dict = pickle.load(mmapped_file)
-
-            return tt_dict
+            with open(filename, 'rb') as f:
+                mmapped_file = mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+                cache = pickle.load(mmapped_file)
 
     avoid_ids = [station_name_to_id(data, x, STATION_TABLE)
                  for x in AVOID_STATIONS]
@@ -490,7 +2039,12 @@ def gen_timetable(data: dict, IGNORED_LINES: list[str],
     # 添加普通路线
     TEMP_IGNORED_LINES = [x.lower() for x in IGNORED_LINES]
     tt_dict = {}
+    new_cache: dict[str, tuple[str, list]] = {}
+    changed = False
     for route_id in dep_data.keys():
+        if budget is not None:
+            budget.check()
+
         if route_id not in data['routes']:
             continue
 
@@ -513,116 +2067,570 @@ def gen_timetable(data: dict, IGNORED_LINES: list[str],
         if ONLY_LRT and route['type'] != 'train_light_rail':
             continue
 
-        durations = route['durations']
-        if durations == []:
+        fingerprint = None
+        if filename != '':
+            fingerprint = route_fingerprint(data, route_id)
+
+        if fingerprint is not None and route_id in cache and \
+                cache[route_id][0] == fingerprint:
+            tt = cache[route_id][1]
+        else:
+            tt = gen_route_timetable(data, route_id, avoid_ids,
+                                     CALCULATE_WALKING_WILD,
+                                     WILD_ADDITION, TRANSFER_ADDITION)
+            # 没有指纹的路线（旧版 JSON 数据）不缓存，不需要重写缓存文件
+            if fingerprint is not None:
+                changed = True
+
+        if tt is None:
             continue
 
-        station_ids = [data['stations'][x['id']]['station']
-                       for x in route['stations']]
-        if len(station_ids) - 1 < len(durations):
-            durations = durations[:len(station_ids) - 1]
+        tt_dict[route_id] = tt
+        if fingerprint is not None:
+            new_cache[route_id] = (fingerprint, tt)
 
-        if len(station_ids) - 1 > len(durations):
-            continue
+    if filename != '' and (changed or new_cache.keys() != cache.keys()):
+        with atomic_open(filename, 'wb') as f:
+            pickle.dump(new_cache, f)
 
-        real_ids = [x['id'] for x in route['stations']]
-        dwells = [x['dwellTime'] for x in route['stations']]
-        if len(dwells) > 0:
-            dep = -round(dwells[-1] / 1000)
-        else:
-            dep = 0
-
-        tt = []
-        for i in range(len(station_ids) - 1, 0, -1):
-            station1 = station_ids[i - 1]
-            station2 = station_ids[i]
-            _station1 = real_ids[i - 1]
-            _station2 = real_ids[i]
-            dur = round(durations[i - 1] / 1000)
-            arr_time = dep
-            dep_time = dep - dur
-            dwell = round(dwells[i - 1] / 1000)
-            dep -= dur
-            dep -= dwell
-            if station1 == station2:
-                continue
+    return tt_dict
+
+
+# 时刻表的列名和 array 类型
+TIMETABLE_COLUMNS = (('dep_station', 'I'), ('arr_station', 'I'),
+                     ('dep_time', 'I'), ('arr_time', 'I'), ('trip', 'i'),
+                     ('detail', 'I'), ('kind', 'B'))
+
+
+class Timetable:
+    '''
+    The connections of two whole days, compiled once from the route
+    timetables and the departures and sorted by departure time,
+    so a query only slices its time window, even past midnight.
+    The connections are stored as parallel arrays, the route and
+    walking details are kept once each in a side table.
+    With change times, the arrival time of a connection is the time
+    the rider can leave its arrival station again, use real_legs() to
+    get the time the rider gets there.
+    '''
+    def __init__(self):
+        self.dep_station = array('I')
+        self.arr_station = array('I')
+        self.dep_time = array('I')
+        self.arr_time = array('I')
+        self.trip = array('i')          # 步行为 -1
+        self.detail = array('I')        # details 中的序号
+        self.kind = array('B')          # LegKind
+        self.details: list[list[str]] = []
+        self.trip_count = 0
+        self.patterns: Optional[RoutePatterns] = None
+        # 按到达时间排序的连接序号，以及对应的到达时间
+        self.arrival_order: Optional[tuple[array, array]] = None
+        self.speed: Optional[float] = None
+        # 每个车站的最短换乘时间，已计入连接的到达时间，None 表示不计
+        self.change_time: Optional[array] = None
+        # 每种连接（按 LegKind）的额外时间，已计入步行的到达时间
+        self.penalty: tuple[int, int, int] = (0, 0, 0)
+        # 空闲的寻路器，查询时借出，用完归还，见 borrow_csa()
+        self.csa_pool: list = []
+
+    def __len__(self) -> int:
+        return len(self.dep_time)
+
+    def bounds(self, start: int, end: int) -> tuple[int, int]:
+        '''
+        Get the index range of the connections departing in [start, end),
+        0 <= start < 86400 and end is at most one day after start.
+        '''
+        return (bisect_left(self.dep_time, start),
+                bisect_left(self.dep_time, min(end, start + 86400)))
+
+    def connection(self, i: int) -> tuple:
+        '''
+        Get one connection as a tuple
+        (dep_station, arr_station, dep_time, arr_time, detail[, trip]),
+        the trip is only given if it is not walking.
+        '''
+        c = (self.dep_station[i], self.arr_station[i],
+             self.dep_time[i], self.arr_time[i],
+             self.details[self.detail[i]])
+        if self.kind[i] == LegKind.RIDE:
+            return c + (self.trip[i],)
+
+        return c
+
+    def change(self, station: int) -> int:
+        '''
+        Get the minimum change time at a station.
+        '''
+        return 0 if self.change_time is None else self.change_time[station]
+
+    def start_walks(self, walks: list[tuple]) -> list[tuple]:
+        '''
+        Add the penalty and the change time at the end to the transfers
+        from the start station, as for the walks in the timetable.
+        '''
+        return [(w[0], w[1], w[2],
+                 w[3] + self.penalty[leg_kind(w[4])] + self.change(w[1])) +
+                tuple(w[4:]) for w in walks]
+
+    def real_legs(self, legs: list[tuple]) -> list[tuple]:
+        '''
+        Take the change time at the end out of the arrival time of the
+        legs of a journey, so it is the time the rider gets there.
+        '''
+        if self.change_time is None:
+            return legs
+
+        return [(x[0], x[1], x[2], x[3] - self.change_time[x[1]]) +
+                tuple(x[4:]) for x in legs]
+
+    def by_arrival(self) -> tuple[array, array]:
+        '''
+        Get the connection indices sorted by the time the trains get to
+        the arrival station and those times, for reverse scans, so the
+        connections of a trip stay in order with change times.
+        Built on first use.
+        '''
+        if self.arrival_order is None:
+            if np is not None:
+                arr_time = np.frombuffer(self.arr_time, dtype=np.uint32)
+                if self.change_time is not None:
+                    arr_time = arr_time - np.frombuffer(
+                        self.change_time, dtype=np.uint32)[np.frombuffer(
+                            self.arr_station, dtype=np.uint32)]
+
+                order = np.argsort(arr_time, kind='stable')
+                self.arrival_order = (
+                    array('I', order.astype(np.uint32).tobytes()),
+                    array('I', arr_time[order].astype(np.uint32).tobytes()))
+            else:
+                arr_time = self.arr_time
+                if self.change_time is not None:
+                    arr_time = array('I', (
+                        t - self.change_time[x]
+                        for t, x in zip(self.arr_time, self.arr_station)))
+
+                order = sorted(range(len(self)), key=arr_time.__getitem__)
+                self.arrival_order = (
+                    array('I', order),
+                    array('I', map(arr_time.__getitem__, order)))
+
+        return self.arrival_order
+
+    def max_speed(self, data: dict) -> float:
+        '''
+        Get the highest straight-line speed between the two stations of
+        any connection, in block/s, so the distance to the target at this
+        speed never overestimates the time left. The short walks rounded
+        to no time count as one second. Infinite if a connection has a
+        station without coordinates. Computed on first use.
+        '''
+        if self.speed is None:
+            xz = station_xz(data)
+            if any(x is None for x in xz):
+                used = set(self.dep_station) | set(self.arr_station)
+                if any(xz[x] is None for x in used):
+                    self.speed = float('inf')
+                    return self.speed
+
+            if np is not None:
+                x = np.array([c[0] if c else 0 for c in xz], dtype=np.float64)
+                z = np.array([c[1] if c else 0 for c in xz], dtype=np.float64)
+                dep = np.frombuffer(self.dep_station, dtype=np.uint32)
+                arr = np.frombuffer(self.arr_station, dtype=np.uint32)
+                dist = np.hypot(x[dep] - x[arr], z[dep] - z[arr])
+                duration = np.frombuffer(self.arr_time, dtype=np.uint32) - \
+                    np.frombuffer(self.dep_time, dtype=np.uint32).astype(
+                        np.int64)
+                self.speed = float(np.max(dist / np.maximum(duration, 1),
+                                          initial=0))
+            else:
+                speed = 0
+                for a, b, t1, t2 in zip(self.dep_station, self.arr_station,
+                                        self.dep_time, self.arr_time):
+                    dist = sqrt((xz[a][0] - xz[b][0]) ** 2 +
+                                (xz[a][1] - xz[b][1]) ** 2)
+                    speed = max(speed, dist / max(t2 - t1, 1))
+
+                self.speed = speed
+
+        return self.speed
+
+    def route_patterns(self) -> 'RoutePatterns':
+        '''
+        Get the route patterns of the timetable, built on first use.
+        '''
+        if self.patterns is None:
+            self.patterns = RoutePatterns(self)
+
+        return self.patterns
+
+
+class RoutePatterns:
+    '''
+    The trips of a compiled timetable grouped into route patterns, trips
+    of the same route that ride the same connections, for Raptor.
+    The trips of a pattern are sorted by departure time and never
+    overtake each other.
+    '''
+    def __init__(self, timetable: 'Timetable'):
+        trips: dict[int, list[int]] = {}
+        # 每对车站只保留最快的步行
+        walks: dict[tuple[int, int], tuple[int, int]] = {}
+        walk_times: dict[int, list[int]] = {}
+        for i, (kind, trip, station, con, dep, arr) in enumerate(zip(
+                timetable.kind, timetable.trip, timetable.dep_station,
+                timetable.arr_station, timetable.dep_time,
+                timetable.arr_time)):
+            if kind == LegKind.RIDE:
+                if trip in trips:
+                    trips[trip].append(i)
+                else:
+                    trips[trip] = [i]
 
-            if _station2 in avoid_ids:
                 continue
 
-            if _station1 not in avoid_ids and _station2 not in avoid_ids:
-                tt.append((sta_id(station1), sta_id(station2),
-                           dep_time, arr_time,
-                           [route_id, route['stations'][-1]['id']]))
+            times = walk_times.setdefault(station, [])
+            if len(times) == 0 or times[-1] != dep:
+                times.append(dep)
+
+            if (station, con) not in walks or \
+                    arr - dep < walks[station, con][0]:
+                walks[station, con] = (arr - dep, i)
+
+        # 班次已按首个连接的发车时间排序
+        groups: dict[tuple, list[list[int]]] = {}
+        dep_station = timetable.dep_station
+        arr_station = timetable.arr_station
+        detail = timetable.detail
+        for connections in trips.values():
+            key = tuple([(dep_station[i], arr_station[i], detail[i])
+                         for i in connections])
+            groups.setdefault(key, []).append(connections)
+
+        self.pairs: list[list[tuple[int, int]]] = []
+        self.dep: list[list[array]] = []
+        self.arr: list[list[array]] = []
+        self.index: list[list[array]] = []
+        self.stops: dict[int, list[tuple[int, int]]] = {}
+        for key, group in groups.items():
+            p = len(self.pairs)
+            self.pairs.append([(x[0], x[1]) for x in key])
+            index = [array('I', column) for column in zip(*group)]
+            self.index.append(index)
+            self.dep.append([array('I', map(timetable.dep_time.__getitem__,
+                                            column)) for column in index])
+            self.arr.append([array('I', map(timetable.arr_time.__getitem__,
+                                            column)) for column in index])
+            for k, x in enumerate(key):
+                self.stops.setdefault(x[0], []).append((p, k))
+
+        # 步行在有列车到达时出发，按出发时间排序
+        self.walk_times: dict[int, array] = {
+            station: array('I', times)
+            for station, times in walk_times.items()}
+        self.footpaths: dict[int, list[tuple[int, int, int]]] = {}
+        for (station, con), (t2, i) in walks.items():
+            self.footpaths.setdefault(station, []).append((con, t2, i))
+
+
+def compile_timetable(tt_dict: dict[str, list[tuple]], DEP_PATH,
+                      use_numpy: bool = True,
+                      change_time: Optional[array] = None,
+                      TRANSFER_PENALTY: int = 0,
+                      WILD_PENALTY: int = 0) -> Timetable:
+    '''
+    Expand the route timetables with every departure of two days.
+    A trip that starts before midnight keeps the same trip number
+    for its connections after midnight.
+    NumPy is used for the expansion when it is installed.
+    If change_time is given, every connection arrives change_time of its
+    arrival station later, and every walk leaves change_time of its
+    departure station after the train arrives. The penalties are added
+    to the walks of each kind.
+    '''
+    with open(DEP_PATH, 'r', encoding='utf-8') as f:
+        dep_data: dict[str, list[int]] = json.load(f)
 
-            # 添加出站换乘
-            connections = data['stations'][_station2]['connections']
-            if _station2 in TRANSFER_ADDITION:
-                connections += data['stations'][TRANSFER_ADDITION[_station2]]
-            for con in connections:
-                if con in avoid_ids:
-                    continue
+    timetable = Timetable()
+    timetable.change_time = change_time
+    timetable.penalty = (0, TRANSFER_PENALTY, WILD_PENALTY)
+    detail_index: dict[tuple[str, str], int] = {}
+    routes: list[tuple[list[tuple], list[int]]] = []
+    for route_id, departures in dep_data.items():
+        if route_id not in tt_dict:
+            continue
 
-                if _station2 not in data['transfer_time']:
-                    continue
+        template = []
+        for t in tt_dict[route_id]:
+            key = tuple(t[4])
+            if key not in detail_index:
+                detail_index[key] = len(timetable.details)
+                timetable.details.append(t[4])
 
-                if con not in data['transfer_time'][_station2]:
+            kind = leg_kind(t[4])
+            dep = t[2]
+            arr = t[3] + timetable.penalty[kind]
+            if change_time is not None:
+                # 下车后经过换乘时间才能步行离开，到站后经过换乘时间才能上车
+                if kind != LegKind.RIDE:
+                    dep += change_time[t[0]]
+                    arr += change_time[t[0]]
+
+                arr += change_time[t[1]]
+
+            template.append((t[0], t[1], dep, arr, detail_index[key], kind))
+
+        routes.append((template, departures))
+
+    trip_count = sum(len(departures) for _, departures in routes)
+    timetable.trip_count = 3 * trip_count
+    if use_numpy is True and np is not None:
+        columns = expand_timetable_np(routes, trip_count)
+    else:
+        columns = expand_timetable(routes, trip_count)
+
+    for (name, typecode), column in zip(TIMETABLE_COLUMNS, columns):
+        setattr(timetable, name, column)
+
+    return timetable
+
+
+def expand_timetable(routes: list[tuple[list[tuple], list[int]]],
+                     trip_count: int) -> list[array]:
+    '''
+    Expand the route templates with their departures into the
+    timetable columns, sorted by departure time.
+    '''
+    columns = [array(typecode) for _, typecode in TIMETABLE_COLUMNS]
+    (dep_station, arr_station, dep_time, arr_time,
+     trips, details, kinds) = (column.append for column in columns)
+    trip_no = 0
+    for template, departures in routes:
+        first = min((t[2] for t in template), default=0)
+        last = max((t[2] for t in template), default=0)
+        for departure in departures:
+            # 路线时刻表的时间不大于 0，前一天发车的班次可能在当天到达
+            for day in range(3):
+                offset = departure + day * 86400
+                # 只展开有连接在两天之内发车的日期
+                if offset + last < 0 or offset + first >= 2 * 86400:
                     continue
 
-                t2 = round(data['transfer_time'][_station2][con])
-                dist = data['transfer_dist'][_station2][con]
-                con = data['stations'][con]['station']
-                tt.append((sta_id(station2), sta_id(con),
-                           arr_time, arr_time + t2,
-                           [f'出站换乘步行 Walk {round(dist, 2)}m', '']))
-
-            if CALCULATE_WALKING_WILD is True:
-                # 添加非出站换乘（越野）
-                connections = list(data['stations'].keys())
-                if _station2 in WILD_ADDITION:
-                    connections += data['stations'][WILD_ADDITION[_station2]]
-                for con in connections:
-                    if con in avoid_ids:
+                trip = trip_no + day * trip_count
+                for t in template:
+                    dep = t[2] + offset
+                    if not 0 <= dep < 2 * 86400:
                         continue
 
-                    if _station2 not in data['transfer_time']:
-                        continue
+                    dep_station(t[0])
+                    arr_station(t[1])
+                    dep_time(dep)
+                    arr_time(t[3] + offset)
+                    trips(trip if t[5] == LegKind.RIDE else -1)
+                    details(t[4])
+                    kinds(t[5])
 
-                    if con not in data['transfer_time'][_station2]:
-                        continue
+            trip_no += 1
+
+    # IMPORTANT !!! Connections must be sorted by departure/arrival time.
+    order = sorted(range(len(columns[2])), key=columns[2].__getitem__)
+    return [array(typecode, map(column.__getitem__, order))
+            for column, (_, typecode) in zip(columns, TIMETABLE_COLUMNS)]
 
-                    t2 = round(data['transfer_time'][_station2][con])
-                    dist = data['transfer_dist'][_station2][con]
-                    con = data['stations'][con]['station']
-                    tt.append((sta_id(station2), sta_id(con),
-                               arr_time, arr_time + t2,
-                               [f'步行 Walk {round(dist, 2)}m', '']))
 
-        tt_dict[route_id] = tt
+def expand_timetable_np(routes: list[tuple[list[tuple], list[int]]],
+                        trip_count: int) -> list[array]:
+    '''
+    Expand the route templates with their departures into the
+    timetable columns with NumPy broadcasting, sorted by departure time.
+    The output is identical to expand_timetable().
+    '''
+    dtypes = [np.dtype(typecode) for _, typecode in TIMETABLE_COLUMNS]
+    chunks = []
+    trip_no = 0
+    days = np.arange(3, dtype=np.int32)
+    for template, departures in routes:
+        if not template:
+            trip_no += len(departures)
+            continue
 
-    if filename != '':
-        if not os.path.exists(filename):
-            with open(filename, 'wb') as f:
-                pickle.dump(tt_dict, f)
+        t = np.array(template, dtype=np.int32).reshape(-1, 6)
+        # 按 (发车, 日期, 模板) 的顺序展开，与 expand_timetable() 相同
+        offset = np.array(departures, dtype=np.int32)[:, None] + days * 86400
+        # 只展开有连接在两天之内发车的日期
+        rows, day = np.nonzero((offset + t[:, 2].max() >= 0) &
+                               (offset + t[:, 2].min() < 2 * 86400))
+        offset = offset[rows, day]
+        trips = trip_no + rows + day * trip_count
+        trip_no += len(departures)
+
+        dep = offset[:, None] + t[:, 2]
+        keep = (dep >= 0) & (dep < 2 * 86400)
+        dep = dep[keep]
+        shape = keep.shape
+        trip = np.broadcast_to(trips[:, None], shape)[keep].astype(dtypes[4])
+        kind = np.broadcast_to(t[:, 5].astype(dtypes[6]), shape)[keep]
+        trip[kind != LegKind.RIDE] = -1
+        chunks.append((
+            np.broadcast_to(t[:, 0].astype(dtypes[0]), shape)[keep],
+            np.broadcast_to(t[:, 1].astype(dtypes[1]), shape)[keep],
+            dep.astype(dtypes[2]),
+            (dep + np.broadcast_to(t[:, 3] - t[:, 2], shape)[keep]).astype(
+                dtypes[3]),
+            trip,
+            np.broadcast_to(t[:, 4].astype(dtypes[5]), shape)[keep],
+            kind))
+
+    parts = [list(column) for column in zip(*chunks)] if chunks else \
+        [[np.zeros(0, dtype)] for dtype in dtypes]
+    del chunks
+    # IMPORTANT !!! Connections must be sorted by departure/arrival time.
+    order = np.argsort(np.concatenate(parts[2]), kind='stable')
+    # 逐列合并和排序，同一时间只多占用一列的内存
+    columns = []
+    for column_parts, (_, typecode) in zip(parts, TIMETABLE_COLUMNS):
+        values = np.concatenate(column_parts)
+        column_parts.clear()
+        column = array(typecode)
+        column.frombytes(values[order].view(np.uint8))
+        columns.append(column)
+
+    return columns
+
+
+def station_change_times(data: dict, MIN_CHANGE_TIME: int,
+                         CHANGE_TIME: dict[str, int],
+                         STATION_TABLE) -> Optional[array]:
+    '''
+    Get the minimum change time of every station, MIN_CHANGE_TIME unless
+    the station is in CHANGE_TIME. None if they are all 0.
+    '''
+    if MIN_CHANGE_TIME == 0 and not any(CHANGE_TIME.values()):
+        return None
 
-    return tt_dict
+    change_time = array('I', [MIN_CHANGE_TIME]) * len(data['stations'])
+    for name, t in CHANGE_TIME.items():
+        station_id = station_name_to_id(data, name, STATION_TABLE)
+        if station_id is not None:
+            change_time[data['stations'][station_id]['station']] = t
+
+    return change_time
+
+
+def load_timetable(data: dict, IGNORED_LINES: list[str],
+                   CALCULATE_HIGH_SPEED: bool, CALCULATE_BOAT: bool,
+                   CALCULATE_WALKING_WILD: bool, ONLY_LRT: bool,
+                   AVOID_STATIONS: list, route_type: RouteType,
+                   original_ignored_lines: list[str], DEP_PATH: str,
+                   version1: str, version2: str,
+                   STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION,
+                   budget: Budget = None, MIN_CHANGE_TIME: int = 0,
+                   CHANGE_TIME: dict[str, int] = {},
+                   TRANSFER_PENALTY: int = 0,
+                   WILD_PENALTY: int = 0) -> Timetable:
+    '''
+    Get the compiled timetable, reusing the one compiled for the same
+    data object, settings and departures file if there is one.
+    '''
+    key = json.dumps([IGNORED_LINES, CALCULATE_HIGH_SPEED, CALCULATE_BOAT,
+                      CALCULATE_WALKING_WILD, ONLY_LRT, AVOID_STATIONS,
+                      route_type.value, original_ignored_lines,
+                      os.path.abspath(DEP_PATH), STATION_TABLE,
+                      WILD_ADDITION, TRANSFER_ADDITION, MIN_CHANGE_TIME,
+                      CHANGE_TIME, TRANSFER_PENALTY, WILD_PENALTY],
+                     sort_keys=True)
+    dep_mtime = os.path.getmtime(DEP_PATH)
+    with compiled_timetables_lock:
+        cached = compiled_timetables.get(key)
+
+    if cached is not None and cached[0] is data and cached[1] == dep_mtime:
+        return cached[2]
+
+    tt_dict = gen_timetable(
+        data, IGNORED_LINES, CALCULATE_HIGH_SPEED, CALCULATE_BOAT,
+        CALCULATE_WALKING_WILD, ONLY_LRT, AVOID_STATIONS, route_type,
+        original_ignored_lines, DEP_PATH, version1, version2,
+        STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION, budget)
+    change_time = station_change_times(data, MIN_CHANGE_TIME, CHANGE_TIME,
+                                       STATION_TABLE)
+    timetable = compile_timetable(tt_dict, DEP_PATH, True, change_time,
+                                  TRANSFER_PENALTY, WILD_PENALTY)
+    with compiled_timetables_lock:
+        compiled_timetables.pop(key, None)
+        compiled_timetables[key] = (data, dep_mtime, timetable)
+        while len(compiled_timetables) > MAX_COMPILED_TIMETABLES:
+            evicted = compiled_timetables.pop(next(iter(compiled_timetables)))
+            # 寻路器引用时刻表，清空空闲的寻路器后时刻表可以立即释放
+            with csa_pools_lock:
+                evicted[2].csa_pool.clear()
+
+    return timetable
+
+
+@contextmanager
+def borrow_csa(max_stations, timetable: Timetable, timeout_min=2,
+               budget: Budget = None):
+    '''
+    Borrow an idle CSA of the timetable, or a new one if they are all
+    in use, so the buffers are kept across queries.
+    '''
+    pool = timetable.csa_pool
+    with csa_pools_lock:
+        csa = pool.pop() if len(pool) > 0 else None
 
+    if csa is None or csa.max_stations != max_stations:
+        csa = CSA(max_stations, timetable, timeout_min)
 
-def load_tt(tt_dict: dict[tuple], data, start, end, departure_time: int,
-            DEP_PATH, STATION_TABLE, TRANSFER_ADDITION,
-            CALCULATE_WALKING_WILD, WILD_ADDITION, MAX_HOUR):
-    with open(DEP_PATH, 'r', encoding='utf-8') as f:
-        dep_data: dict[str, list[int]] = json.load(f)
+    csa.timeout_min = timeout_min
+    csa.budget = budget
+    try:
+        yield csa
+    finally:
+        csa.budget = None
+        with csa_pools_lock:
+            pool.append(csa)
+
+
+def lower_bounds(data: dict, timetable: Timetable,
+                 arrival_station: int) -> Optional[array]:
+    '''
+    Get a lower bound of the time from every station to arrival_station,
+    the straight-line distance at the highest speed of the timetable.
+    None if the timetable has no usable speed.
+    '''
+    speed = timetable.max_speed(data)
+    xz = station_xz(data)
+    target = xz[arrival_station]
+    if target is None or speed == 0 or speed == float('inf'):
+        return None
+
+    return array('Q', (0 if c is None else
+                       floor(sqrt((c[0] - target[0]) ** 2 +
+                                  (c[1] - target[1]) ** 2) / speed)
+                       for c in xz))
+
+
+def load_tt(data, start, end, departure_time: int,
+            STATION_TABLE, TRANSFER_ADDITION,
+            CALCULATE_WALKING_WILD, WILD_ADDITION,
+            budget: Budget = None) -> list[tuple]:
+    '''
+    Get the transfers from the start station of one query.
+    '''
+    if budget is not None:
+        budget.check()
 
-    timetable: list[tuple] = []
+    tt: list[tuple] = []
     start_station = station_name_to_id(data, start, STATION_TABLE)
     end_station = station_name_to_id(data, end, STATION_TABLE)
     if not (start_station and end_station):
-        return [], {}
+        return []
 
     # 添加起点出站换乘
     ss = data['stations'][start_station]['station']
-    connections = data['stations'][start_station]['connections']
+    connections = list(data['stations'][start_station]['connections'])
     if start in TRANSFER_ADDITION:
         connections += data['stations'][TRANSFER_ADDITION[start]]
     for con in connections:
@@ -632,14 +2640,14 @@ def load_tt(tt_dict: dict[tuple], data, start, end, departure_time: int,
         t2 = round(data['transfer_time'][start_station][con])
         dist = data['transfer_dist'][start_station][con]
         con = data['stations'][con]['station']
-        timetable.append(
-            (sta_id(ss), sta_id(con),
+        tt.append(
+            (ss, con,
              departure_time, departure_time + t2,
              [f'出站换乘步行 Walk {round(dist, 2)}m', '']))
 
     if CALCULATE_WALKING_WILD is True:
-        # 添加起点非出站换乘（越野）
-        connections = list(data['stations'].keys())
+        # 添加起点非出站换乘（越野），换乘表的行已按车站编号排序
+        connections = list(data['transfer_time'].get(start_station, {}))
         if start in WILD_ADDITION:
             connections += data['stations'][WILD_ADDITION[start]]
         for con in connections:
@@ -652,62 +2660,46 @@ def load_tt(tt_dict: dict[tuple], data, start, end, departure_time: int,
             t2 = round(data['transfer_time'][start_station][con])
             dist = data['transfer_dist'][start_station][con]
             con = data['stations'][con]['station']
-            timetable.append(
-                (sta_id(ss), sta_id(con),
+            tt.append(
+                (ss, con,
                  departure_time, departure_time + t2,
                  [f'步行 Walk {round(dist, 2)}m', '']))
 
-    max_time = departure_time + MAX_HOUR * 60 * 60
-    trips: dict[str, dict[str, int]] = {}
-    trip_no = 0
-    for route_id, departures in dep_data.items():
-        if route_id not in tt_dict:
-            continue
-
-        if max_time > 86400:
-            departures += [x + 86400 for x in departures if x <= max_time - 86400]
-
-        tt = tt_dict[route_id]
-        for departure in departures:
-            if departure >= max_time:
-                break
+    return tt
 
-            trips[str(trip_no)] = {}
 
-            for t in tt:
-                _t = list(t)
-                _t[2] += departure
-                _t[3] += departure
-                if _t[2] < 0:
-                    _t[2] += 86400
-                    _t[3] += 86400
-
-                if max_time - 86400 < _t[2] < departure_time:
-                    continue
+def shift_walks(walks: list[tuple], departure_time: int) -> list[tuple]:
+    '''
+    Move the transfers from the start station to leave at departure_time.
+    '''
+    return [(w[0], w[1], departure_time, departure_time + w[3] - w[2]) +
+            tuple(w[4:]) for w in walks]
 
-                if _t[4][1] != '':  # Not walking
-                    _t += [trip_no]
-                    trips[str(trip_no)][str(_t[0])] = _t[2]
 
-                timetable.append(_t)
+def journey_rides(result: list[tuple]) -> int:
+    '''
+    Get the number of rides of a journey.
+    '''
+    return sum(1 for x in result if len(x) > 5)
 
-                # if max_time > 86400 and departure <= max_time - 86400:
-                #     _t[2] += 86400
-                #     _t[3] += 86400
-                #     if _t[4][1] != '':  # Not walking
-                #         trips[str(trip_no)][str(_t[0])] = _t[2]
 
-                #     timetable.append(_t)
+def leave_time(result: list[tuple]) -> Optional[int]:
+    '''
+    Get the latest time to leave the start station and still catch the
+    first ride of a journey, None if it has no ride.
+    '''
+    walk = 0
+    for leg in result:
+        if len(leg) > 5:
+            return leg[2] - walk
 
-            trip_no += 1
+        walk += leg[3] - leg[2]
 
-    # IMPORTANT !!! Connections must be sorted by departure/arrival time.
-    timetable.sort(key=itemgetter(2))
-    return timetable, trips
+    return None
 
 
 def process_path(result: list[tuple], start: str, end: str,
-                 trips: dict[str, dict[str, int]], data: dict, detail: bool,
+                 data: dict, detail: bool,
                  STATION_TABLE) -> list[str, int, int, int, list]:
     '''
     Process the path, change it into human readable form.
@@ -722,34 +2714,9 @@ def process_path(result: list[tuple], start: str, end: str,
 
     path: list[tuple] = []
     last_detail: tuple = None
-    route_new = []
-    low_i = MAX_INT
-    for i in range(len(result) - 1, -1, -1):
-        if i >= low_i:
-            continue
-
-        new_leg = result[i]
-        if len(new_leg) < 6:
-            route_new.append(new_leg)
-            continue
-
-        trip = trips[str(new_leg[5])]
-        for j in range(i - 1, -1, -1):
-            trip_index = str(result[j][0])
-            if trip_index not in trip:
-                continue
-
-            if trip[trip_index] >= result[j][2]:
-                new_leg = [trip_index, new_leg[1], trip[trip_index],
-                           new_leg[3], new_leg[4], new_leg[5]]
-                low_i = j
-
-        route_new.append(new_leg)
-
-    route_new.reverse()
-    for con in route_new:
+    for con in result:
         if con[4] != last_detail or detail is True:
-            path.append(con)
+            path.append(list(con))
         else:
             last_con = path[-1]
             last_con[3] = con[3]
@@ -804,10 +2771,14 @@ def process_path(result: list[tuple], start: str, end: str,
 def save_image(route_type: RouteType, every_route_time: list,
                BASE_PATH, version1, version2,
                PNG_PATH, departure_time,
-               show=False, map_link: str = None) -> tuple[Image.Image, str]:
+               show=False, map_link: str = None,
+               budget: Budget = None) -> tuple[Image.Image, str]:
     '''
     Save image of the route.
     '''
+    if budget is not None:
+        budget.check()
+
     pattern = []
     pattern.append(
         (ImagePattern.TEXT,
@@ -842,7 +2813,8 @@ def save_image(route_type: RouteType, every_route_time: list,
     # 总时长从出发时间开始算，不从发车时间开始算
     full_time = every_route_time[-1][6] - departure_time
     return generate_image(pattern, route_type, BASE_PATH,
-                          version1, version2, full_time, show, map_link)
+                          version1, version2, full_time, show, map_link,
+                          budget)
 
 
 def calculate_height_width(pattern: list[list[ImagePattern]],
@@ -907,7 +2879,8 @@ def draw_text(draw: ImageDraw.ImageDraw, xy: tuple[int, int], text: str,
 
 def generate_image(pattern, route_type, BASE_PATH, version1, version2,
                    shortest_distance,
-                   show: bool = False, map_link: str = None) -> tuple[Image.Image, str]:
+                   show: bool = False, map_link: str = None,
+                   budget: Budget = None) -> tuple[Image.Image, str]:
     '''
     Generate the image with PIL.
     '''
@@ -943,6 +2916,9 @@ def generate_image(pattern, route_type, BASE_PATH, version1, version2,
     last_colour = ''
     station_y = []
     for i, pat in enumerate(pattern):
+        if budget is not None:
+            budget.check()
+
         if pat[0] == ImagePattern.OR:
             draw_text(draw, (30, y), '或', 'black', fonts, 20)
             draw_text(draw, (30, y + 30), 'or', 'black', fonts, 20)
@@ -1012,6 +2988,9 @@ def generate_image(pattern, route_type, BASE_PATH, version1, version2,
         draw_text(draw, (10, y), f'地图链接 Map Link: {map_link}',
                   'blue', fonts, 16)
 
+    if budget is not None:
+        budget.check()
+
     output_buffer = BytesIO()
     image.save(output_buffer, 'png')
     if show is True:
@@ -1033,6 +3012,49 @@ def generate_image(pattern, route_type, BASE_PATH, version1, version2,
     return image, base64_str
 
 
+def query_time(departure_time: Optional[int], tz: int) -> int:
+    '''
+    Get the departure time of a query in seconds since midnight,
+    the current time in timezone tz if departure_time is None.
+    '''
+    if departure_time is None:
+        dtz = timezone(timedelta(hours=tz))
+        t1 = datetime.now().replace(year=1970, month=1, day=1)
+        try:
+            t1 = t1.astimezone(dtz).replace(tzinfo=timezone.utc)
+        except OSError:
+            t1 = t1.replace(tzinfo=timezone.utc)
+
+        departure_time = round(t1.timestamp())
+        departure_time += 10  # 寻路时间
+
+    return departure_time % 86400
+
+
+def load_query_data(LINK: str, LOCAL_FILE_PATH, DEP_PATH, MAX_WILD_BLOCKS,
+                    UPDATE_DATA: bool, GEN_DEPARTURE: bool,
+                    data_ttl: int = DATA_TTL, data: dict = None) -> dict:
+    '''
+    Get the station data of a query and make sure the departures exist.
+    '''
+    if LINK.endswith('/index.html'):
+        LINK = LINK.rstrip('/index.html')
+
+    if LINK == '':
+        raise ValueError('Railway System Map link is empty')
+
+    if data is None:
+        data = load_data(LINK, LOCAL_FILE_PATH, MAX_WILD_BLOCKS,
+                         UPDATE_DATA, data_ttl)
+
+    if GEN_DEPARTURE is True or (not os.path.exists(DEP_PATH)):
+        with refresh_lock(DEP_PATH):
+            if GEN_DEPARTURE is True or (not os.path.exists(DEP_PATH)):
+                gen_departure(LINK, DEP_PATH)
+
+    return data
+
+
 def main(station1: str, station2: str, LINK: str,
          LOCAL_FILE_PATH, DEP_PATH, BASE_PATH, PNG_PATH,
          MAX_WILD_BLOCKS: int = 1500,
@@ -1046,7 +3068,16 @@ def main(station1: str, station2: str, LINK: str,
          CALCULATE_WALKING_WILD: bool = False, ONLY_LRT: bool = False,
          DETAIL: bool = False, MAX_HOUR=3, timetable=None, gen_image=True,
          show=False, departure_time=None, tz=0,
-         timeout_min=2, map_link: str = None) -> Union[tuple[Image.Image, str], bool, None]:
+         timeout_min=2, map_link: str = None,
+         data_ttl: int = DATA_TTL,
+         data: dict = None, window_min: int = 0,
+         MAX_TRANSFERS: int = None, PREFER_LESS_TRANSFER: bool = False,
+         engine: Engine = Engine.CSA, arrival_time: int = None,
+         goal_directed: bool = False, budget: Budget = None,
+         alternatives: int = 0, MIN_CHANGE_TIME: int = 0,
+         CHANGE_TIME: dict[str, int] = {}, TRANSFER_PENALTY: int = 0,
+         WILD_PENALTY: int = 0
+         ) -> Union[tuple[Image.Image, str], list, bool, None]:
     '''
     Main function. You can call it in your own code.
     Output:
@@ -1056,36 +3087,60 @@ def main(station1: str, station2: str, LINK: str,
     
     Parameters:
     map_link -- Map link to display in the image (optional)
+    data_ttl -- Seconds before the station data is revalidated (optional)
+    data -- Station data already loaded, used instead of LOCAL_FILE_PATH
+    (optional)
+    timetable -- Route timetables from gen_timetable() or a compiled
+    Timetable (optional)
+    window_min -- If it is given, return a list with every journey that
+    leaves within window_min minutes and is not beaten by a later one,
+    instead of only the earliest arrival (optional)
+    MAX_TRANSFERS -- Maximum number of transfers between rides, at most
+    MAX_BAG_SIZE - 1 with Engine.CSA (optional)
+    PREFER_LESS_TRANSFER -- Return the journey with the fewest transfers
+    instead of the earliest arrival (optional)
+    engine -- Engine.CSA or Engine.RAPTOR, the routing algorithm (optional)
+    arrival_time -- If it is given, find the latest departure that still
+    arrives by arrival_time, in seconds since midnight. Only supported
+    with Engine.CSA and without MAX_TRANSFERS, PREFER_LESS_TRANSFER or
+    goal_directed, otherwise ValueError is raised (optional)
+    goal_directed -- Skip the connections that cannot beat the best
+    arrival by a straight-line lower bound, same results (optional)
+    budget -- Budget of the whole query, from the timetable to the image.
+    Call budget.cancel() from another thread to stop the query with
+    QueryCancelled. Without it, only the pathfinding is limited to
+    timeout_min minutes (optional)
+    alternatives -- If it is given, return a list with up to alternatives
+    journeys instead of one. The first one is the usual result, each next
+    one is found by scanning the same timetable again from just after the
+    previous one leaves, and a journey that leaves later but arrives as
+    early replaces the previous one (with PREFER_LESS_TRANSFER, only if it
+    has as few rides). Not used with arrival_time or window_min (optional)
+    MIN_CHANGE_TIME -- Seconds needed to change trains in a station, also
+    before and after every walk (optional)
+    CHANGE_TIME -- Station names and their own minimum change times,
+    used instead of MIN_CHANGE_TIME (optional)
+    TRANSFER_PENALTY -- Seconds added to every out-of-station transfer
+    (optional)
+    WILD_PENALTY -- Seconds added to every wild walk (optional)
     '''
-    if departure_time is None:
-        dtz = timezone(timedelta(hours=tz))
-        t1 = datetime.now().replace(year=1970, month=1, day=1)
-        try:
-            t1 = t1.astimezone(dtz).replace(tzinfo=timezone.utc)
-        except OSError:
-            t1 = t1.replace(tzinfo=timezone.utc)
-
-        departure_time = round(t1.timestamp())
-        departure_time += 10  # 寻路时间
-
-    departure_time %= 86400
-
-    IGNORED_LINES += ORIGINAL_IGNORED_LINES
+    if engine == Engine.CSA and MAX_TRANSFERS is not None and \
+            MAX_TRANSFERS >= MAX_BAG_SIZE:
+        raise ValueError(f'MAX_TRANSFERS must be less than {MAX_BAG_SIZE}')
+
+    # 反向寻路只有单目标的 CSA，不支持这些设置
+    if arrival_time is not None and (
+            engine != Engine.CSA or MAX_TRANSFERS is not None or
+            PREFER_LESS_TRANSFER is True or goal_directed is True):
+        raise ValueError('arrival_time only supports Engine.CSA without '
+                         'MAX_TRANSFERS, PREFER_LESS_TRANSFER or '
+                         'goal_directed')
+
+    departure_time = query_time(departure_time, tz)
+    IGNORED_LINES = IGNORED_LINES + ORIGINAL_IGNORED_LINES
     STATION_TABLE = {x.lower(): y.lower() for x, y in STATION_TABLE.items()}
-    if LINK.endswith('/index.html'):
-        LINK = LINK.rstrip('/index.html')
-
-    if LINK == '':
-        raise ValueError('Railway System Map link is empty')
-    
-    data = fetch_data(LINK, LOCAL_FILE_PATH, MAX_WILD_BLOCKS)
-    
-    if GEN_DEPARTURE is True or (not os.path.exists(DEP_PATH)):
-        if LINK == '':
-            raise ValueError('Railway System Map link is empty')
-        
-        gen_departure(LINK, DEP_PATH)
-
+    data = load_query_data(LINK, LOCAL_FILE_PATH, DEP_PATH, MAX_WILD_BLOCKS,
+                           UPDATE_DATA, GEN_DEPARTURE, data_ttl, data)
     version1 = strftime('%Y%m%d-%H%M',
                         gmtime(os.path.getmtime(LOCAL_FILE_PATH)))
     version2 = strftime('%Y%m%d-%H%M',
@@ -1093,29 +3148,128 @@ def main(station1: str, station2: str, LINK: str,
 
     route_type = RouteType.REAL_TIME
     if timetable is None:
-        timetable = gen_timetable(
+        timetable = load_timetable(
             data, IGNORED_LINES, CALCULATE_HIGH_SPEED, CALCULATE_BOAT,
             CALCULATE_WALKING_WILD, ONLY_LRT, AVOID_STATIONS, route_type,
             ORIGINAL_IGNORED_LINES, DEP_PATH, version1, version2,
-            STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION)
+            STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION, budget,
+            MIN_CHANGE_TIME, CHANGE_TIME, TRANSFER_PENALTY, WILD_PENALTY)
+    elif not isinstance(timetable, Timetable):
+        timetable = compile_timetable(
+            timetable, DEP_PATH, True,
+            station_change_times(data, MIN_CHANGE_TIME, CHANGE_TIME,
+                                 STATION_TABLE),
+            TRANSFER_PENALTY, WILD_PENALTY)
+
+    tt = timetable.start_walks(
+        load_tt(data, station1, station2, departure_time,
+                STATION_TABLE, TRANSFER_ADDITION,
+                CALCULATE_WALKING_WILD, WILD_ADDITION, budget))
 
-    tt, trips = load_tt(timetable, data, station1, station2, departure_time,
-                        DEP_PATH, STATION_TABLE, TRANSFER_ADDITION,
-                        CALCULATE_WALKING_WILD, WILD_ADDITION, MAX_HOUR)
-
-    csa = CSA(len(data['stations']), tt, timeout_min)
     s1 = station_name_to_id(data, station1, STATION_TABLE)
     s2 = station_name_to_id(data, station2, STATION_TABLE)
     if s1 is None or s2 is None:
         return None
 
-    s1 = int('0x' + data['stations'][s1]['station'], 16)
-    s2 = int('0x' + data['stations'][s2]['station'], 16)
-    result = csa.compute(s1, s2, departure_time)
+    s1 = data['stations'][s1]['station']
+    s2 = data['stations'][s2]['station']
+    lower_bound = None
+    if goal_directed is True:
+        lower_bound = lower_bounds(data, timetable, s2)
+
+    journeys = None
+
+    with borrow_csa(len(data['stations']), timetable, timeout_min,
+                    budget) as csa:
+        if arrival_time is not None:
+            # 到达时间在凌晨时，使用第二天的时刻表
+            arrival_time %= 86400
+            if arrival_time < MAX_HOUR * 60 * 60:
+                arrival_time += 86400
+
+            result = csa.compute_latest(s1, s2,
+                                        arrival_time + timetable.change(s2),
+                                        arrival_time - MAX_HOUR * 60 * 60, tt)
+            if result != []:
+                departure_time = result[0][2]
+        elif window_min > 0:
+            last_departure = departure_time + window_min * 60
+            journeys = csa.profile(s1, s2, departure_time, last_departure,
+                                   last_departure + MAX_HOUR * 60 * 60, tt)
+        else:
+            raptor = None
+            if engine == Engine.RAPTOR:
+                raptor = Raptor(len(data['stations']), timetable,
+                                timeout_min)
+                raptor.budget = budget
+
+            if alternatives > 0:
+                journeys = []
+
+            t = departure_time
+            walks = tt
+            while True:
+                end_time = t + MAX_HOUR * 60 * 60
+                if raptor is not None:
+                    max_rides = None if MAX_TRANSFERS is None \
+                        else MAX_TRANSFERS + 1
+                    result = raptor.compute(s1, s2, t, end_time, walks,
+                                            max_rides, PREFER_LESS_TRANSFER)
+                elif PREFER_LESS_TRANSFER is True:
+                    max_rides = MAX_BAG_SIZE if MAX_TRANSFERS is None \
+                        else MAX_TRANSFERS + 1
+                    result = csa.compute_mc(s1, s2, t, end_time, walks,
+                                            max_rides, True, lower_bound)
+                else:
+                    result = csa.compute(s1, s2, t, end_time, walks,
+                                         lower_bound)
+                    # 最早到达的路线没有超过换乘次数限制时，它也是限制下的最优解，
+                    # 不必再做更慢的多目标寻路
+                    if MAX_TRANSFERS is not None and \
+                            journey_rides(result) > MAX_TRANSFERS + 1:
+                        result = csa.compute_mc(s1, s2, t, end_time, walks,
+                                                MAX_TRANSFERS + 1, False,
+                                                lower_bound)
+
+                if alternatives == 0 or result == []:
+                    break
+
+                # 晚出发也能同样早到达时，替换上一条路线
+                # 优先少换乘时，还要求乘车次数不多于上一条
+                if journeys != [] and \
+                        result[-1][3] <= journeys[-1][-1][3] and \
+                        (PREFER_LESS_TRANSFER is False or
+                         journey_rides(result) <= journey_rides(journeys[-1])):
+                    journeys[-1] = result
+                else:
+                    journeys.append(result)
+
+                t = leave_time(result)
+                if len(journeys) >= alternatives or t is None or \
+                        t >= departure_time + MAX_HOUR * 60 * 60:
+                    break
+
+                # 从上一条路线出发后一秒重新寻路
+                t += 1
+                walks = shift_walks(tt, t)
+
+    if journeys is not None:
+        if journeys == []:
+            return False
+
+        erts = [process_path(timetable.real_legs(x), station1, station2,
+                             data, DETAIL, STATION_TABLE) for x in journeys]
+        if gen_image is False:
+            return erts
+
+        return [save_image(route_type, ert, BASE_PATH, version1, version2,
+                           PNG_PATH, ert[0][5], show, map_link, budget)
+                for ert in erts]
+
     if result == []:
         return False
 
-    ert = process_path(result, station1, station2, trips,
+    ert = process_path(timetable.real_legs(result), station1, station2,
                        data, DETAIL, STATION_TABLE)
 
     if gen_image is False:
@@ -1125,7 +3279,241 @@ def main(station1: str, station2: str, LINK: str,
         return ert[0]
 
     return save_image(route_type, ert, BASE_PATH, version1, version2,
-                      PNG_PATH, departure_time, show, map_link)
+                      PNG_PATH, departure_time, show, map_link, budget)
+
+
+def isochrone(station: str, LINK: str, LOCAL_FILE_PATH, DEP_PATH,
+              MAX_WILD_BLOCKS: int = 1500,
+              TRANSFER_ADDITION: dict[str, list[str]] = {},
+              WILD_ADDITION: dict[str, list[str]] = {},
+              STATION_TABLE: dict[str, str] = {},
+              ORIGINAL_IGNORED_LINES: list = [], UPDATE_DATA: bool = False,
+              GEN_DEPARTURE: bool = False, IGNORED_LINES: list = [],
+              AVOID_STATIONS: list = [],
+              CALCULATE_HIGH_SPEED: bool = True, CALCULATE_BOAT: bool = True,
+              CALCULATE_WALKING_WILD: bool = False, ONLY_LRT: bool = False,
+              max_min: int = 30, band_min: int = 10, timetable=None,
+              departure_time=None, tz=0, timeout_min=2,
+              data_ttl: int = DATA_TTL, data: dict = None,
+              budget: Budget = None, MIN_CHANGE_TIME: int = 0,
+              CHANGE_TIME: dict[str, int] = {}, TRANSFER_PENALTY: int = 0,
+              WILD_PENALTY: int = 0
+              ) -> Optional[list[list[tuple[str, int]]]]:
+    '''
+    Get every station reachable from station within max_min minutes,
+    grouped into bands of band_min minutes.
+    Output:
+    None -- Incorrect station name 车站输入错误，请重新输入
+    else 其他 -- One list per band, the first band is the stations
+    reached within band_min minutes, each is a list of
+    (station name, minutes) sorted by minutes
+
+    Parameters:
+    budget -- Budget of the whole query, see main() (optional)
+    MIN_CHANGE_TIME, CHANGE_TIME, TRANSFER_PENALTY, WILD_PENALTY --
+    Change times and penalties, see main() (optional)
+    '''
+    departure_time = query_time(departure_time, tz)
+    IGNORED_LINES = IGNORED_LINES + ORIGINAL_IGNORED_LINES
+    STATION_TABLE = {x.lower(): y.lower() for x, y in STATION_TABLE.items()}
+    data = load_query_data(LINK, LOCAL_FILE_PATH, DEP_PATH, MAX_WILD_BLOCKS,
+                           UPDATE_DATA, GEN_DEPARTURE, data_ttl, data)
+    s1 = station_name_to_id(data, station, STATION_TABLE)
+    if s1 is None:
+        return None
+
+    if timetable is None:
+        timetable = load_timetable(
+            data, IGNORED_LINES, CALCULATE_HIGH_SPEED, CALCULATE_BOAT,
+            CALCULATE_WALKING_WILD, ONLY_LRT, AVOID_STATIONS,
+            RouteType.REAL_TIME, ORIGINAL_IGNORED_LINES, DEP_PATH, '', '',
+            STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION, budget,
+            MIN_CHANGE_TIME, CHANGE_TIME, TRANSFER_PENALTY, WILD_PENALTY)
+    elif not isinstance(timetable, Timetable):
+        timetable = compile_timetable(
+            timetable, DEP_PATH, True,
+            station_change_times(data, MIN_CHANGE_TIME, CHANGE_TIME,
+                                 STATION_TABLE),
+            TRANSFER_PENALTY, WILD_PENALTY)
+
+    tt = timetable.start_walks(
+        load_tt(data, station, station, departure_time,
+                STATION_TABLE, TRANSFER_ADDITION,
+                CALCULATE_WALKING_WILD, WILD_ADDITION, budget))
+    s1 = data['stations'][s1]['station']
+    with borrow_csa(len(data['stations']), timetable, timeout_min,
+                    budget) as csa:
+        earliest_arrival = csa.compute_all(
+            s1, departure_time, departure_time + max_min * 60, tt)
+        reached = [(i, x - timetable.change(i))
+                   for i, x in enumerate(earliest_arrival) if x != MAX_INT]
+
+    bands: list[list[tuple[str, int]]] = \
+        [[] for _ in range(-(-max_min // band_min))]
+    for i, arr in reached:
+        if i == s1:
+            continue
+
+        minutes = -(-(arr - departure_time) // 60)
+        if minutes > max_min:
+            continue
+
+        bands[max(minutes - 1, 0) // band_min].append(
+            (station_num_to_name(data, i), minutes))
+
+    for band in bands:
+        band.sort(key=lambda x: (x[1], natural_keys(x[0])))
+
+    return bands
+
+
+# 进程池中每个进程的寻路器
+matrix_csa: Optional[CSA] = None
+
+
+def init_matrix_worker(max_stations: int, timetable: Timetable,
+                       timeout_min) -> None:
+    '''
+    Keep one CSA per worker process of travel_time_matrix().
+    '''
+    global matrix_csa
+    matrix_csa = CSA(max_stations, timetable, timeout_min)
+
+
+def matrix_row(origin: int, destinations: list[int], departure_time: int,
+               end_time: int, walks: list[tuple],
+               csa: CSA = None) -> tuple[list[int], list[int]]:
+    '''
+    Scan once from origin and get the arrival time and the number of
+    transfers to every destination, -1 if it is unreachable.
+    '''
+    if csa is None:
+        csa = matrix_csa
+
+    earliest_arrival = csa.compute_all(origin, departure_time, end_time,
+                                       walks)
+    arrivals = []
+    transfers = []
+    for station in destinations:
+        if station == origin:
+            arrivals.append(departure_time)
+            transfers.append(0)
+        elif earliest_arrival[station] == MAX_INT:
+            arrivals.append(-1)
+            transfers.append(-1)
+        else:
+            arrivals.append(earliest_arrival[station] -
+                            csa.timetable.change(station))
+            rides = sum(1 for x in csa.find_path(station) if len(x) > 5)
+            transfers.append(max(rides - 1, 0))
+
+    return arrivals, transfers
+
+
+def travel_time_matrix(origins: list[str], destinations: list[str],
+                       LINK: str, LOCAL_FILE_PATH, DEP_PATH,
+                       MAX_WILD_BLOCKS: int = 1500,
+                       TRANSFER_ADDITION: dict[str, list[str]] = {},
+                       WILD_ADDITION: dict[str, list[str]] = {},
+                       STATION_TABLE: dict[str, str] = {},
+                       ORIGINAL_IGNORED_LINES: list = [],
+                       UPDATE_DATA: bool = False,
+                       GEN_DEPARTURE: bool = False, IGNORED_LINES: list = [],
+                       AVOID_STATIONS: list = [],
+                       CALCULATE_HIGH_SPEED: bool = True,
+                       CALCULATE_BOAT: bool = True,
+                       CALCULATE_WALKING_WILD: bool = False,
+                       ONLY_LRT: bool = False, MAX_HOUR=3, timetable=None,
+                       departure_time=None, tz=0, timeout_min=2,
+                       data_ttl: int = DATA_TTL, data: dict = None,
+                       processes: int = 0,
+                       budget: Budget = None, MIN_CHANGE_TIME: int = 0,
+                       CHANGE_TIME: dict[str, int] = {},
+                       TRANSFER_PENALTY: int = 0,
+                       WILD_PENALTY: int = 0) -> Optional[tuple]:
+    '''
+    Get the arrival times and the numbers of transfers from every origin
+    to every destination, with one scan per origin on a shared timetable.
+    Output:
+    None -- Incorrect station name(s) 车站输入错误，请重新输入
+    else 其他 -- (arrivals, transfers), one row per origin and one column
+    per destination, -1 if it is unreachable. The arrival times are in
+    seconds since midnight of the departure day. They are NumPy arrays if
+    NumPy is installed, else lists of array.
+
+    Parameters:
+    processes -- If it is more than 1, scan the origins in a pool of
+    processes (optional)
+    budget -- Budget of the whole query, see main(). With processes,
+    it is checked between the rows (optional)
+    MIN_CHANGE_TIME, CHANGE_TIME, TRANSFER_PENALTY, WILD_PENALTY --
+    Change times and penalties, see main() (optional)
+    '''
+    departure_time = query_time(departure_time, tz)
+    IGNORED_LINES = IGNORED_LINES + ORIGINAL_IGNORED_LINES
+    STATION_TABLE = {x.lower(): y.lower() for x, y in STATION_TABLE.items()}
+    data = load_query_data(LINK, LOCAL_FILE_PATH, DEP_PATH, MAX_WILD_BLOCKS,
+                           UPDATE_DATA, GEN_DEPARTURE, data_ttl, data)
+    stations = []
+    for name in origins + destinations:
+        station_id = station_name_to_id(data, name, STATION_TABLE)
+        if station_id is None:
+            return None
+
+        stations.append(data['stations'][station_id]['station'])
+
+    if timetable is None:
+        timetable = load_timetable(
+            data, IGNORED_LINES, CALCULATE_HIGH_SPEED, CALCULATE_BOAT,
+            CALCULATE_WALKING_WILD, ONLY_LRT, AVOID_STATIONS,
+            RouteType.REAL_TIME, ORIGINAL_IGNORED_LINES, DEP_PATH, '', '',
+            STATION_TABLE, WILD_ADDITION, TRANSFER_ADDITION, budget,
+            MIN_CHANGE_TIME, CHANGE_TIME, TRANSFER_PENALTY, WILD_PENALTY)
+    elif not isinstance(timetable, Timetable):
+        timetable = compile_timetable(
+            timetable, DEP_PATH, True,
+            station_change_times(data, MIN_CHANGE_TIME, CHANGE_TIME,
+                                 STATION_TABLE),
+            TRANSFER_PENALTY, WILD_PENALTY)
+
+    end_time = departure_time + MAX_HOUR * 60 * 60
+    targets = stations[len(origins):]
+    tasks = [(origin, targets, departure_time, end_time,
+              timetable.start_walks(
+                  load_tt(data, name, name, departure_time, STATION_TABLE,
+                          TRANSFER_ADDITION, CALCULATE_WALKING_WILD,
+                          WILD_ADDITION, budget)))
+             for name, origin in zip(origins, stations)]
+    max_stations = len(data['stations'])
+    if processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(processes, initializer=init_matrix_worker,
+                                 initargs=(max_stations, timetable,
+                                           timeout_min)) as executor:
+            rows = []
+            futures = [executor.submit(matrix_row, *task) for task in tasks]
+            try:
+                for future in futures:
+                    while budget is not None and not future.done():
+                        budget.check()
+                        wait([future], 1)
+
+                    rows.append(future.result())
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    else:
+        with borrow_csa(max_stations, timetable, timeout_min,
+                        budget) as csa:
+            rows = [matrix_row(*task, csa) for task in tasks]
+
+    if np is not None:
+        shape = (len(origins), len(destinations))
+        return (np.array([x[0] for x in rows], np.int64).reshape(shape),
+                np.array([x[1] for x in rows], np.int16).reshape(shape))
+
+    return ([array('q', x[0]) for x in rows],
+            [array('h', x[1]) for x in rows])
 
 
 def run():
@@ -1173,6 +3561,14 @@ def run():
     CALCULATE_WALKING_WILD: bool = False
     # 仅允许轻轨，默认值为False
     ONLY_LRT: bool = False
+    # 同站换乘以及步行前后的最短换乘时间（秒），默认值为0
+    MIN_CHANGE_TIME: int = 0
+    # 单独设置车站的最短换乘时间
+    # "车站: 秒数, ..."
+    CHANGE_TIME: dict[str, int] = {}
+    # 每次出站换乘、非出站换乘（越野）额外增加的时间（秒），默认值为0
+    TRANSFER_PENALTY: int = 0
+    WILD_PENALTY: int = 0
 
     # 出发时间（秒，0-86400），默认值为None，即当前时间后10秒
     DEP_TIME = None
@@ -1189,7 +3585,9 @@ def run():
          ORIGINAL_IGNORED_LINES, UPDATE_DATA, GEN_DEPARTURE,
          IGNORED_LINES, AVOID_STATIONS, CALCULATE_HIGH_SPEED,
          CALCULATE_BOAT, CALCULATE_WALKING_WILD, ONLY_LRT, DETAIL, MAX_HOUR,
-         show=True, departure_time=DEP_TIME)
+         show=True, departure_time=DEP_TIME,
+         MIN_CHANGE_TIME=MIN_CHANGE_TIME, CHANGE_TIME=CHANGE_TIME,
+         TRANSFER_PENALTY=TRANSFER_PENALTY, WILD_PENALTY=WILD_PENALTY)
 
 
 if __name__ == '__main__':
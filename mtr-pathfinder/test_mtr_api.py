@@ -0,0 +1,93 @@
+from threading import Thread
+from time import perf_counter
+import json
+import tempfile
+
+from mtr_api import make_server, map_api, MapClient, save_snapshot
+
+# 本地快照服务器，不访问在线线路图
+LINK: str = 'http://127.0.0.1'
+# 足够大、可以压缩的响应
+BODY: bytes = json.dumps(
+    {'data': {'stations': [{'id': str(i), 'name': f'站{i}'}
+                           for i in range(2000)]}}).encode('utf-8')
+
+
+def make_snapshot() -> tempfile.TemporaryDirectory:
+    snapshot_dir = tempfile.TemporaryDirectory()
+    save_snapshot(snapshot_dir.name, map_api(LINK, 'departures'), BODY)
+    return snapshot_dir
+
+
+def start_server(snapshot_dir: str, unavailable: int = 0):
+    server = make_server(snapshot_dir, '127.0.0.1', 0,
+                         unavailable=unavailable)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{LINK}:{server.server_address[1]}'
+
+
+def test_retry_after() -> None:
+    with make_snapshot() as snapshot_dir:
+        server, link = start_server(snapshot_dir, unavailable=1)
+        with server:
+            client = MapClient()
+            start = perf_counter()
+            r = client.get(map_api(link, 'departures'))
+            elapsed = perf_counter() - start
+            server.shutdown()
+
+        stats = client.stats()
+        assert r.status_code == 200
+        assert elapsed >= 1, elapsed  # Retry-After: 1
+        assert stats['requests'] == 2 and stats['retries'] == 1
+        assert stats['failures'] == 1
+
+
+def test_gzip_bytes() -> None:
+    with make_snapshot() as snapshot_dir:
+        server, link = start_server(snapshot_dir)
+        with server:
+            client = MapClient()
+            r = client.get(map_api(link, 'departures'))
+            server.shutdown()
+
+        stats = client.stats()
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert r.content == BODY
+        assert stats['bytes_decoded'] == len(BODY)
+        assert 0 < stats['bytes_received'] < stats['bytes_decoded']
+
+
+def test_etag() -> None:
+    with make_snapshot() as snapshot_dir:
+        server, link = start_server(snapshot_dir)
+        with server:
+            client = MapClient()
+            url = map_api(link, 'departures')
+            r1 = client.get(url)
+            r2 = client.get(url, {'If-None-Match': r1.headers['ETag']})
+            r3 = client.get(url, {'If-None-Match': '"stale"'})
+            server.shutdown()
+
+        assert r1.status_code == 200 and r1.headers['ETag']
+        assert r2.status_code == 304 and r2.content == b''
+        assert r3.status_code == 200 and r3.content == BODY
+
+
+def test_replay() -> None:
+    with make_snapshot() as snapshot_dir:
+        client = MapClient()
+        client.replay(snapshot_dir)
+        url = map_api('http://example.invalid', 'departures')
+        r1 = client.get(url)
+        r2 = client.get(url, {'If-None-Match': r1.headers['ETag']})
+        r3 = client.get(map_api('http://example.invalid', 'missing'))
+        assert r1.status_code == 200 and r1.content == BODY
+        assert r2.status_code == 304
+        assert r3.status_code == 404
+
+
+if __name__ == '__main__':
+    for test in (test_retry_after, test_gzip_bytes, test_etag, test_replay):
+        test()
+        print(f'{test.__name__}: OK')
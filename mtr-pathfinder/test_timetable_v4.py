@@ -0,0 +1,76 @@
+import copy
+import gc
+import json
+import os
+import tempfile
+import weakref
+
+from bench_v4 import gen_map, MAX_WILD_BLOCKS
+from mtr_pathfinder_v4 import borrow_csa, load_timetable, process_data, \
+    RouteType
+import mtr_pathfinder_v4
+
+# 生成的线路图的车站数量
+STATIONS: int = 40
+
+
+def make_data(tmp: str) -> tuple[dict, str]:
+    raw = gen_map(STATIONS)
+    data = process_data(copy.deepcopy(raw), MAX_WILD_BLOCKS)
+    dep_path = os.path.join(tmp, 'departures.json')
+    with open(dep_path, 'w', encoding='utf-8') as f:
+        json.dump({route['id']: list(range(0, 86400, 600))
+                   for route in raw['routes']}, f)
+
+    return data, dep_path
+
+
+def load(data: dict, dep_path: str, high_speed: bool):
+    # 不计算船的路线时不使用时刻表缓存文件
+    return load_timetable(data, [], high_speed, False, False, False, [],
+                          RouteType.REAL_TIME, [], dep_path, '', '',
+                          {}, {}, {})
+
+
+def test_reuse_csa() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        data, dep_path = make_data(tmp)
+        try:
+            timetable = load(data, dep_path, True)
+            assert load(data, dep_path, True) is timetable
+            with borrow_csa(STATIONS, timetable) as csa1:
+                pass
+            with borrow_csa(STATIONS, timetable) as csa2:
+                pass
+        finally:
+            mtr_pathfinder_v4.compiled_timetables.clear()
+
+        assert csa1 is csa2
+        assert timetable.csa_pool == [csa1]
+
+
+def test_evicted_timetable_collected() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        data, dep_path = make_data(tmp)
+        limit = mtr_pathfinder_v4.MAX_COMPILED_TIMETABLES
+        mtr_pathfinder_v4.MAX_COMPILED_TIMETABLES = 1
+        try:
+            timetable = load(data, dep_path, True)
+            with borrow_csa(STATIONS, timetable) as csa:
+                assert csa.timetable is timetable
+
+            ref = weakref.ref(timetable)
+            del timetable, csa
+            # 编译另一个设置的时刻表，淘汰第一个时刻表
+            load(data, dep_path, False)
+            gc.collect()
+            assert ref() is None
+        finally:
+            mtr_pathfinder_v4.MAX_COMPILED_TIMETABLES = limit
+            mtr_pathfinder_v4.compiled_timetables.clear()
+
+
+if __name__ == '__main__':
+    for test in (test_reuse_csa, test_evicted_timetable_collected):
+        test()
+        print(f'{test.__name__}: OK')
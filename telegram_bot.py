@@ -1,11 +1,13 @@
+import asyncio
 import os
 import sys
 import hashlib
 import json
 import logging
+import time
 from datetime import datetime
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
 
 load_dotenv()
@@ -60,15 +62,25 @@ class UserDataManager:
 user_data_manager = UserDataManager(DATA_FILE)
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'mtr-pathfinder'))
-from mtr_pathfinder_v4 import main, station_name_to_id, station_num_to_name
+from mtr_pathfinder_v4 import MAX_BAG_SIZE, Budget, QueryCancelled, gen_departure, isochrone, load_data, main, station_name_to_id, station_num_to_name
 
 LINK = 'http://leonmmcoset.jjxmm.win:8888'
 MAX_WILD_BLOCKS = 1500
 MAX_HOUR = 3
+STATION_REFRESH_INTERVAL = 300      # 车站数据刷新间隔，单位 s
+DEPARTURE_REFRESH_INTERVAL = 1800   # 发车数据刷新间隔，单位 s
+QUERY_TIMEOUT = 120                 # 每次查询（含生成时刻表和图片）的最长时间，单位 s
+ALTERNATIVES = 5                    # 每次查询最多给出的路线数
+MAX_SAVED_JOURNEYS = 5              # 每个用户保留可翻页的查询结果数
+MAX_TRANSFERS_LIMIT = MAX_BAG_SIZE - 1  # 最大换乘设置的上限，受多目标寻路的乘车次数限制
+
+
+def get_data_paths(link):
+    link_hash = hashlib.md5(link.encode('utf-8')).hexdigest()
+    return (os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json'),
+            os.path.join('mtr-pathfinder', f'mtr-route-data-{link_hash}-mtr4-v4.json'))
+
 
-link_hash = hashlib.md5(LINK.encode('utf-8')).hexdigest()
-LOCAL_FILE_PATH = os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json')
-DEP_PATH = os.path.join('mtr-pathfinder', f'mtr-route-data-{link_hash}-mtr4-v4.json')
 BASE_PATH = os.path.join('mtr-pathfinder', 'mtr_pathfinder_data')
 PNG_PATH = os.path.join('mtr-pathfinder', 'mtr_pathfinder_data')
 
@@ -86,26 +98,184 @@ CALCULATE_HIGH_SPEED = True
 CALCULATE_BOAT = True
 CALCULATE_WALKING_WILD = False
 ONLY_LRT = False
+MIN_CHANGE_TIME = 30                # 同站换乘以及步行前后的最短换乘时间，单位 s
+CHANGE_TIME = {}                    # 单独设置车站的最短换乘时间，"车站: 秒数"
+TRANSFER_PENALTY = 0                # 每次出站换乘额外增加的时间，单位 s
+WILD_PENALTY = 0                    # 每次非出站换乘（越野）额外增加的时间，单位 s
 
-START_STATION, END_STATION, ROUTE_NAME, DEL_ROUTE_NAME, SET_MAP_LINK = range(5)
+START_STATION, END_STATION, ROUTE_NAME, DEL_ROUTE_NAME, SET_MAP_LINK, ARRIVAL_TIME = range(6)
 
 
-def load_station_data(link=None):
-    if link is None:
-        link = LINK
-    
-    link_hash = hashlib.md5(link.encode('utf-8')).hexdigest()
-    local_file_path = os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json')
-    
-    if not os.path.exists(local_file_path):
+# 每个地图链接正在进行的数据刷新，键为 (地图链接, 'stations' 或 'departures')
+refresh_tasks = {}
+# 每个地图链接最新的车站数据
+station_snapshots = {}
+# 每个地图链接最新车站数据对应的本地文件版本 (修改时间, 大小)
+station_versions = {}
+# 每个地图链接的刷新状态
+refresh_status = {}
+
+
+def get_file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
         return None
     
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def get_refresh_status(link):
+    if link not in refresh_status:
+        refresh_status[link] = {
+            kind: {'updated': None, 'failures': 0, 'total_failures': 0, 'last_error': None}
+            for kind in ('stations', 'departures')
+        }
+    return refresh_status[link]
+
+
+async def run_refresh(link, kind):
+    local_file_path, dep_path = get_data_paths(link)
+    status = get_refresh_status(link)[kind]
     try:
-        with open(local_file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        if kind == 'stations':
+            # 车站数据用条件请求重新验证，没有变化时不会重新下载
+            data = await asyncio.to_thread(
+                load_data, link, local_file_path, MAX_WILD_BLOCKS, True, 0)
+            # 文件没有变化（304）时保留原来的对象，已编译的时刻表和缓冲区继续有效
+            version = get_file_version(local_file_path)
+            if link not in station_snapshots or version is None or \
+                    station_versions.get(link) != version:
+                station_snapshots[link] = data
+                station_versions[link] = version
+        else:
+            await asyncio.to_thread(gen_departure, link, dep_path)
     except Exception as e:
-        print(f'加载车站数据失败: {e}')
-        return None
+        status['failures'] += 1
+        status['total_failures'] += 1
+        status['last_error'] = str(e)
+        logger.error(f'刷新 {link} 的{"车站" if kind == "stations" else "发车"}数据失败'
+                     f'（连续 {status["failures"]} 次）：{e}')
+        raise
+    
+    status['updated'] = time.time()
+    status['failures'] = 0
+    logger.info(f'已刷新 {link} 的{"车站" if kind == "stations" else "发车"}数据')
+
+
+async def refresh_data(link, kind):
+    # 同一地图链接的同一种数据同时只刷新一次，其他调用等待同一个结果
+    key = (link, kind)
+    task = refresh_tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_refresh(link, kind))
+        refresh_tasks[key] = task
+        task.add_done_callback(lambda _: refresh_tasks.pop(key, None))
+    
+    await asyncio.shield(task)
+
+
+async def refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    link, kind = context.job.data
+    try:
+        await refresh_data(link, kind)
+    except Exception:
+        # 失败已记录在 refresh_status 中，下次定时任务会重试
+        pass
+
+
+def schedule_refresh(job_queue, link):
+    # 每个使用中的地图链接注册一次定时刷新任务
+    if job_queue is None:
+        return
+    
+    for kind, interval in (('stations', STATION_REFRESH_INTERVAL),
+                           ('departures', DEPARTURE_REFRESH_INTERVAL)):
+        name = f'refresh_{kind}_{link}'
+        if not job_queue.get_jobs_by_name(name):
+            job_queue.run_repeating(refresh_job, interval, first=0, data=(link, kind), name=name)
+
+
+def start_query(context: ContextTypes.DEFAULT_TYPE):
+    # 同一用户发起新查询时，放弃上一次未完成的查询
+    old = context.user_data.get('budget')
+    if old is not None:
+        old.cancel()
+    
+    budget = Budget(QUERY_TIMEOUT)
+    context.user_data['budget'] = budget
+    return budget
+
+
+def finish_query(context: ContextTypes.DEFAULT_TYPE, budget):
+    if context.user_data.get('budget') is budget:
+        del context.user_data['budget']
+
+
+def journey_keyboard(index, count):
+    buttons = []
+    if index > 0:
+        buttons.append(InlineKeyboardButton('◀ 上一条', callback_data=f'journey_{index - 1}'))
+    buttons.append(InlineKeyboardButton(f'{index + 1}/{count}', callback_data='journey_page'))
+    if index < count - 1:
+        buttons.append(InlineKeyboardButton('下一条 ▶', callback_data=f'journey_{index + 1}'))
+    return InlineKeyboardMarkup([buttons])
+
+
+async def reply_journeys(message, context: ContextTypes.DEFAULT_TYPE, result):
+    # 多条路线只发送一张图片，用按钮翻页
+    from io import BytesIO
+    import base64 as b64
+    images = [b64.b64decode(base64_str) for image, base64_str in result]
+    if len(images) == 1:
+        await message.reply_photo(photo=BytesIO(images[0]))
+        return
+    
+    sent = await message.reply_photo(photo=BytesIO(images[0]),
+                                     reply_markup=journey_keyboard(0, len(images)))
+    journeys = context.user_data.setdefault('journeys', {})
+    journeys[sent.message_id] = images
+    while len(journeys) > MAX_SAVED_JOURNEYS:
+        del journeys[next(iter(journeys))]
+
+
+async def journey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    page = query.data.split('_')[1]
+    if not page.isdigit():
+        await query.answer()
+        return
+    
+    index = int(page)
+    images = context.user_data.get('journeys', {}).get(query.message.message_id)
+    if images is None or index >= len(images):
+        await query.answer('查询结果已过期，请重新查询。')
+        return
+    
+    await query.answer()
+    from io import BytesIO
+    await query.edit_message_media(InputMediaPhoto(BytesIO(images[index])),
+                                   reply_markup=journey_keyboard(index, len(images)))
+
+
+async def get_station_data(context: ContextTypes.DEFAULT_TYPE, link):
+    # 使用内存中最新的车站数据，只有第一次使用该地图链接时才需要等待加载
+    schedule_refresh(context.job_queue, link)
+    updated = get_refresh_status(link)['stations']['updated']
+    if link not in station_snapshots or (
+            context.job_queue is None and time.time() - updated >= STATION_REFRESH_INTERVAL):
+        # 没有安装 JobQueue 时在查询时刷新
+        await refresh_data(link, 'stations')
+    
+    return station_snapshots[link]
+
+
+def get_links_in_use():
+    links = {LINK}
+    for user_data in user_data_manager.data.values():
+        if 'MAP_LINK' in user_data.get('settings', {}):
+            links.add(user_data['settings']['MAP_LINK'])
+    return links
 
 
 def get_user_settings(user_id):
@@ -118,7 +288,6 @@ def get_user_settings(user_id):
             'CALCULATE_WALKING_WILD': False,
             'ONLY_LRT': False,
             'MAX_HOUR': 3,
-            'MIN_HOUR': 0,
             'MAX_TRANSFERS': 10,
             'PREFER_FAST': True,
             'PREFER_LESS_TRANSFER': False,
@@ -127,20 +296,21 @@ def get_user_settings(user_id):
             'HISTORY_LIMIT': 10,
             'DEFAULT_DEPARTURE': 'current',
             'SHOW_MAP_LINK': True,
-            'AUTO_UPDATE': True,
             'SHOW_STATION_CODE': True
         }
         user_data_manager.update_user_data(user_id, user_data)
     else:
         settings = user_data['settings']
-        if 'MIN_HOUR' not in settings:
-            settings['MIN_HOUR'] = 0
         if 'MAX_TRANSFERS' not in settings:
             settings['MAX_TRANSFERS'] = 10
+        if settings['MAX_TRANSFERS'] > MAX_TRANSFERS_LIMIT:
+            settings['MAX_TRANSFERS'] = MAX_TRANSFERS_LIMIT
         if 'PREFER_FAST' not in settings:
             settings['PREFER_FAST'] = True
         if 'PREFER_LESS_TRANSFER' not in settings:
             settings['PREFER_LESS_TRANSFER'] = False
+        # 优先快速和优先少换乘二选一，以优先少换乘为准
+        settings['PREFER_FAST'] = not settings['PREFER_LESS_TRANSFER']
         if 'TIMEZONE' not in settings:
             settings['TIMEZONE'] = 8
         if 'MAP_LINK' not in settings:
@@ -151,8 +321,6 @@ def get_user_settings(user_id):
             settings['DEFAULT_DEPARTURE'] = 'current'
         if 'SHOW_MAP_LINK' not in settings:
             settings['SHOW_MAP_LINK'] = True
-        if 'AUTO_UPDATE' not in settings:
-            settings['AUTO_UPDATE'] = True
         if 'SHOW_STATION_CODE' not in settings:
             settings['SHOW_STATION_CODE'] = True
         user_data['settings'] = settings
@@ -218,12 +386,14 @@ def save_user_routes(user_id, routes):
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = '''🚇 MTR 路径导航机器人
+    help_text = f'''🚇 MTR 路径导航机器人
 
 欢迎使用MTR路径导航机器人！以下是可用命令：
 
 📍 路线查询
-/path - 查询两个车站之间的路线
+/path - 查询两个车站之间的路线（可翻页查看之后出发的路线）
+/arrive - 查询在指定时间前到达的最晚出发路线（不使用最大换乘和优先少换乘设置）
+/reach <车站名> [分钟] - 查询一定时间内可达的车站
 
 📜 历史记录
 /history - 查看最近查询历史
@@ -249,13 +419,13 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🛣️ 地图设置
 /setmap - 设置地图链接
 /seemap - 查看当前地图链接
+/status - 查看数据更新状态
 
 ⚙️ 设置
 /settings - 打开设置面板
   - 历史记录：5/10/15/20/30/50条
   - 出发时间：当前时间/固定时间
   - 显示地图：是否在结果中显示地图链接
-  - 自动更新：是否自动更新车站数据
   - 显示代码：是否显示车站代码
   - 详细模式：显示详细路线信息
   - 高铁：是否包含高铁路线
@@ -263,16 +433,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
   - 越野步行：是否包含越野步行路线
   - 仅轻轨：是否仅查询轻轨路线
   - 最大时长：1-12小时
-  - 最小时长：0-12小时
-  - 最大换乘：0-20次
-  - 优先快速：优先选择快速路线
-  - 优先少换乘：优先选择少换乘路线
+  - 最大换乘：0-{MAX_TRANSFERS_LIMIT}次
+  - 优先快速：选择最早到达的路线
+  - 优先少换乘：选择换乘最少的路线，与优先快速二选一
   - 时区：UTC-12到UTC+12
   - 地图链接：默认/自定义
 
 ❓ 其他
 /start - 显示此帮助信息
-/cancel - 取消当前操作
+/cancel - 取消当前操作或正在进行的查询
 
 所有数据会自动保存，重启服务器后不会丢失！'''
 
@@ -298,16 +467,24 @@ async def start_station(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def end_station(update: Update, context: ContextTypes.DEFAULT_TYPE):
     end_station = update.message.text
     start_station = context.user_data['start_station']
+    # 查询在后台进行并立即结束对话，查询期间仍可 /cancel 或开始新的查询
+    context.application.create_task(
+        path_query(update, context, start_station, end_station), update=update)
+    return ConversationHandler.END
+
+
+async def path_query(update: Update, context: ContextTypes.DEFAULT_TYPE, start_station, end_station):
     user_id = update.effective_user.id
     settings = get_user_settings(user_id)
     
     logger.info(f'用户 {user_id} 查询路线：{start_station} → {end_station}')
+    local_file_path, dep_path = get_data_paths(settings['MAP_LINK'])
     logger.info(f'调用main函数参数：')
     logger.info(f'  station1: {start_station}')
     logger.info(f'  station2: {end_station}')
     logger.info(f'  LINK: {settings["MAP_LINK"]}')
-    logger.info(f'  LOCAL_FILE_PATH: {LOCAL_FILE_PATH}')
-    logger.info(f'  DEP_PATH: {DEP_PATH}')
+    logger.info(f'  LOCAL_FILE_PATH: {local_file_path}')
+    logger.info(f'  DEP_PATH: {dep_path}')
     logger.info(f'  BASE_PATH: {BASE_PATH}')
     logger.info(f'  PNG_PATH: {PNG_PATH}')
     logger.info(f'  MAX_WILD_BLOCKS: {MAX_WILD_BLOCKS}')
@@ -315,7 +492,7 @@ async def end_station(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'  WILD_ADDITION: {WILD_ADDITION}')
     logger.info(f'  STATION_TABLE: {STATION_TABLE}')
     logger.info(f'  ORIGINAL_IGNORED_LINES: {ORIGINAL_IGNORED_LINES}')
-    logger.info(f'  UPDATE_DATA: {settings["AUTO_UPDATE"]}')
+    logger.info(f'  UPDATE_DATA: {UPDATE_DATA}')
     logger.info(f'  GEN_DEPARTURE: {GEN_DEPARTURE}')
     logger.info(f'  IGNORED_LINES: {IGNORED_LINES}')
     logger.info(f'  AVOID_STATIONS: {AVOID_STATIONS}')
@@ -325,27 +502,42 @@ async def end_station(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'  ONLY_LRT: {settings["ONLY_LRT"]}')
     logger.info(f'  DETAIL: {settings["DETAIL"]}')
     logger.info(f'  MAX_HOUR: {settings["MAX_HOUR"]}')
+    logger.info(f'  MAX_TRANSFERS: {settings["MAX_TRANSFERS"]}')
+    logger.info(f'  PREFER_LESS_TRANSFER: {settings["PREFER_LESS_TRANSFER"]}')
+    logger.info(f'  alternatives: {ALTERNATIVES}')
     logger.info(f'  gen_image: True')
     logger.info(f'  show: False')
     
     await update.message.reply_text('正在生成路线图，请稍候...')
     
+    budget = start_query(context)
     try:
+        data = await get_station_data(context, settings['MAP_LINK'])
         map_link = settings['MAP_LINK'] if settings['SHOW_MAP_LINK'] else None
-        result = main(
-            start_station, end_station, settings['MAP_LINK'], LOCAL_FILE_PATH, DEP_PATH,
+        result = await asyncio.to_thread(
+            main, start_station, end_station, settings['MAP_LINK'], local_file_path, dep_path,
             BASE_PATH, PNG_PATH, MAX_WILD_BLOCKS, TRANSFER_ADDITION,
             WILD_ADDITION, STATION_TABLE, ORIGINAL_IGNORED_LINES,
-            settings['AUTO_UPDATE'], GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
+            UPDATE_DATA, GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
             settings['CALCULATE_HIGH_SPEED'], settings['CALCULATE_BOAT'], 
             settings['CALCULATE_WALKING_WILD'], settings['ONLY_LRT'], 
             settings['DETAIL'], settings['MAX_HOUR'], gen_image=True, show=False,
-            map_link=map_link
+            map_link=map_link, data=data,
+            MIN_CHANGE_TIME=MIN_CHANGE_TIME, CHANGE_TIME=CHANGE_TIME,
+            TRANSFER_PENALTY=TRANSFER_PENALTY, WILD_PENALTY=WILD_PENALTY,
+            MAX_TRANSFERS=settings['MAX_TRANSFERS'],
+            PREFER_LESS_TRANSFER=settings['PREFER_LESS_TRANSFER'],
+            budget=budget, alternatives=ALTERNATIVES
         )
+    except QueryCancelled:
+        logger.info(f'用户 {user_id} 的查询已取消')
+        return
     except Exception as e:
         logger.error(f'用户 {user_id} 查询路线失败：{e}')
         await update.message.reply_text('查询路线时发生错误，请稍后重试。')
-        return ConversationHandler.END
+        return
+    finally:
+        finish_query(context, budget)
     
     if result is False:
         logger.warning(f'用户 {user_id} 未找到路线：{start_station} → {end_station}')
@@ -353,24 +545,114 @@ async def end_station(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif result is None:
         logger.warning(f'用户 {user_id} 车站名称错误')
         await update.message.reply_text('车站输入错误，请重新输入。')
-    elif not isinstance(result, tuple) or len(result) != 2:
+    elif not isinstance(result, list) or len(result) == 0:
         logger.error(f'用户 {user_id} 查询结果格式错误：{type(result)}')
         await update.message.reply_text('查询结果格式错误，请稍后重试。')
     else:
         logger.info(f'用户 {user_id} 路线查询成功：{start_station} → {end_station}')
         add_to_history(user_id, start_station, end_station)
+        await reply_journeys(update.message, context, result)
+
+
+async def arrive_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    logger.info(f'用户 {user_id} 开始查询按时到达路线')
+    await update.message.reply_text('请输入起点车站名称：')
+    return START_STATION
+
+
+async def arrive_end_station(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    end_station = update.message.text
+    logger.info(f'用户 {user_id} 输入终点：{end_station}')
+    context.user_data['end_station'] = end_station
+    await update.message.reply_text('请输入最晚到达时间（HH:MM）：')
+    return ARRIVAL_TIME
+
+
+async def arrive_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip().replace('：', ':')
+    start_station = context.user_data['start_station']
+    end_station = context.user_data['end_station']
+    
+    try:
+        hour, minute = (int(x) for x in text.split(':'))
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text('时间格式错误，请输入 HH:MM，例如 18:30：')
+        return ARRIVAL_TIME
+    
+    # 查询在后台进行并立即结束对话，查询期间仍可 /cancel 或开始新的查询
+    context.application.create_task(
+        arrive_query(update, context, start_station, end_station, text, hour * 3600 + minute * 60),
+        update=update)
+    return ConversationHandler.END
+
+
+async def arrive_query(update: Update, context: ContextTypes.DEFAULT_TYPE, start_station, end_station,
+                       text, arrival_time):
+    user_id = update.effective_user.id
+    settings = get_user_settings(user_id)
+    logger.info(f'用户 {user_id} 查询按时到达路线：{start_station} → {end_station}，{text} 前到达')
+    local_file_path, dep_path = get_data_paths(settings['MAP_LINK'])
+    
+    await update.message.reply_text('正在生成路线图，请稍候...')
+    
+    budget = start_query(context)
+    try:
+        data = await get_station_data(context, settings['MAP_LINK'])
+        map_link = settings['MAP_LINK'] if settings['SHOW_MAP_LINK'] else None
+        # 按时到达只支持最早到达的反向寻路，不传入最大换乘和优先少换乘设置
+        result = await asyncio.to_thread(
+            main, start_station, end_station, settings['MAP_LINK'], local_file_path, dep_path,
+            BASE_PATH, PNG_PATH, MAX_WILD_BLOCKS, TRANSFER_ADDITION,
+            WILD_ADDITION, STATION_TABLE, ORIGINAL_IGNORED_LINES,
+            UPDATE_DATA, GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
+            settings['CALCULATE_HIGH_SPEED'], settings['CALCULATE_BOAT'], 
+            settings['CALCULATE_WALKING_WILD'], settings['ONLY_LRT'], 
+            settings['DETAIL'], settings['MAX_HOUR'], gen_image=True, show=False,
+            map_link=map_link, data=data, arrival_time=arrival_time,
+            MIN_CHANGE_TIME=MIN_CHANGE_TIME, CHANGE_TIME=CHANGE_TIME,
+            TRANSFER_PENALTY=TRANSFER_PENALTY, WILD_PENALTY=WILD_PENALTY,
+            budget=budget
+        )
+    except QueryCancelled:
+        logger.info(f'用户 {user_id} 的查询已取消')
+        return
+    except Exception as e:
+        logger.error(f'用户 {user_id} 查询按时到达路线失败：{e}')
+        await update.message.reply_text('查询路线时发生错误，请稍后重试。')
+        return
+    finally:
+        finish_query(context, budget)
+    
+    if result is False:
+        logger.warning(f'用户 {user_id} 未找到按时到达路线：{start_station} → {end_station}')
+        await update.message.reply_text(f'找不到能在 {text} 前到达的路线。')
+    elif result is None:
+        logger.warning(f'用户 {user_id} 车站名称错误')
+        await update.message.reply_text('车站输入错误，请重新输入。')
+    elif not isinstance(result, tuple) or len(result) != 2:
+        logger.error(f'用户 {user_id} 查询结果格式错误：{type(result)}')
+        await update.message.reply_text('查询结果格式错误，请稍后重试。')
+    else:
+        logger.info(f'用户 {user_id} 按时到达路线查询成功：{start_station} → {end_station}')
+        add_to_history(user_id, start_station, end_station)
         image, base64_str = result
         from io import BytesIO
         import base64 as b64
         img_bytes = b64.b64decode(base64_str)
         await update.message.reply_photo(photo=BytesIO(img_bytes))
-    
-    return ConversationHandler.END
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f'用户 {user_id} 取消操作')
+    budget = context.user_data.pop('budget', None)
+    if budget is not None:
+        budget.cancel()
+        logger.info(f'用户 {user_id} 取消正在进行的查询')
     await update.message.reply_text('已取消操作。')
     return ConversationHandler.END
 
@@ -417,10 +699,6 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         ],
         [
-            InlineKeyboardButton(
-                f"最小时长: {settings['MIN_HOUR']}小时", 
-                callback_data='change_MIN_HOUR'
-            ),
             InlineKeyboardButton(
                 f"最大换乘: {settings['MAX_TRANSFERS']}次", 
                 callback_data='change_MAX_TRANSFERS'
@@ -461,12 +739,6 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"显示地图: {'✅' if settings['SHOW_MAP_LINK'] else '❌'}", 
                 callback_data='toggle_SHOW_MAP_LINK'
             ),
-            InlineKeyboardButton(
-                f"自动更新: {'✅' if settings['AUTO_UPDATE'] else '❌'}", 
-                callback_data='toggle_AUTO_UPDATE'
-            )
-        ],
-        [
             InlineKeyboardButton(
                 f"显示代码: {'✅' if settings['SHOW_STATION_CODE'] else '❌'}", 
                 callback_data='toggle_SHOW_STATION_CODE'
@@ -509,17 +781,17 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == 'change_MAX_HOUR':
         settings['MAX_HOUR'] = settings['MAX_HOUR'] + 1 if settings['MAX_HOUR'] < 12 else 1
         logger.info(f'用户 {user_id} 修改最大时长：{settings["MAX_HOUR"]}')
-    elif query.data == 'change_MIN_HOUR':
-        settings['MIN_HOUR'] = settings['MIN_HOUR'] + 1 if settings['MIN_HOUR'] < 12 else 0
-        logger.info(f'用户 {user_id} 修改最小时长：{settings["MIN_HOUR"]}')
     elif query.data == 'change_MAX_TRANSFERS':
-        settings['MAX_TRANSFERS'] = settings['MAX_TRANSFERS'] + 1 if settings['MAX_TRANSFERS'] < 20 else 0
+        settings['MAX_TRANSFERS'] = settings['MAX_TRANSFERS'] + 1 if settings['MAX_TRANSFERS'] < MAX_TRANSFERS_LIMIT else 0
         logger.info(f'用户 {user_id} 修改最大换乘：{settings["MAX_TRANSFERS"]}')
     elif query.data == 'toggle_PREFER_FAST':
+        # 优先快速和优先少换乘二选一，分别对应最早到达和乘车次数最少的路线
         settings['PREFER_FAST'] = not settings['PREFER_FAST']
+        settings['PREFER_LESS_TRANSFER'] = not settings['PREFER_FAST']
         logger.info(f'用户 {user_id} 切换优先快速：{settings["PREFER_FAST"]}')
     elif query.data == 'toggle_PREFER_LESS_TRANSFER':
         settings['PREFER_LESS_TRANSFER'] = not settings['PREFER_LESS_TRANSFER']
+        settings['PREFER_FAST'] = not settings['PREFER_LESS_TRANSFER']
         logger.info(f'用户 {user_id} 切换优先少换乘：{settings["PREFER_LESS_TRANSFER"]}')
     elif query.data == 'change_TIMEZONE':
         settings['TIMEZONE'] = settings['TIMEZONE'] + 1 if settings['TIMEZONE'] < 12 else -12
@@ -542,9 +814,6 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == 'toggle_SHOW_MAP_LINK':
         settings['SHOW_MAP_LINK'] = not settings['SHOW_MAP_LINK']
         logger.info(f'用户 {user_id} 切换显示地图链接：{settings["SHOW_MAP_LINK"]}')
-    elif query.data == 'toggle_AUTO_UPDATE':
-        settings['AUTO_UPDATE'] = not settings['AUTO_UPDATE']
-        logger.info(f'用户 {user_id} 切换自动更新：{settings["AUTO_UPDATE"]}')
     elif query.data == 'toggle_SHOW_STATION_CODE':
         settings['SHOW_STATION_CODE'] = not settings['SHOW_STATION_CODE']
         logger.info(f'用户 {user_id} 切换显示车站代码：{settings["SHOW_STATION_CODE"]}')
@@ -556,7 +825,6 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'CALCULATE_WALKING_WILD': False,
             'ONLY_LRT': False,
             'MAX_HOUR': 3,
-            'MIN_HOUR': 0,
             'MAX_TRANSFERS': 10,
             'PREFER_FAST': True,
             'PREFER_LESS_TRANSFER': False,
@@ -565,7 +833,6 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'HISTORY_LIMIT': 10,
             'DEFAULT_DEPARTURE': 'current',
             'SHOW_MAP_LINK': True,
-            'AUTO_UPDATE': True,
             'SHOW_STATION_CODE': True
         })
         logger.info(f'用户 {user_id} 重置设置')
@@ -604,10 +871,6 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         ],
         [
-            InlineKeyboardButton(
-                f"最小时长: {settings['MIN_HOUR']}小时", 
-                callback_data='change_MIN_HOUR'
-            ),
             InlineKeyboardButton(
                 f"最大换乘: {settings['MAX_TRANSFERS']}次", 
                 callback_data='change_MAX_TRANSFERS'
@@ -648,12 +911,6 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"显示地图: {'✅' if settings['SHOW_MAP_LINK'] else '❌'}", 
                 callback_data='toggle_SHOW_MAP_LINK'
             ),
-            InlineKeyboardButton(
-                f"自动更新: {'✅' if settings['AUTO_UPDATE'] else '❌'}", 
-                callback_data='toggle_AUTO_UPDATE'
-            )
-        ],
-        [
             InlineKeyboardButton(
                 f"显示代码: {'✅' if settings['SHOW_STATION_CODE'] else '❌'}", 
                 callback_data='toggle_SHOW_STATION_CODE'
@@ -706,12 +963,13 @@ async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = get_user_settings(user_id)
     
     logger.info(f'用户 {user_id} 从历史查询：{route["start"]} → {route["end"]}')
+    local_file_path, dep_path = get_data_paths(settings['MAP_LINK'])
     logger.info(f'调用main函数参数：')
     logger.info(f'  station1: {route["start"]}')
     logger.info(f'  station2: {route["end"]}')
     logger.info(f'  LINK: {settings["MAP_LINK"]}')
-    logger.info(f'  LOCAL_FILE_PATH: {LOCAL_FILE_PATH}')
-    logger.info(f'  DEP_PATH: {DEP_PATH}')
+    logger.info(f'  LOCAL_FILE_PATH: {local_file_path}')
+    logger.info(f'  DEP_PATH: {dep_path}')
     logger.info(f'  BASE_PATH: {BASE_PATH}')
     logger.info(f'  PNG_PATH: {PNG_PATH}')
     logger.info(f'  MAX_WILD_BLOCKS: {MAX_WILD_BLOCKS}')
@@ -719,7 +977,7 @@ async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'  WILD_ADDITION: {WILD_ADDITION}')
     logger.info(f'  STATION_TABLE: {STATION_TABLE}')
     logger.info(f'  ORIGINAL_IGNORED_LINES: {ORIGINAL_IGNORED_LINES}')
-    logger.info(f'  UPDATE_DATA: {settings["AUTO_UPDATE"]}')
+    logger.info(f'  UPDATE_DATA: {UPDATE_DATA}')
     logger.info(f'  GEN_DEPARTURE: {GEN_DEPARTURE}')
     logger.info(f'  IGNORED_LINES: {IGNORED_LINES}')
     logger.info(f'  AVOID_STATIONS: {AVOID_STATIONS}')
@@ -729,27 +987,42 @@ async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'  ONLY_LRT: {settings["ONLY_LRT"]}')
     logger.info(f'  DETAIL: {settings["DETAIL"]}')
     logger.info(f'  MAX_HOUR: {settings["MAX_HOUR"]}')
+    logger.info(f'  MAX_TRANSFERS: {settings["MAX_TRANSFERS"]}')
+    logger.info(f'  PREFER_LESS_TRANSFER: {settings["PREFER_LESS_TRANSFER"]}')
+    logger.info(f'  alternatives: {ALTERNATIVES}')
     logger.info(f'  gen_image: True')
     logger.info(f'  show: False')
     
     await query.edit_message_text(f'正在查询 {route["start"]} → {route["end"]}...')
     
+    budget = start_query(context)
     try:
+        data = await get_station_data(context, settings['MAP_LINK'])
         map_link = settings['MAP_LINK'] if settings['SHOW_MAP_LINK'] else None
-        result = main(
-            route['start'], route['end'], settings['MAP_LINK'], LOCAL_FILE_PATH, DEP_PATH,
+        result = await asyncio.to_thread(
+            main, route['start'], route['end'], settings['MAP_LINK'], local_file_path, dep_path,
             BASE_PATH, PNG_PATH, MAX_WILD_BLOCKS, TRANSFER_ADDITION,
             WILD_ADDITION, STATION_TABLE, ORIGINAL_IGNORED_LINES,
-            settings['AUTO_UPDATE'], GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
+            UPDATE_DATA, GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
             settings['CALCULATE_HIGH_SPEED'], settings['CALCULATE_BOAT'], 
             settings['CALCULATE_WALKING_WILD'], settings['ONLY_LRT'], 
             settings['DETAIL'], settings['MAX_HOUR'], gen_image=True, show=False,
-            map_link=map_link
+            map_link=map_link, data=data,
+            MIN_CHANGE_TIME=MIN_CHANGE_TIME, CHANGE_TIME=CHANGE_TIME,
+            TRANSFER_PENALTY=TRANSFER_PENALTY, WILD_PENALTY=WILD_PENALTY,
+            MAX_TRANSFERS=settings['MAX_TRANSFERS'],
+            PREFER_LESS_TRANSFER=settings['PREFER_LESS_TRANSFER'],
+            budget=budget, alternatives=ALTERNATIVES
         )
+    except QueryCancelled:
+        logger.info(f'用户 {user_id} 的查询已取消')
+        return
     except Exception as e:
         logger.error(f'用户 {user_id} 历史查询失败：{e}')
         await query.message.reply_text('查询路线时发生错误，请稍后重试。')
         return
+    finally:
+        finish_query(context, budget)
     
     if result is False:
         logger.warning(f'用户 {user_id} 历史查询未找到路线')
@@ -757,17 +1030,13 @@ async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif result is None:
         logger.warning(f'用户 {user_id} 历史查询车站名称错误')
         await query.message.reply_text('车站输入错误，请重新输入。')
-    elif not isinstance(result, tuple) or len(result) != 2:
+    elif not isinstance(result, list) or len(result) == 0:
         logger.error(f'用户 {user_id} 历史查询结果格式错误：{type(result)}')
         await query.message.reply_text('查询结果格式错误，请稍后重试。')
     else:
         logger.info(f'用户 {user_id} 历史查询成功')
         add_to_history(user_id, route['start'], route['end'])
-        image, base64_str = result
-        from io import BytesIO
-        import base64 as b64
-        img_bytes = b64.b64decode(base64_str)
-        await query.message.reply_photo(photo=BytesIO(img_bytes))
+        await reply_journeys(query.message, context, result)
 
 
 async def add_route_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -836,12 +1105,13 @@ async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = get_user_settings(user_id)
     
     logger.info(f'用户 {user_id} 使用快捷命令：{route_name}')
+    local_file_path, dep_path = get_data_paths(settings['MAP_LINK'])
     logger.info(f'调用main函数参数：')
     logger.info(f'  station1: {route["start"]}')
     logger.info(f'  station2: {route["end"]}')
     logger.info(f'  LINK: {settings["MAP_LINK"]}')
-    logger.info(f'  LOCAL_FILE_PATH: {LOCAL_FILE_PATH}')
-    logger.info(f'  DEP_PATH: {DEP_PATH}')
+    logger.info(f'  LOCAL_FILE_PATH: {local_file_path}')
+    logger.info(f'  DEP_PATH: {dep_path}')
     logger.info(f'  BASE_PATH: {BASE_PATH}')
     logger.info(f'  PNG_PATH: {PNG_PATH}')
     logger.info(f'  MAX_WILD_BLOCKS: {MAX_WILD_BLOCKS}')
@@ -849,7 +1119,7 @@ async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'  WILD_ADDITION: {WILD_ADDITION}')
     logger.info(f'  STATION_TABLE: {STATION_TABLE}')
     logger.info(f'  ORIGINAL_IGNORED_LINES: {ORIGINAL_IGNORED_LINES}')
-    logger.info(f'  UPDATE_DATA: {settings["AUTO_UPDATE"]}')
+    logger.info(f'  UPDATE_DATA: {UPDATE_DATA}')
     logger.info(f'  GEN_DEPARTURE: {GEN_DEPARTURE}')
     logger.info(f'  IGNORED_LINES: {IGNORED_LINES}')
     logger.info(f'  AVOID_STATIONS: {AVOID_STATIONS}')
@@ -859,27 +1129,42 @@ async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'  ONLY_LRT: {settings["ONLY_LRT"]}')
     logger.info(f'  DETAIL: {settings["DETAIL"]}')
     logger.info(f'  MAX_HOUR: {settings["MAX_HOUR"]}')
+    logger.info(f'  MAX_TRANSFERS: {settings["MAX_TRANSFERS"]}')
+    logger.info(f'  PREFER_LESS_TRANSFER: {settings["PREFER_LESS_TRANSFER"]}')
+    logger.info(f'  alternatives: {ALTERNATIVES}')
     logger.info(f'  gen_image: True')
     logger.info(f'  show: False')
     
     await update.message.reply_text(f'正在查询 {route["start"]} → {route["end"]}...')
     
+    budget = start_query(context)
     try:
+        data = await get_station_data(context, settings['MAP_LINK'])
         map_link = settings['MAP_LINK'] if settings['SHOW_MAP_LINK'] else None
-        result = main(
-            route['start'], route['end'], settings['MAP_LINK'], LOCAL_FILE_PATH, DEP_PATH,
+        result = await asyncio.to_thread(
+            main, route['start'], route['end'], settings['MAP_LINK'], local_file_path, dep_path,
             BASE_PATH, PNG_PATH, MAX_WILD_BLOCKS, TRANSFER_ADDITION,
             WILD_ADDITION, STATION_TABLE, ORIGINAL_IGNORED_LINES,
-            settings['AUTO_UPDATE'], GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
+            UPDATE_DATA, GEN_DEPARTURE, IGNORED_LINES, AVOID_STATIONS,
             settings['CALCULATE_HIGH_SPEED'], settings['CALCULATE_BOAT'], 
             settings['CALCULATE_WALKING_WILD'], settings['ONLY_LRT'], 
             settings['DETAIL'], settings['MAX_HOUR'], gen_image=True, show=False,
-            map_link=map_link
+            map_link=map_link, data=data,
+            MIN_CHANGE_TIME=MIN_CHANGE_TIME, CHANGE_TIME=CHANGE_TIME,
+            TRANSFER_PENALTY=TRANSFER_PENALTY, WILD_PENALTY=WILD_PENALTY,
+            MAX_TRANSFERS=settings['MAX_TRANSFERS'],
+            PREFER_LESS_TRANSFER=settings['PREFER_LESS_TRANSFER'],
+            budget=budget, alternatives=ALTERNATIVES
         )
+    except QueryCancelled:
+        logger.info(f'用户 {user_id} 的查询已取消')
+        return
     except Exception as e:
         logger.error(f'用户 {user_id} 快捷命令查询失败：{e}')
         await update.message.reply_text('查询路线时发生错误，请稍后重试。')
         return
+    finally:
+        finish_query(context, budget)
     
     if result is False:
         logger.warning(f'用户 {user_id} 快捷命令查询未找到路线')
@@ -887,17 +1172,13 @@ async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif result is None:
         logger.warning(f'用户 {user_id} 快捷命令查询车站名称错误')
         await update.message.reply_text('车站输入错误，请重新输入。')
-    elif not isinstance(result, tuple) or len(result) != 2:
+    elif not isinstance(result, list) or len(result) == 0:
         logger.error(f'用户 {user_id} 快捷命令查询结果格式错误：{type(result)}')
         await update.message.reply_text('查询结果格式错误，请稍后重试。')
     else:
         logger.info(f'用户 {user_id} 快捷命令查询成功')
         add_to_history(user_id, route['start'], route['end'])
-        image, base64_str = result
-        from io import BytesIO
-        import base64 as b64
-        img_bytes = b64.b64decode(base64_str)
-        await update.message.reply_photo(photo=BytesIO(img_bytes))
+        await reply_journeys(update.message, context, result)
 
 
 async def del_route_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -959,19 +1240,11 @@ async def station_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     map_link = settings['MAP_LINK']
     show_code = settings.get('SHOW_STATION_CODE', True)
     
-    link_hash = hashlib.md5(map_link.encode('utf-8')).hexdigest()
-    local_file_path = os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json')
-    
-    logger.info(f'用户 {user_id} 更新车站数据：{map_link}')
-    await update.message.reply_text('正在更新车站数据，请稍候...')
-    
     try:
-        from mtr_pathfinder_v4 import fetch_data
-        data = fetch_data(map_link, local_file_path, MAX_WILD_BLOCKS)
-        logger.info(f'用户 {user_id} 车站数据更新成功')
+        data = await get_station_data(context, map_link)
     except Exception as e:
-        logger.error(f'用户 {user_id} 车站数据更新失败：{e}')
-        await update.message.reply_text('更新车站数据失败，请稍后重试。')
+        logger.error(f'用户 {user_id} 加载车站数据失败：{e}')
+        await update.message.reply_text('加载车站数据失败，请稍后重试。')
         return
     
     station_id = station_name_to_id(data, station_name, STATION_TABLE)
@@ -1026,6 +1299,75 @@ async def station_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 
+async def reach_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    if not context.args:
+        logger.info(f'用户 {user_id} 查看可达范围帮助')
+        await update.message.reply_text('用法：/reach <车站名> [分钟]\n例如：/reach 莱恩再新城 30')
+        return
+    
+    max_min = 30
+    args = context.args
+    if len(args) > 1 and args[-1].isdigit():
+        max_min = int(args[-1])
+        args = args[:-1]
+    
+    station_name = ' '.join(args)
+    settings = get_user_settings(user_id)
+    max_min = max(1, min(max_min, settings['MAX_HOUR'] * 60))
+    band_min = 5 if max_min <= 30 else 10 if max_min <= 60 else 30
+    logger.info(f'用户 {user_id} 查询可达范围：{station_name}，{max_min}分钟')
+    local_file_path, dep_path = get_data_paths(settings['MAP_LINK'])
+    
+    budget = start_query(context)
+    try:
+        data = await get_station_data(context, settings['MAP_LINK'])
+        bands = await asyncio.to_thread(
+            isochrone, station_name, settings['MAP_LINK'], local_file_path, dep_path,
+            MAX_WILD_BLOCKS, TRANSFER_ADDITION, WILD_ADDITION, STATION_TABLE,
+            ORIGINAL_IGNORED_LINES, UPDATE_DATA, GEN_DEPARTURE,
+            IGNORED_LINES, AVOID_STATIONS,
+            settings['CALCULATE_HIGH_SPEED'], settings['CALCULATE_BOAT'],
+            settings['CALCULATE_WALKING_WILD'], settings['ONLY_LRT'],
+            max_min=max_min, band_min=band_min, data=data, budget=budget,
+            MIN_CHANGE_TIME=MIN_CHANGE_TIME, CHANGE_TIME=CHANGE_TIME,
+            TRANSFER_PENALTY=TRANSFER_PENALTY, WILD_PENALTY=WILD_PENALTY
+        )
+    except QueryCancelled:
+        logger.info(f'用户 {user_id} 的查询已取消')
+        return
+    except Exception as e:
+        logger.error(f'用户 {user_id} 查询可达范围失败：{e}')
+        await update.message.reply_text('查询可达范围时发生错误，请稍后重试。')
+        return
+    finally:
+        finish_query(context, budget)
+    
+    if bands is None:
+        logger.warning(f'用户 {user_id} 车站不存在：{station_name}')
+        await update.message.reply_text(f'找不到车站 "{station_name}"。')
+        return
+    
+    text = f'🕒 {station_name} {max_min}分钟内可达的车站：\n'
+    for i, band in enumerate(bands):
+        if not band:
+            continue
+        text += f'\n⏱ {i * band_min}-{min((i + 1) * band_min, max_min)}分钟（{len(band)}个）\n'
+        for name, minutes in band:
+            text += f'• {name.replace("|", " / ")} {minutes}分钟\n'
+    
+    if all(not band for band in bands):
+        text += '\n无'
+    
+    # Telegram 单条消息最多 4096 个字符
+    if len(text) > 4096:
+        text = text[:4000].rsplit('\n', 1)[0] + '\n……'
+    
+    logger.info(f'用户 {user_id} 可达范围查询成功：{station_name}')
+    await update.message.reply_text(text)
+
+
 async def line_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -1040,19 +1382,11 @@ async def line_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = get_user_settings(user_id)
     map_link = settings['MAP_LINK']
     
-    link_hash = hashlib.md5(map_link.encode('utf-8')).hexdigest()
-    local_file_path = os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json')
-    
-    logger.info(f'用户 {user_id} 更新车站数据：{map_link}')
-    await update.message.reply_text('正在更新车站数据，请稍候...')
-    
     try:
-        from mtr_pathfinder_v4 import fetch_data
-        data = fetch_data(map_link, local_file_path, MAX_WILD_BLOCKS)
-        logger.info(f'用户 {user_id} 车站数据更新成功')
+        data = await get_station_data(context, map_link)
     except Exception as e:
-        logger.error(f'用户 {user_id} 车站数据更新失败：{e}')
-        await update.message.reply_text('更新车站数据失败，请稍后重试。')
+        logger.error(f'用户 {user_id} 加载车站数据失败：{e}')
+        await update.message.reply_text('加载车站数据失败，请稍后重试。')
         return
     
     routes = data.get('routes', {})
@@ -1126,19 +1460,11 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     map_link = settings['MAP_LINK']
     show_code = settings.get('SHOW_STATION_CODE', True)
     
-    link_hash = hashlib.md5(map_link.encode('utf-8')).hexdigest()
-    local_file_path = os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json')
-    
-    logger.info(f'用户 {user_id} 更新车站数据：{map_link}')
-    await update.message.reply_text('正在更新车站数据，请稍候...')
-    
     try:
-        from mtr_pathfinder_v4 import fetch_data
-        data = fetch_data(map_link, local_file_path, MAX_WILD_BLOCKS)
-        logger.info(f'用户 {user_id} 车站数据更新成功')
+        data = await get_station_data(context, map_link)
     except Exception as e:
-        logger.error(f'用户 {user_id} 车站数据更新失败：{e}')
-        await update.message.reply_text('更新车站数据失败，请稍后重试。')
+        logger.error(f'用户 {user_id} 加载车站数据失败：{e}')
+        await update.message.reply_text('加载车站数据失败，请稍后重试。')
         return
     
     stations = data.get('stations', {})
@@ -1214,19 +1540,11 @@ async def count_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = get_user_settings(user_id)
     map_link = settings['MAP_LINK']
     
-    link_hash = hashlib.md5(map_link.encode('utf-8')).hexdigest()
-    local_file_path = os.path.join('mtr-pathfinder', f'mtr-station-data-{link_hash}-mtr4-v4.json')
-    
-    logger.info(f'用户 {user_id} 更新车站数据：{map_link}')
-    await update.message.reply_text('正在更新车站数据，请稍候...')
-    
     try:
-        from mtr_pathfinder_v4 import fetch_data
-        data = fetch_data(map_link, local_file_path, MAX_WILD_BLOCKS)
-        logger.info(f'用户 {user_id} 车站数据更新成功')
+        data = await get_station_data(context, map_link)
     except Exception as e:
-        logger.error(f'用户 {user_id} 车站数据更新失败：{e}')
-        await update.message.reply_text('更新车站数据失败，请稍后重试。')
+        logger.error(f'用户 {user_id} 加载车站数据失败：{e}')
+        await update.message.reply_text('加载车站数据失败，请稍后重试。')
         return
     
     stations = data.get('stations', {})
@@ -1300,6 +1618,7 @@ async def set_map_link_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = get_user_settings(user_id)
     settings['MAP_LINK'] = new_link
     save_user_settings(user_id, settings)
+    schedule_refresh(context.job_queue, new_link)
     
     await update.message.reply_text(f'✅ 地图链接已更新为：{new_link}')
     return ConversationHandler.END
@@ -1326,6 +1645,30 @@ async def see_map_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    logger.info(f'用户 {user_id} 查看数据状态')
+    
+    settings = get_user_settings(user_id)
+    link = settings['MAP_LINK']
+    status = get_refresh_status(link)
+    
+    text = f'📡 数据状态\n\n📍 链接：{link}\n'
+    for kind, name, interval in (('stations', '车站数据', STATION_REFRESH_INTERVAL),
+                                 ('departures', '发车数据', DEPARTURE_REFRESH_INTERVAL)):
+        item = status[kind]
+        text += f'\n{name}（每 {interval} 秒刷新）\n'
+        if item['updated'] is None:
+            text += '  更新时间：尚未更新\n'
+        else:
+            text += f'  距上次更新：{round(time.time() - item["updated"])} 秒\n'
+        text += f'  连续失败：{item["failures"]} 次，累计失败：{item["total_failures"]} 次\n'
+        if item['last_error'] is not None:
+            text += f'  最近错误：{item["last_error"]}\n'
+    
+    await update.message.reply_text(text)
+
+
 def main_bot():
     TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
     if not TOKEN:
@@ -1342,6 +1685,18 @@ def main_bot():
             END_STATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, end_station)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        allow_reentry=True,
+    )
+    
+    arrive_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('arrive', arrive_start)],
+        states={
+            START_STATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, start_station)],
+            END_STATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, arrive_end_station)],
+            ARRIVAL_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, arrive_time)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        allow_reentry=True,
     )
     
     add_route_conv_handler = ConversationHandler(
@@ -1371,20 +1726,31 @@ def main_bot():
     )
     
     application.add_handler(conv_handler)
+    application.add_handler(arrive_conv_handler)
     application.add_handler(add_route_conv_handler)
     application.add_handler(del_route_conv_handler)
     application.add_handler(set_map_link_conv_handler)
     application.add_handler(CommandHandler('start', start_command))
     application.add_handler(CommandHandler('station', station_command))
+    application.add_handler(CommandHandler('reach', reach_command, block=False))
     application.add_handler(CommandHandler('line', line_command))
     application.add_handler(CommandHandler('search', search_command))
     application.add_handler(CommandHandler('count', count_command))
     application.add_handler(CommandHandler('settings', settings))
     application.add_handler(CommandHandler('history', history))
-    application.add_handler(CommandHandler('route', route_command))
+    application.add_handler(CommandHandler('route', route_command, block=False))
     application.add_handler(CommandHandler('seemap', see_map_link))
     application.add_handler(CallbackQueryHandler(settings_callback, pattern='^toggle_|^change_|^reset_'))
-    application.add_handler(CallbackQueryHandler(history_callback, pattern='^history_'))
+    application.add_handler(CallbackQueryHandler(history_callback, pattern='^history_', block=False))
+    application.add_handler(CallbackQueryHandler(journey_callback, pattern='^journey_'))
+    application.add_handler(CommandHandler('cancel', cancel))
+    
+    application.add_handler(CommandHandler('status', status_command))
+    
+    if application.job_queue is None:
+        logger.warning('未安装 python-telegram-bot[job-queue]，车站数据将在查询时刷新')
+    for link in get_links_in_use():
+        schedule_refresh(application.job_queue, link)
     
     print('Bot已启动...')
     application.run_polling()